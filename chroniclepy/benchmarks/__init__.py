@@ -0,0 +1,6 @@
+'''
+Benchmarks of ChroniclePy on synthetic raw data, eg. from the root of the repository:
+
+    python -m chroniclepy.benchmarks.bench before.json
+    python -m chroniclepy.benchmarks.bench after.json --compare before.json
+'''
@@ -0,0 +1,187 @@
+'''
+Timed benchmarks of the stages of the pipeline, on synthetic raw files (see generate):
+reading the raw files, extracting the usage (per engine), checking the overlap and the
+sessions, adding the summary columns and the full summary, each at several precisions.
+The imports of the command line are timed as well.  The results are written as json, so
+that runs on different commits can be compared.
+'''
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from chroniclepy.chroniclepy import __version__, dtypes, preprocessing, summarising, utils
+from chroniclepy.chroniclepy.constants import columns
+from chroniclepy.benchmarks import generate
+
+def timeit(function, repeat=3, setup=None):
+    '''
+    This function times a function (the logging and warnings are discarded).  With setup, the result
+    of setup() is passed to the function, so that copies aren't timed.  Returns the
+    times in seconds and the result of the last run.
+    '''
+    times = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for _ in range(repeat):
+            args = setup() if setup is not None else ()
+            start = time.perf_counter()
+            result = function(*args)
+            times.append(time.perf_counter() - start)
+    return times, result
+
+# seconds for all imports (also at the start of the interpreter) to print the help
+import_budget = 0.25
+
+def time_imports():
+    '''
+    This function times the imports of the command line to print the help, in a new
+    interpreter (see python -X importtime).  Returns the time in seconds.
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=root)
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'chroniclepy.chroniclepy', '--help'],
+        capture_output=True, text=True, env=env, cwd=root, check=True).stderr
+    # lines "import time: self [us] | cumulative [us] | package", nested imports are indented
+    imports = [x.split('|') for x in output.splitlines() if x.startswith('import time:') and not 'self [us]' in x]
+    return sum(int(x[1]) for x in imports if not x[2].startswith('  ')) / 1e6
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+def result(stage, times, rows, **parameters):
+    return dict(stage=stage, rows=int(rows), seconds=min(times), times=times, **parameters)
+
+def benchmark(workdir, participants=5, days=14, seed=0, precisions=[60, 900, 3600],
+    engines=['loop', 'vectorized'], sessioninterval=[60], repeat=3):
+    '''
+    This function generates the raw files in the workdir and times every stage on all
+    files together.  The extracted usage of the first engine is used for the next stages.
+    Returns a dictionary with the parameters, the environment and a list of results.
+    '''
+    rawfolder = os.path.join(workdir, 'raw')
+    filenames = generate.generate(rawfolder, participants=participants, days=days, seed=seed)
+    results = []
+
+    times = [time_imports() for _ in range(repeat)]
+    results.append(result('cli_imports', times, 0, budget=import_budget))
+    if min(times) > import_budget:
+        print("The imports of the command line take %.3fs, more than the budget of %.2fs"%(min(times), import_budget))
+
+    times, raw = timeit(lambda: [preprocessing.read_data(x) for x in filenames], repeat=repeat)
+    events = sum(len(x) for x in raw)
+    results.append(result('read_data', times, events))
+    raw = [utils.backwards_compatibility(x) for x in raw]
+
+    for precision in precisions:
+        for engine in engines:
+            times, extracted = timeit(lambda: [preprocessing.engines[engine](x.copy(), precision=precision) for x in raw],
+                repeat=repeat)
+            results.append(result('extract_usage', times, events, precision=precision, engine=engine))
+            if engine == engines[0]:
+                usage = extracted
+
+        timed = [x[x[columns.prep_duration_seconds] > 0] for x in usage]
+        times, _ = timeit(lambda *x: [preprocessing.check_overlap_add_sessions(y, session_def=sessioninterval) for y in x],
+            repeat=repeat, setup=lambda: [x.copy() for x in timed])
+        results.append(result('check_overlap_add_sessions', times, sum(len(x) for x in timed), precision=precision))
+
+        prepfolder = os.path.join(workdir, 'preprocessed_%i'%precision)
+        os.makedirs(prepfolder, exist_ok=True)
+        preprocessed = []
+        for filename, data in zip(filenames, usage):
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                data = preprocessing.preprocess_usage(data, sessioninterval=sessioninterval)
+            outfilename = os.path.join(prepfolder, os.path.basename(filename).replace('ChronicleData','ChronicleData_preprocessed'))
+            utils.write_intermediate(data, outfilename)
+            # as read by the summary
+            data = dtypes.compact(utils.backwards_compatibility(utils.read_intermediate(outfilename)))
+            preprocessed.append(data.dropna(subset=[columns.full_name]))
+        times, _ = timeit(lambda *x: [preprocessing.add_preprocessed_columns(y) for y in x],
+            repeat=repeat, setup=lambda: [x.copy() for x in preprocessed])
+        results.append(result('add_preprocessed_columns', times, sum(len(x) for x in preprocessed), precision=precision))
+
+        outfolder = os.path.join(workdir, 'output_%i'%precision)
+        times, _ = timeit(lambda: summarising.summary(prepfolder, outfolder, quarterly=True, splitweek=True, force=True),
+            repeat=repeat)
+        results.append(result('summary', times, sum(len(x) for x in preprocessed), precision=precision))
+
+    return {
+        'parameters': dict(participants=participants, days=days, seed=seed, precisions=list(precisions),
+            engines=list(engines), sessioninterval=list(sessioninterval), repeat=repeat),
+        'environment': dict(version=__version__, commit=get_commit(), python=platform.python_version(),
+            pandas=pd.__version__, numpy=np.__version__, machine=platform.machine()),
+        'results': results
+    }
+
+def compare(before, after):
+    '''
+    This function prints the fastest times of two benchmark runs (json files) side by
+    side, with the ratio (> 1 is faster after).
+    '''
+    runs = []
+    for filename in [before, after]:
+        with open(filename, 'r') as fl:
+            runs.append({(x['stage'], x.get('precision'), x.get('engine')): x['seconds'] for x in json.load(fl)['results']})
+    print("%-28s %9s %-10s %10s %10s %7s"%('stage', 'precision', 'engine', 'before', 'after', 'ratio'))
+    for key in [x for x in runs[0] if x in runs[1]]:
+        stage, precision, engine = key
+        print("%-28s %9s %-10s %10.3f %10.3f %7.2f"%(stage, precision or '', engine or '',
+            runs[0][key], runs[1][key], runs[0][key] / runs[1][key]))
+
+def get_parser():
+    parser = ArgumentParser(description = 'Benchmark the stages of ChroniclePy on synthetic data.')
+    parser.add_argument('output', action='store',
+        help = 'the json file to write the results (or with --compare: the run to compare to).')
+    parser.add_argument('--compare', action='store', default=None,
+        help = 'a json file with the results of an earlier run, to compare with output \
+            instead of running the benchmarks.')
+    parser.add_argument('--participants', action='store', type=int, default=5,
+        help = 'the number of participants (files).')
+    parser.add_argument('--days', action='store', type=int, default=14,
+        help = 'the number of days per participant.')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+        help = 'the seed of the random generator.')
+    parser.add_argument('--precision', action='append', type=int, default=None,
+        help = 'a precision (in seconds) to benchmark, can be given more than once \
+            (default: 60, 900 and 3600).')
+    parser.add_argument('--engine', action='append', choices=['loop', 'vectorized'], default=None,
+        help = 'an engine to benchmark, can be given more than once (default: both).')
+    parser.add_argument('--repeat', action='store', type=int, default=3,
+        help = 'the number of times every stage is run (the fastest time is reported).')
+    parser.add_argument('--workdir', action='store', default=None,
+        help = 'the folder for the generated files (default: a temporary folder that is removed).')
+    return parser
+
+if __name__ == '__main__':
+    opts = get_parser().parse_args()
+    if opts.compare is not None:
+        compare(opts.compare, opts.output)
+    else:
+        workdir = opts.workdir or tempfile.mkdtemp()
+        try:
+            results = benchmark(workdir, participants=opts.participants, days=opts.days, seed=opts.seed,
+                precisions=opts.precision or [60, 900, 3600], engines=opts.engine or ['loop', 'vectorized'],
+                repeat=opts.repeat)
+        finally:
+            if opts.workdir is None:
+                shutil.rmtree(workdir)
+        with open(opts.output, 'w') as fl:
+            json.dump(results, fl, indent=2)
+        for x in results['results']:
+            print("%-28s %9s %-10s %10.3f"%(x['stage'], x.get('precision', ''), x.get('engine', ''), x['seconds']))
@@ -0,0 +1,119 @@
+'''
+A seeded generator of synthetic raw Chronicle files, for benchmarks.  Every participant
+uses the phone in sessions: the screen turns on, a few apps are moved to the foreground
+and background (sometimes overlapping, sometimes never backgrounded), with interactions
+and notifications in between, until the screen turns off or the phone powers off.
+Participants can travel to another timezone, and the default start date makes the study
+period span a daylight saving time change.
+'''
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import os
+
+from chroniclepy.chroniclepy.constants import columns, interactions
+
+apps = ['com.whatsapp', 'com.facebook.orca', 'com.android.chrome', 'com.google.android.youtube',
+    'com.twitter.android', 'com.instagram.android', 'com.android.settings', 'com.netflix.mediaclient',
+    'com.spotify.music', 'com.google.android.gm', 'com.snapchat.android', 'com.google.android.apps.maps']
+
+titles = ['', '', '', 'Inbox', 'Home', 'Chat', 'Video']
+
+timezones = ['America/Los_Angeles', 'America/Chicago', 'America/New_York', 'Europe/Brussels', 'Asia/Kolkata']
+
+raw_columns = [columns.raw_record_type, columns.timezone, columns.full_name, columns.title,
+    columns.raw_date_logged, 'study_id']
+
+def format_logged(utc):
+    return utc.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ'%(utc.microsecond // 1000)
+
+def generate_participant(seed, days=14, start=datetime(2019, 3, 3), travel=0.3):
+    '''
+    This function generates the raw data of one participant for a number of days from
+    the start (in UTC).  With probability travel, the participant moves to another
+    timezone halfway.  Returns a dataframe with the columns of a raw Chronicle file.
+    '''
+    rng = np.random.RandomState(seed)
+    zones = [timezones[rng.randint(len(timezones))]]
+    if rng.rand() < travel:
+        zones.append(timezones[rng.randint(len(timezones))])
+    favourites = rng.dirichlet(np.ones(len(apps)) * 0.5)
+    end = start + timedelta(days=days)
+    travelled = start + timedelta(days=days / 2.)
+    events = []
+
+    def add(record_type, time, app, title=''):
+        zone = zones[-1] if time >= travelled else zones[0]
+        events.append((record_type, zone, app, title, time))
+
+    time = start + timedelta(seconds=float(rng.uniform(0, 3600)))
+    while time < end:
+        add(interactions.screen_interactive, time, 'android')
+        for _ in range(1 + rng.poisson(2)):
+            app = apps[rng.choice(len(apps), p=favourites)]
+            title = titles[rng.randint(len(titles))]
+            time += timedelta(seconds=float(rng.exponential(5)))
+            add(interactions.foreground, time, app, title)
+            for _ in range(rng.poisson(1.5)):
+                add(interactions.user_interaction, time + timedelta(seconds=float(rng.exponential(30))), app, title)
+            if rng.rand() < 0.2:
+                notification = [interactions.notification_seen, interactions.notification_interruption][rng.randint(2)]
+                add(notification, time + timedelta(seconds=float(rng.exponential(30))), apps[rng.randint(len(apps))])
+            time += timedelta(seconds=float(rng.exponential(120)), milliseconds=int(rng.randint(1000)))
+            r = rng.rand()
+            if r < 0.05:
+                # the next app is in the foreground before this one is in the background
+                add(interactions.background, time + timedelta(milliseconds=int(rng.randint(1500))), app, title)
+            elif r < 0.08:
+                # never moved to the background
+                pass
+            else:
+                add(interactions.background, time, app, title)
+        time += timedelta(seconds=float(rng.exponential(10)))
+        if rng.rand() < 0.03:
+            add(interactions.power_off, time, 'android')
+        else:
+            add(interactions.screen_non_interactive, time, 'android')
+        # longer breaks at night
+        gap = rng.exponential(900) if rng.rand() < 0.9 else rng.exponential(4 * 3600)
+        time += timedelta(seconds=float(gap), milliseconds=int(rng.randint(1000)))
+
+    data = pd.DataFrame(events, columns=raw_columns[:-2] + ['utc']).sort_values('utc', kind='mergesort').reset_index(drop=True)
+    data[columns.raw_date_logged] = [format_logged(x) for x in data['utc']]
+    data['study_id'] = 'benchmark'
+    # exports have some duplicated events and events without a timezone
+    data = pd.concat([data, data.sample(frac=0.01, random_state=rng)]).sort_index(kind='mergesort')
+    data.loc[data.sample(frac=0.005, random_state=rng).index, columns.timezone] = np.nan
+    return data[raw_columns].reset_index(drop=True)
+
+def generate(folder, participants=10, days=14, seed=0, start=datetime(2019, 3, 3)):
+    '''
+    This function writes one raw file (ChronicleData-<participant>.csv) per participant
+    to the folder.  The same seed gives the same files.  Returns the filenames.
+    '''
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    filenames = []
+    for participant in range(participants):
+        filename = os.path.join(folder, "ChronicleData-participant%03d.csv"%participant)
+        generate_participant(seed * 100003 + participant, days=days, start=start).to_csv(filename, index=False)
+        filenames.append(filename)
+    return filenames
+
+def get_parser():
+    parser = ArgumentParser(description = 'Generate synthetic raw Chronicle files.')
+    parser.add_argument('folder', action='store',
+        help = 'the folder to write the raw files.')
+    parser.add_argument('--participants', action='store', type=int, default=10,
+        help = 'the number of participants (files).')
+    parser.add_argument('--days', action='store', type=int, default=14,
+        help = 'the number of days per participant.')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+        help = 'the seed of the random generator.')
+    return parser
+
+if __name__ == '__main__':
+    opts = get_parser().parse_args()
+    generate(opts.folder, participants=opts.participants, days=opts.days, seed=opts.seed)
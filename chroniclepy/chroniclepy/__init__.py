@@ -1 +1,16 @@
-from . import constants, preprocessing, subsetting, summarise_app_categories, summarise_modalities, summarising, utils
\ No newline at end of file
+__version__ = "1.9"
+
+import importlib
+
+# the modules are imported when they're first used (eg. chroniclepy.preprocessing), so
+# that the command line starts without importing pandas (see cli)
+submodules = ['cli', 'constants', 'dtypes', 'manifest', 'pipeline', 'preprocessing', 'subsetting', 'summarise_app_categories',
+    'summarise_modalities', 'summarise_person', 'summarising', 'utils']
+
+def __getattr__(name):
+    if name in submodules:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
+
+def __dir__():
+    return sorted(list(globals()) + submodules)
@@ -0,0 +1,237 @@
+'''
+The command line of ChroniclePy (the chroniclepy command and run.py).  The stages are only
+imported when they run, so that starting (and --help) doesn't wait for pandas.
+'''
+
+from argparse import ArgumentParser
+import json
+import sys
+
+def get_parser():
+    parser = ArgumentParser(description = 'ChroniclePy: Preprocessing and Summarizing Chronicle data')
+    parser.add_argument('stage', choices=['preprocessing','summary','all'],
+        help = 'processing stage to be run: preprocessing or summary')
+    parser.add_argument('input_dir', action='store',
+        help = 'the folder with data files (csv\'s).')
+    parser.add_argument('preproc_dir', action='store',
+        help = 'the folder to write preprocessed files.')
+    parser.add_argument('subset_dir', action='store',
+        help = 'the folder to write subsetted files (only with --write-intermediates).')
+    parser.add_argument('output_dir', action='store',
+        help = 'the folder to write output files.')
+    parser.add_argument('--workers', action='store', type=int, default=1,
+        help = 'the number of processes to preprocess or summarise files in parallel.')
+    parser.add_argument('--intermediate-format', dest='intermediate_format', action='store',
+        choices=['csv', 'parquet'], default='csv',
+        help = 'the file format for the preprocessed and subsetted files.  Parquet keeps \
+            the timestamps typed, so they don\'t need to be parsed again (requires pyarrow).')
+    parser.add_argument('--force', action='store_true', default=False,
+        help = 'process all files again, also the ones that didn\'t change since the last run.')
+    parser.add_argument('--resume', action='store_true', default=False,
+        help = 'keep a checkpoint with every preprocessed file, and only preprocess the \
+            events that were added to a raw file since the last run.')
+    parser.add_argument('--fused', action='store_true', default=False,
+        help = 'with stage "all": run every participant through all stages in memory, without \
+            writing and reading the preprocessed and subsetted files in between (they\'re only \
+            written with --write-intermediates).  Nothing is reused from earlier runs.')
+    parser.add_argument('--write-intermediates', dest='write_intermediates', action='store_true', default=False,
+        help = 'also write the subsetted files (the summary filters the apps without them), \
+            and with --fused also the preprocessed files.')
+
+    parser.add_argument('--profile', action='store', default=None,
+        help = 'a file to write the profile of every stage per participant (a json line with the \
+            wall and cpu time, the rows in and out and the peak memory).  A table per stage \
+            is printed at the end.  This makes the processing slower.')
+    parser.add_argument('--profile-dir', dest='profile_dir', action='store', default=None,
+        help = 'a folder to write a cProfile dump of every stage (only with --profile).')
+
+    prepargs = parser.add_argument_group('Options for preprocessing the data.')
+    prepargs.add_argument('--precision',action='append',type=int, default = None,
+        help = 'the precision in seconds for the output file (default: 900). This defines the time \
+            unit of the data.  Eg. if the data should be split up by the hour, use 3600.  Can be \
+            given more than once: the usage is extracted once and every precision is written to \
+            a subfolder (precision_<seconds>) of the preprocessed, subsetted and output folders.')
+    prepargs.add_argument('--sessioninterval', action='append', default=['60'],
+        help = 'the interval (in seconds) that define the start of a new session, i.e. \
+            how long should the break be between 2 sessions of phone usages to be considered \
+            a new session.')
+    prepargs.add_argument('--engine', action='store', choices=['loop', 'vectorized'], default='loop',
+        help = 'the engine to extract app usage: "loop" walks over all events, "vectorized" \
+            pairs the events with grouped array operations (same output, faster on large files).')
+    prepargs.add_argument('--chunksize', action='store', type=int, default=None,
+        help = 'read raw files in chunks of this many events, so that the memory used doesn\'t \
+            grow with the size of a file (the events should be sorted by time).')
+    prepargs.add_argument('--intervals', action='store_true', default=False,
+        help = 'write the usage as intervals instead of one row per time unit (precision), \
+            so that the preprocessed files grow with the number of app usages rather than with \
+            the time the apps were used.  The summary splits them up again (same output).  \
+            Not with --resume and --chunksize.')
+    prepargs.add_argument('--batch', action='store', type=int, default=None,
+        help = 'preprocess the raw files this many at once: the events of all participants in \
+            a batch go through every step together and are only split up per participant when \
+            they\'re written (same output as the vectorized engine, faster with many small files).  \
+            Not with --resume, --chunksize and --fused.')
+    prepargs.add_argument('--log_dir', action='store', default=None, 
+        help = 'the folder to write log files.')
+    prepargs.add_argument('--log_options', action='store', default="", 
+        help = 'the options for logging.  Should be a dictionary, eg. {"log_exceed_durations_minutes": [15, 30]}.')
+
+    subargs = parser.add_argument_group('Options for subsetting the data.')
+    subargs.add_argument('--subsetfile',action='store', default=None,
+        help = 'a csv file with one column named "fullname" \
+        with a column with 1/0 coding which apps to include in the summary statistics.  \
+        With more than one 1/0 column, every subset is summarised (in a folder per column).')
+    subargs.add_argument('--removefile',action='store', default=None,
+        help = 'a csv file with one column named "fullname" \
+        to indicate which apps to remove in the summary statistics.')
+
+    summaryargs = parser.add_argument_group('Options for summarising the data.')
+    summaryargs.add_argument('--recodefile',action='store', default=None,
+        help = 'a csv file with one column named "fullname" \
+        with transformations of the apps (eg. category codes, other names,...)')
+    summaryargs.add_argument('--fullapplistfile',action='store', default=None,
+        help = 'a csv file that will be written with all applications \
+        (to prepare/complete the recodefile).')
+    summaryargs.add_argument('--includestartend', action='store_true', default=False,
+        help = 'flag to include the first and last day in the summary table.')
+    summaryargs.add_argument('--quarterly', action='store_true', default=False,
+        help = 'flag to export quarterly summary statistics.')
+    summaryargs.add_argument('--splitweek', action='store_true', default=False,
+        help = 'flag to export summary statistics separately for week and weekend days.')
+    summaryargs.add_argument('--weekdefinition', action='store', default='weekdayMF',
+        help = 'One of "weekdayMF", "weekdayMTh", "weekdaySTh" to distinguish week and weekend\
+        (only when using --splitweek flag)')
+    summaryargs.add_argument('--splitday', action='store_true', default=False,
+        help = 'flag to export summary statistics separately for daytime vs nighttime.')
+    summaryargs.add_argument('--daytime', action='store', default= '10:00',
+        help = 'What time does daytime start?  In 24h format (eg. 10:00)')
+    summaryargs.add_argument('--nighttime', action='store', default= '22:00',
+        help = 'What time does nighttime start?  In 24h format (eg. 22:00)')
+    summaryargs.add_argument('--maxdays', action='store', default=None, type=int,
+        help = "What is the maximum number of days you want to analyze per person?"
+    )
+    return parser
+
+def main():
+    opts = get_parser().parse_args()
+    if isinstance(opts.profile, str):
+        from . import utils
+        utils.start_profiling(opts.profile, opts.profile_dir)
+    try:
+        failed = run(opts)
+    finally:
+        if isinstance(opts.profile, str):
+            utils.stop_profiling()
+            utils.logger("LOG: Profile per stage:\n%s"%utils.profile_summary(opts.profile).to_string(), level=1)
+    # the other files were processed, but a scheduled run should see that some were skipped
+    if failed:
+        sys.exit(1)
+
+def get_precisions(opts):
+    return opts.precision or [900]
+
+def check_summary_options(opts):
+    if max(get_precisions(opts)) > 15*60 and opts.quarterly:
+        raise ValueError("The precision is above a quarter and the minimum precision for summary is by quarter.")
+    if isinstance(opts.weekdefinition,str):
+        if opts.weekdefinition not in ['weekdayMTh', 'weekdaySTh', 'weekdayMF']:
+            raise ValueError("Unknown weekday definition !")
+    if opts.splitweek and not isinstance(opts.weekdefinition,str):
+        raise ValueError("Please specify the weekdefinition if you want !")
+
+def run(opts):
+    '''
+    Runs the stages of the options and returns the raw files that failed.
+    '''
+    # the stages are imported when they're used, so that eg. --help doesn't import pandas
+    from . import preprocessing, subsetting, summarising
+    precisions = get_precisions(opts)
+    failed = []
+
+    if opts.fused:
+        if opts.stage != 'all':
+            raise ValueError("The fused mode runs all stages: use the stage all.")
+        if opts.batch is not None:
+            raise ValueError("The fused mode runs every participant on its own: don't use --batch.")
+        check_summary_options(opts)
+        from . import pipeline
+        subsetted = isinstance(opts.subsetfile,str) or isinstance(opts.removefile,str)
+        return pipeline.run(
+            infolder = opts.input_dir,
+            outfolder = opts.output_dir,
+            precision = precisions,
+            sessioninterval = [int(x) for x in opts.sessioninterval],
+            engine = opts.engine,
+            subsetfile = opts.subsetfile,
+            removefile = opts.removefile,
+            preproc_dir = opts.preproc_dir if opts.write_intermediates else None,
+            subset_dir = opts.subset_dir if opts.write_intermediates and subsetted else None,
+            intermediate_format = opts.intermediate_format,
+            intervals = opts.intervals,
+            recodefile = opts.recodefile,
+            fullapplistfile = opts.fullapplistfile,
+            workers = opts.workers,
+            includestartend = opts.includestartend,
+            quarterly = opts.quarterly,
+            splitweek = opts.splitweek,
+            weekdefinition = opts.weekdefinition,
+            splitday = opts.splitday,
+            daytime = opts.daytime,
+            nighttime = opts.nighttime,
+            maxdays = opts.maxdays
+        )
+
+    if opts.stage=='preprocessing' or opts.stage=='all':
+        if (opts.log_options != "") and not isinstance(opts.log_dir, str):
+            raise ValueError("You specified a logging options, but no directory to write logs.")
+        failed = preprocessing.preprocess_folder(
+            infolder = opts.input_dir,
+            outfolder = opts.preproc_dir,
+            precision = precisions,
+            sessioninterval = [int(x) for x in opts.sessioninterval],
+            engine = opts.engine,
+            workers = opts.workers,
+            intermediate_format = opts.intermediate_format,
+            force = opts.force,
+            resume = opts.resume,
+            chunksize = opts.chunksize,
+            intervals = opts.intervals,
+            batch = opts.batch,
+            logdir = opts.log_dir,
+            logopts = {} if opts.log_options == "" else json.loads(opts.log_options)
+            )
+    
+    # the summary filters the apps itself, the subsetted files are only written when asked
+    if opts.stage == "subsetting" or (opts.stage=="all" and opts.write_intermediates):
+        if (isinstance(opts.subsetfile,str) or isinstance(opts.removefile,str)):
+            for precision in precisions:
+                subsetting.subset(
+                    infolder = preprocessing.get_precision_folder(opts.preproc_dir, precision, precisions),
+                    outfolder = preprocessing.get_precision_folder(opts.subset_dir, precision, precisions),
+                    removefile=opts.removefile, 
+                    subsetfile = opts.subsetfile,
+                    intermediate_format = opts.intermediate_format
+                )
+
+    if opts.stage=='summary' or opts.stage=='all':
+        check_summary_options(opts)
+        for precision in precisions:
+            summarising.summary(
+                infolder = preprocessing.get_precision_folder(opts.preproc_dir, precision, precisions),
+                outfolder = preprocessing.get_precision_folder(opts.output_dir, precision, precisions),
+                subsetfile = opts.subsetfile,
+                removefile = opts.removefile,
+                includestartend = opts.includestartend,
+                recodefile = opts.recodefile,
+                fullapplistfile = opts.fullapplistfile,
+                quarterly = opts.quarterly,
+                splitweek = opts.splitweek,
+                weekdefinition = opts.weekdefinition,
+                splitday = opts.splitday,
+                daytime = opts.daytime,
+                nighttime = opts.nighttime,
+                maxdays = opts.maxdays,
+                workers = opts.workers,
+                force = opts.force
+            )
+    return failed
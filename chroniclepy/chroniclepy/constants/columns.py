@@ -17,3 +17,10 @@ raw_record_type = "app_record_type"
 switch_app = "app_switch_app"
 engage_30s = "app_engage_30s"
 flags = "app_usage_flags"
+
+# preprocessed files with intervals instead of bins (see preprocessing.to_intervals)
+prep_bins = "app_bins"
+prep_interval_end = "app_interval_end_timestamp"
+prep_precision = "app_precision_seconds"
+prep_start_timezone = "app_start_timezone"
+prep_end_timezone = "app_end_timezone"
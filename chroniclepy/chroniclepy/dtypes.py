@@ -0,0 +1,83 @@
+'''
+The dtypes of the data in memory: repeated strings (apps, titles, participants, record
+types, timezones) are categories, calendar columns and flags are small integers and
+durations (in whole seconds) are float32.  Columns with missing values can't be small
+integers, they are float32.
+'''
+
+from .constants import columns
+import pandas as pd
+import re
+
+category_columns = ['participant_id', 'person', columns.full_name, columns.title, columns.timezone,
+    columns.raw_record_type, columns.prep_record_type,
+    'general.fullname', 'app_fullname', 'ol.timezone', 'ol.title']
+
+integer_columns = ['day', 'weekdayMF', 'weekdayMTh', 'weekdaySTh', 'hour', 'quarter', columns.switch_app]
+
+float_columns = [columns.prep_duration_seconds]
+
+# session flags (app_engage_60s), not their durations
+engage_pattern = r'^(app_)?engage_\d+s$'
+
+raw_dtypes = {col: 'category' for col in category_columns}
+
+def is_integer_column(col):
+    return col in integer_columns or re.match(engage_pattern, col) is not None
+
+def compact(data):
+    '''
+    This function applies the dtypes to the columns of a dataframe that have one.
+    Small integers are stored as int8, as float32 when there are missing values.
+    '''
+    for col in data.columns:
+        dtype = data[col].dtype
+        if col in category_columns and not isinstance(dtype, pd.CategoricalDtype):
+            data[col] = data[col].astype('category')
+        elif is_integer_column(col) and dtype.kind in 'biuf':
+            data[col] = data[col].astype('float32' if data[col].isna().any() else 'int8')
+        elif col in float_columns and dtype.kind in 'biuf':
+            data[col] = data[col].astype('float32')
+    return data
+
+def output(data):
+    '''
+    This function returns the dtypes of the written files: small integers are always
+    float32, as in a file with missing values, so that every part of a file written in
+    parts has the same types as when it is written at once (see utils.append_intermediate).
+    Categories that aren't used are removed.
+    '''
+    data = data.copy(deep=False)
+    for col in data.columns:
+        dtype = data[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            data[col] = data[col].cat.remove_unused_categories()
+        elif (is_integer_column(col) or col in float_columns) and dtype.kind in 'biuf':
+            data[col] = data[col].astype('float32')
+    return data
+
+def widen(data, cols):
+    '''
+    This function turns compact numbers back into int64 or float64, eg. to count flags
+    per day (a sum of int8 is an int8, which overflows).
+    '''
+    for col in cols:
+        dtype = data[col].dtype
+        if dtype.kind in 'biu':
+            data[col] = data[col].astype('int64')
+        elif dtype.kind == 'f':
+            data[col] = data[col].astype('float64')
+    return data
+
+def fillna(data, values):
+    '''
+    This function fills missing values by column (a dictionary), also in categorical
+    columns that don't have the value as a category yet.
+    '''
+    for col, value in values.items():
+        if not col in data.columns or value is None:
+            continue
+        if isinstance(data[col].dtype, pd.CategoricalDtype) and not value in data[col].cat.categories:
+            data[col] = data[col].cat.add_categories([value])
+        data[col] = data[col].fillna(value)
+    return data
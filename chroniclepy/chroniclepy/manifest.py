@@ -0,0 +1,95 @@
+from . import __version__
+import hashlib
+import json
+import os
+import pickle
+
+def get_hash(filename):
+    '''
+    This function returns the sha256 hash of the content of a file.
+    '''
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fl:
+        for block in iter(lambda: fl.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def read_manifest(filename):
+    '''
+    This function reads a manifest (a json file with one entry per input file),
+    or returns an empty manifest when there is none (or it can't be read).
+    '''
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename, 'r') as fl:
+            return json.load(fl)
+    except ValueError:
+        return {}
+
+def write_manifest(manifest, filename):
+    '''
+    This function writes a manifest, through a temporary file so that an interrupted
+    run doesn't leave a broken manifest behind.
+    '''
+    with open(filename + '.tmp', 'w') as fl:
+        json.dump(manifest, fl, indent=2, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+def get_entry(filename, parameters, sha256=None):
+    '''
+    This function returns the manifest entry of an input file: its size, modification
+    time and hash, the parameters it was processed with and the package version.
+    '''
+    stat = os.stat(filename)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': get_hash(filename) if sha256 is None else sha256,
+        'parameters': parameters,
+        'version': __version__
+    }
+
+def is_unchanged(entry, filename, parameters):
+    '''
+    This function checks whether an input file and the parameters are the same as in
+    its manifest entry.  The file is only hashed when the size is the same but the
+    modification time is not (eg. a file that was copied again).
+    '''
+    if entry is None or entry.get('version') != __version__:
+        return False
+    if json.loads(json.dumps(parameters)) != entry.get('parameters'):
+        return False
+    stat = os.stat(filename)
+    if stat.st_size != entry.get('size'):
+        return False
+    if stat.st_mtime == entry.get('mtime'):
+        return True
+    return get_hash(filename) == entry.get('sha256')
+
+def read_checkpoint(filename, parameters):
+    '''
+    This function reads a checkpoint (a pickled dictionary), or returns None when there is
+    none or when it was written with other parameters or another version of the package.
+    '''
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as fl:
+            checkpoint = pickle.load(fl)
+    except Exception:
+        return None
+    if checkpoint.get('version') != __version__ or checkpoint.get('parameters') != json.loads(json.dumps(parameters)):
+        return None
+    return checkpoint
+
+def write_checkpoint(checkpoint, filename, parameters):
+    '''
+    This function writes a checkpoint with the parameters and the package version,
+    through a temporary file (see write_manifest).
+    '''
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    checkpoint = dict(checkpoint, parameters=json.loads(json.dumps(parameters)), version=__version__)
+    with open(filename + '.tmp', 'wb') as fl:
+        pickle.dump(checkpoint, fl)
+    os.replace(filename + '.tmp', filename)
@@ -0,0 +1,93 @@
+from . import utils, preprocessing, subsetting, summarising
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+
+def process_file(filename, infolder, precisions=[3600], sessioninterval=[5*60], engine='loop',
+    filters={}, preproc_dir=None, subset_dir=None, intermediate_format='csv', intervals=False, **kwargs):
+    '''
+    This function runs a raw file through all stages in memory: preprocessing at every
+    precision (the usage is extracted once, see preprocessing.preprocess_precisions), the app
+    filters (see subsetting.read_filters) and the summary of the person (see
+    summarising.summarise_filtered, with the other arguments).  The preprocessed and
+    subsetted data are only written with a preproc_dir or subset_dir (in a subfolder per
+    precision with more than one, see preprocessing.get_precision_folder), as intervals
+    with intervals (see preprocessing.to_intervals).  Returns the
+    summaries of the person by precision (None when there's no usage), or the filename when
+    the file could not be processed (the error is logged, see preprocessing.preprocess_file).
+    '''
+    utils.set_logtag(preprocessing.get_personid(filename))
+    try:
+        utils.logger("LOG: Processing file %s..."%filename,level=1)
+        dataframe = preprocessing.read_data(os.path.join(infolder,filename))
+        preprocessed = preprocessing.preprocess_precisions(dataframe, precisions, sessioninterval=sessioninterval, engine=engine)
+        outfilename = filename.replace('ChronicleData','ChronicleData_preprocessed')
+        results = {}
+        for precision, data in preprocessed.items():
+            if data is None:
+                results[precision] = None
+                continue
+            written = preprocessing.to_intervals(data, precision) if intervals and (preproc_dir is not None or subset_dir is not None) else data
+            if preproc_dir is not None:
+                folder = preprocessing.get_precision_folder(preproc_dir, precision, precisions)
+                utils.write_intermediate(written, os.path.join(folder, outfilename), intermediate_format)
+            if subset_dir is not None:
+                folder = preprocessing.get_precision_folder(subset_dir, precision, precisions)
+                for name, appfilter in filters.items():
+                    utils.write_intermediate(subsetting.filter_apps(written, appfilter), os.path.join(subsetting.get_folder(folder, name, filters),
+                        outfilename.replace('ChronicleData_preprocessed','ChronicleData_subsetted')), intermediate_format)
+            results[precision] = summarising.summarise_filtered(data, outfilename, filters, **kwargs)
+        return results
+    except Exception as e:
+        utils.logger("ERROR: Could not process file %s: %s: %s"%(filename, type(e).__name__, e))
+        return filename
+    finally:
+        utils.set_logtag(None)
+
+def run(infolder, outfolder, precision=3600, sessioninterval=[5*60], engine='loop',
+    subsetfile=None, removefile=None, preproc_dir=None, subset_dir=None, intermediate_format='csv', intervals=False,
+    recodefile=None, fullapplistfile=None, workers=1, **kwargs):
+    '''
+    This function preprocesses, subsets and summarises all raw files in a folder in one go:
+    every participant goes through all stages in memory (see process_file), without writing
+    and reading the preprocessed and subsetted files in between (they're only written with
+    a preproc_dir or subset_dir).  The summary is the same as running the stages one by one,
+    but nothing is reused from earlier runs.  With a list of precisions, the summary at every
+    precision is written to a subfolder of the outfolder (see preprocessing.get_precision_folder).
+    Returns the files that could not be processed.
+    '''
+    if workers < 1:
+        raise ValueError("The number of workers should be at least 1.")
+    precisions = list(precision) if isinstance(precision, (list, tuple)) else [precision]
+    filters = subsetting.read_filters(subsetfile, removefile)
+    if len(filters) == 0:
+        subset_dir = None
+    folders = []
+    for prec in precisions:
+        folders += [preprocessing.get_precision_folder(x, prec, precisions) for x in [preproc_dir, outfolder] if x is not None]
+        if subset_dir is not None:
+            folders += [subsetting.get_folder(preprocessing.get_precision_folder(subset_dir, prec, precisions), x, filters) for x in filters]
+    for folder in folders:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    # sorted, so that the summary has the persons in the same order as summarising.summary
+    files = sorted([x for x in os.listdir(infolder) if x.startswith("Chronicle")])
+    recode = utils.read_recode(recodefile) if isinstance(recodefile,str) else None
+    process = partial(process_file, infolder=infolder, precisions=precisions, sessioninterval=sessioninterval,
+        engine=engine, filters=filters, preproc_dir=preproc_dir, subset_dir=subset_dir,
+        intermediate_format=intermediate_format, intervals=intervals, recode=recode, **kwargs)
+    if workers == 1 or len(files) <= 1:
+        results = [process(filename) for filename in files]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+            results = list(executor.map(process, files))
+
+    failed = [x for x in results if isinstance(x, str)]
+    if len(failed) > 0:
+        utils.logger("WARNING: %i files could not be processed: %s"%(len(failed), ", ".join(failed)))
+    for prec in precisions:
+        summarising.write_summaries([x[prec] for x in results if isinstance(x, dict) and x[prec] is not None],
+            preprocessing.get_precision_folder(outfolder, prec, precisions), filters,
+            recode=recode, fullapplistfile=fullapplistfile)
+    return failed
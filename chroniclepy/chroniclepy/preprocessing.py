@@ -1,28 +1,103 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
 from dateutil import parser
 from pytz import timezone
 import pandas as pd
 import numpy as np
+import copy
+import itertools
 import os
 import time
 
 from .constants import interactions, columns
-from . import utils
+from . import dtypes, manifest, utils
 
-def read_data(filenm):
-    personid = "-".join(str(filenm).split(".")[-2].split("ChronicleData-")[1:])
-    thisdata = pd.read_csv(filenm)
+def get_personid(filenm):
+    return "-".join(str(filenm).split(".")[-2].split("ChronicleData-")[1:])
+
+# the columns of a raw file that are used (with their names in older files)
+raw_columns = [columns.raw_record_type, columns.raw_date_logged, columns.full_name, columns.timezone, columns.title,
+    'general.fullname', 'app_fullname', 'ol.timezone', 'ol.title']
+
+@utils.profiled('read_data')
+def read_data(filenm, chunksize=None):
+    '''
+    This function reads a raw file, with only the columns that are used (the strings as
+    categories, see dtypes).  With chunksize, an iterator over chunks of that many events
+    is returned.
+    '''
+    personid = get_personid(filenm)
+    kwargs = dict(usecols=lambda x: x in raw_columns, dtype=dtypes.raw_dtypes)
+    if chunksize is not None:
+        chunks = pd.read_csv(filenm, chunksize=chunksize, **kwargs)
+        return (chunk.assign(person=personid) for chunk in chunks)
+    thisdata = pd.read_csv(filenm, **kwargs)
     thisdata['person'] = personid
     return thisdata
-    
 
-def clean_data(thisdata):
+
+def add_missing_columns(thisdata):
+    '''
+    This function adds the timezone (UTC) and title (empty) to raw data without them.
+    '''
+    if not columns.timezone in thisdata.keys() or any(thisdata[columns.timezone]==None):
+        utils.logger("WARNING: Record has no timezone information.  Registering reported time.")
+        thisdata[columns.timezone] = "UTC"
+    if not columns.title in thisdata.columns:
+        thisdata[columns.title] = ""
+    return thisdata
+
+def fill_by_person(data, cols, method='ffill'):
+    '''
+    This function fills the missing values in the columns by the preceding (ffill) or
+    next (bfill) value of the same person, with the rows sorted by person.
+    '''
+    rows = np.arange(len(data))
+    persons = pd.factorize(data['person'])[0]
+    for col in cols:
+        valid = data[col].notna().values
+        if valid.all():
+            continue
+        if method == 'ffill':
+            source = np.maximum.accumulate(np.where(valid, rows, 0))
+        else:
+            source = np.minimum.accumulate(np.where(valid, rows, len(data) - 1)[::-1])[::-1]
+        data[col] = data[col].take(source).where(persons[source] == persons).values
+    return data
+
+def read_cohort(filenames, infolder):
+    '''
+    This function reads the raw files of many persons into one dataframe, keyed by person
+    (see read_data).  Files that can't be read are logged and left out.  Returns the
+    dataframe (None when no file could be read) and the files that could not be read.
+    '''
+    frames, failed = [], []
+    for filename in filenames:
+        try:
+            # the columns are renamed and completed per file, as they can differ between files
+            thisdata = utils.backwards_compatibility(read_data(os.path.join(infolder,filename)))
+            missing = [x for x in [columns.raw_record_type, columns.raw_date_logged] if not x in thisdata.columns]
+            if len(missing) > 0:
+                raise KeyError(missing)
+            frames.append(add_missing_columns(thisdata))
+        except Exception as e:
+            utils.logger("ERROR: Could not preprocess file %s: %s: %s"%(filename, type(e).__name__, e))
+            failed.append(filename)
+    if len(frames) == 0:
+        return None, failed
+    return dtypes.compact(pd.concat(frames, ignore_index=True)), failed
+
+@utils.profiled('clean_data')
+def clean_data(thisdata, previous=None):
     '''
     This function transforms a csv file into a clean dataset:
     - only move-to-foreground and move-to-background actions
     - extracts person ID
     - extracts datetime information and rounds to 10ms
     - sorts events from the same 10ms by (1) foreground, (2) background
+    Missing apps and timezones are filled by the preceding event, at the start by
+    previous (the last values of the events before, see get_fill_values).  The events
+    of several persons (see read_cohort) are sorted and filled per person.
     '''
     utils.logger("Cleaning data", level = 1)
     thisdata = thisdata.dropna(subset=[columns.raw_record_type, columns.raw_date_logged])
@@ -30,108 +105,164 @@ def clean_data(thisdata):
     if len(thisdata)==0:
         return(thisdata)
     thisdata = thisdata[thisdata[columns.raw_record_type] != 'Usage Stat']
-    if not columns.timezone in thisdata.keys() or any(thisdata[columns.timezone]==None):
-        utils.logger("WARNING: Record has no timezone information.  Registering reported time.")
-        thisdata[columns.timezone] = "UTC"
-    if not columns.title in thisdata.columns:
-        thisdata[columns.title] = ""
-    thisdata[columns.title] = thisdata[columns.title].fillna("")
+    thisdata = add_missing_columns(thisdata)
+    thisdata = dtypes.fillna(thisdata, {columns.title: ""})
     thisdata = thisdata[[columns.title, columns.full_name, columns.raw_record_type, columns.raw_date_logged, 'person', columns.timezone]]
-    # fill timezone by preceding timezone and then backwards
-    thisdata = thisdata.sort_values(by=[columns.raw_date_logged]).reset_index(drop=True).fillna(method="ffill").fillna(method="bfill")
-    thisdata['dt_logged'] = thisdata.apply(utils.get_dt,axis=1)
-    thisdata['action'] = thisdata.apply(utils.get_action,axis=1)
-    thisdata = thisdata.sort_values(by=['dt_logged', 'action']).reset_index(drop=True)
+    # fill timezone by preceding timezone and then backwards (of the same person, see read_cohort)
+    thisdata = thisdata.sort_values(by=['person', columns.raw_date_logged], kind='mergesort').reset_index(drop=True)
+    thisdata = fill_by_person(thisdata, [columns.full_name, columns.timezone], method='ffill')
+    if previous is not None:
+        thisdata = dtypes.fillna(thisdata, previous)
+    thisdata = fill_by_person(thisdata, [columns.full_name, columns.timezone], method='bfill')
+    try:
+        thisdata['dt_logged'] = utils.get_dt_vectorized(thisdata[columns.raw_date_logged], thisdata[columns.timezone])
+    except ValueError:
+        utils.logger("WARNING: Could not parse all timestamps at once.  Parsing one by one...")
+        thisdata['dt_logged'] = thisdata.apply(utils.get_dt,axis=1)
+    thisdata['action'] = utils.get_action(thisdata[columns.raw_record_type])
+    thisdata = thisdata.sort_values(by=['person', 'dt_logged', 'action']).reset_index(drop=True)
 
     return thisdata.drop(['action'],axis=1)
 
-def get_timestamps(curtime, prevtime=False, row=None, precision=60):
+def get_fill_values(thisdata, previous=None):
+    '''
+    This function returns the values that clean_data fills forward from the last event of
+    a raw dataset (the last app and timezone), to clean the events after it separately.
+    Values that are missing in the dataset are taken from previous.
+    '''
+    thisdata = thisdata.dropna(subset=[columns.raw_record_type, columns.raw_date_logged])
+    thisdata = thisdata[thisdata[columns.raw_record_type] != 'Usage Stat']
+    thisdata = thisdata.sort_values(by=[columns.raw_date_logged], kind='mergesort')
+    values = {}
+    for col in [columns.full_name, columns.timezone]:
+        if col in thisdata.columns:
+            known = thisdata[col].dropna()
+            values[col] = known.iloc[-1] if len(known) > 0 else None
+    if previous is not None:
+        values = {k: previous.get(k) if v is None else v for k,v in values.items()}
+    return values
+
+def get_usage(row, starttime, endtime=None, record_type=None):
+    '''
+    Function to register an app usage (or an interaction when there's no endtime).
+    The participant, app and title are taken from the row that ends the usage.
     '''
-    Function transforms an app usage statistic into bins (according to the desired precision).
-    Returns a dataframe with the number of rows the number of time units (= precision).
+    return {
+        columns.prep_datetime_start: starttime,
+        columns.prep_datetime_end: endtime,
+        "participant_id": row['person'],
+        columns.full_name: row[columns.full_name],
+        columns.title: row[columns.title],
+        columns.prep_record_type: record_type
+    }
+
+def get_bin_columns(binstarts, binends, localstart, localend):
+    '''
+    This function returns the columns of bins (see bin_intervals) from their start and end,
+    in nanoseconds since epoch and on the local clock: the date, times, weekday, hour and
+    quarter (on the local clock of the start) and the duration.
+    '''
+    weekday = (localstart // utils.NS_DAY + 3) % 7
+    return {
+        "date": utils.format_date(localstart),
+        "starttime": utils.format_time(localstart),
+        "endtime": utils.format_time(localend),
+        "day": (weekday + 1) % 7 + 1,
+        "weekdayMF": (weekday < 5).astype('int64'),
+        "weekdayMTh": (weekday < 4).astype('int64'),
+        "weekdaySTh": ((weekday < 4) | (weekday == 6)).astype('int64'),
+        "hour": (localstart % utils.NS_DAY) // utils.NS_HOUR,
+        "quarter": (localstart % utils.NS_HOUR) // (15 * utils.NS_MINUTE) + 1,
+        columns.prep_duration_seconds: np.round((binends - binstarts) / utils.NS_SECOND)
+    }
+
+def bin_intervals(usage, precision=60):
+    '''
+    Function transforms app usage intervals into bins (according to the desired precision).
+    All intervals are split at once: returns a dataframe with one row per time unit (= precision)
+    per interval, in the order of the intervals.  Intervals without an end (interactions)
+    get a single row without duration.
     Precision in seconds.
     '''
-    if not prevtime:
-        starttime = curtime
-        outtime = [{
-            columns.prep_datetime_start: starttime,
-            columns.prep_datetime_end: np.NaN,
-            "date": starttime.strftime("%Y-%m-%d"),
-            "starttime": starttime.strftime("%H:%M:%S.%f"),
-            "endtime": np.NaN,
-            columns.prep_duration_seconds: np.NaN,
-            columns.prep_record_type: np.NaN,
-            "participant_id": row['person'],
-            columns.full_name: row[columns.full_name],
-            columns.title: row[columns.title]
-        }]
-
-        return pd.DataFrame(outtime)
-
-    #round down to precision
-
-    prevtimehour = prevtime.replace(microsecond=0,second=0,minute=0)
-    seconds_since_prevtimehour = np.floor((prevtime-prevtimehour).seconds/precision)*precision
-    prevtimerounded = prevtimehour+timedelta(seconds=seconds_since_prevtimehour)
+    point = usage[columns.prep_datetime_end].isna().values
+    meta = ["participant_id", columns.full_name, columns.title, columns.prep_record_type]
+
+    intervals = usage[~point].reset_index(drop=True)
+    starttz = utils.get_timezones(intervals[columns.prep_datetime_start])
+    endtz = utils.get_timezones(intervals[columns.prep_datetime_end])
+    starts = utils.get_utc_ns(intervals[columns.prep_datetime_start])
+    ends = utils.get_utc_ns(intervals[columns.prep_datetime_end])
+
+    # round down to precision (on the local clock, relative to the start of the hour)
+    since_hour = utils.get_local_ns(starts, starttz) % utils.NS_HOUR
+    seconds_since_hour = since_hour // utils.NS_SECOND
+    rounded = starts - since_hour + (np.floor(seconds_since_hour / precision) * precision * utils.NS_SECOND).astype('int64')
 
     # number of timepoints on precision scale (= new rows )
-    timedif = (curtime-prevtimerounded)
-    timepoints_n = int(np.floor(timedif.seconds/precision)+int(timedif.days*24*60*60/precision))
-
-    # run over timepoints and append datetimestamps
-    delta = timedelta(seconds=0)
-    outtime = []
-
-    for timepoint in range(timepoints_n+1):
-        starttime = prevtime if timepoint == 0 else prevtimerounded+delta
-        endtime = curtime if timepoint == timepoints_n else prevtimerounded+delta+timedelta(seconds=precision)
-
-        outmetrics = {
-            columns.prep_datetime_start: starttime,
-            columns.prep_datetime_end: endtime,
-            "date": starttime.strftime("%Y-%m-%d"),
-            "starttime": starttime.strftime("%H:%M:%S.%f"),
-            "endtime": endtime.strftime("%H:%M:%S.%f"),
-            "day": (starttime.weekday()+1)%7+1,
-            "weekdayMF": 1 if starttime.weekday() < 5 else 0,
-            "weekdayMTh": 1 if starttime.weekday() < 4 else 0,
-            "weekdaySTh": 1 if (starttime.weekday() < 4 or starttime.weekday()==6) else 0,
-            "hour": starttime.hour,
-            "quarter": int(np.floor(starttime.minute/15.))+1,
-            columns.prep_duration_seconds: np.round((endtime - starttime).total_seconds())
-        }
+    timedif = ends - rounded
+    timedif_days = timedif // utils.NS_DAY
+    timedif_seconds = (timedif % utils.NS_DAY) // utils.NS_SECOND
+    timepoints_n = (np.floor(timedif_seconds / precision) + np.trunc(timedif_days * 24 * 60 * 60 / precision)).astype('int64')
+
+    # expand all intervals to their timepoints
+    interval = np.repeat(np.arange(len(intervals)), timepoints_n + 1)
+    timepoint = np.arange(len(interval)) - np.repeat(np.cumsum(timepoints_n + 1) - (timepoints_n + 1), timepoints_n + 1)
+    last = timepoint == timepoints_n[interval]
+    step = int(round(precision * utils.NS_SECOND))
+    binstarts = np.where(timepoint == 0, starts[interval], rounded[interval] + timepoint * step)
+    binends = np.where(last, ends[interval], rounded[interval] + (timepoint + 1) * step)
+    binstarttz = starttz[interval]
+    binendtz = np.where(last, endtz[interval], starttz[interval])
+
+    binned = pd.DataFrame({
+        columns.prep_datetime_start: utils.to_timestamps(binstarts, binstarttz),
+        columns.prep_datetime_end: utils.to_timestamps(binends, binendtz),
+        **get_bin_columns(binstarts, binends, utils.get_local_ns(binstarts, binstarttz), utils.get_local_ns(binends, binendtz))
+    })
+    for col in meta:
+        binned[col] = intervals[col].values[interval]
 
-        outmetrics['participant_id'] = row['person']
-        outmetrics[columns.full_name] = row[columns.full_name]
-        outmetrics[columns.title] = row[columns.title]
+    points = usage[point].reset_index(drop=True)
+    pointtz = utils.get_timezones(points[columns.prep_datetime_start])
+    pointstarts = utils.get_utc_ns(points[columns.prep_datetime_start])
+    localpoint = utils.get_local_ns(pointstarts, pointtz)
+    points = pd.DataFrame({
+        columns.prep_datetime_start: utils.to_timestamps(pointstarts, pointtz),
+        columns.prep_datetime_end: np.NaN,
+        "date": utils.format_date(localpoint),
+        "starttime": utils.format_time(localpoint),
+        "endtime": np.NaN,
+        columns.prep_duration_seconds: np.NaN,
+        **{col: points[col].values for col in meta}
+    })
 
-        delta = delta+timedelta(seconds=precision)
-        outtime.append(outmetrics)
+    return pd.concat([x for x in [binned, points] if len(x) > 0] or [binned], ignore_index=True)
 
-    return pd.DataFrame(outtime)
+preprocessed_columns = ['participant_id',
+    columns.full_name,
+    columns.title,
+    'date',
+    columns.prep_datetime_start,
+    columns.prep_datetime_end,
+    'starttime',
+    'endtime',
+    'day',  # note: starts on Sunday !
+    'weekdayMF',
+    'weekdayMTh',
+    'weekdaySTh',
+    'hour',
+    'quarter',
+    columns.prep_duration_seconds,
+    columns.prep_record_type]
 
-def extract_usage(dataframe,precision=3600):
+def get_usages(rawdata, state=None):
     '''
-    function to extract usage from a filename.  Precision in seconds.
+    function to walk over all events of a cleaned dataset (see clean_data) and register
+    the app usages and interactions.  Returns the usages and the state at the end (the
+    open apps and the latest unbackgrounded app).  Passing this state continues the
+    extraction with the events that come after.
     '''
 
-    cols = ['participant_id',
-            columns.full_name,
-            columns.title,
-            'date',
-            columns.prep_datetime_start,
-            columns.prep_datetime_end,
-            'starttime',
-            'endtime',
-            'day',  # note: starts on Sunday !
-            'weekdayMF',
-            'weekdayMTh',
-            'weekdaySTh',
-            'hour',
-            'quarter',
-            columns.prep_duration_seconds,
-            columns.prep_record_type]
-
     other_interactions = {
         interactions.screen_non_interactive : "Screen Non-interactive",
         interactions.screen_interactive: "Screen Interactive",
@@ -140,9 +271,8 @@ def extract_usage(dataframe,precision=3600):
     }
 
     alldata = []
-    rawdata = clean_data(dataframe)
-    openapps = {}
-    latest_unbackgrounded = False
+    openapps = {} if state is None else copy.deepcopy(state['openapps'])
+    latest_unbackgrounded = False if state is None else copy.deepcopy(state['latest_unbackgrounded'])
 
     for idx, row in rawdata.iterrows():
         
@@ -181,11 +311,7 @@ def extract_usage(dataframe,precision=3600):
                 
                 if timediff < timedelta(seconds=1):
 
-                    timepoints = get_timestamps(curtime, latest_unbackgrounded['unbgd_time'], precision=precision, row=row)
-
-                    timepoints[columns.prep_record_type] = 'App Usage'
-
-                    alldata.append(timepoints)
+                    alldata.append(get_usage(row, latest_unbackgrounded['unbgd_time'], curtime, 'App Usage'))
 
                     openapps[app]['open'] = False
 
@@ -199,12 +325,7 @@ def extract_usage(dataframe,precision=3600):
                 if curtime-prevtime<timedelta(0):
                     raise ValueError("ALARM ALARM: timepoints out of order !!")
 
-                # split up timepoints by precision
-                timepoints = get_timestamps(curtime,prevtime,precision=precision,row=row)
-
-                timepoints[columns.prep_record_type] = 'App Usage'
-
-                alldata.append(timepoints)
+                alldata.append(get_usage(row, prevtime, curtime, 'App Usage'))
                 
                 openapps[app]['open'] = False
 
@@ -220,74 +341,350 @@ def extract_usage(dataframe,precision=3600):
                     if curtime-prevtime<timedelta(0):
                         raise ValueError("ALARM ALARM: timepoints out of order !!")
                     
-                    # split up timepoints by precision
-                    timepoints = get_timestamps(curtime,prevtime,precision=precision,row=row)
-                    
-                    timepoints[columns.prep_record_type] = 'Power Off'
-
-                    alldata.append(timepoints)
+                    alldata.append(get_usage(row, prevtime, curtime, 'Power Off'))
                     
                     openapps[app] = {'open': False}
         
         # if the interaction is a part of screen non/interactive or notifications...
         # logic should be the same
         if interaction in other_interactions.keys():
-            timepoints = get_timestamps(curtime, precision=precision, row=row)
-            timepoints[columns.prep_record_type] = other_interactions[interaction]
-            alldata.append(timepoints)
+            alldata.append(get_usage(row, curtime, record_type = other_interactions[interaction]))
+
+    return alldata, {'openapps': openapps, 'latest_unbackgrounded': latest_unbackgrounded}
+
+@utils.profiled('bin_usages')
+def bin_usages(usage, precision=3600):
+    '''
+    function to split up the usage intervals (see get_usage_intervals) by precision,
+    sorted by participant and time.  The intervals aren't changed, so that they can be binned again
+    at another precision.  Returns None when there are no usages.
+    '''
+    if usage is not None and len(usage)>0:
+        # split up timepoints by precision
+        alldata = bin_intervals(usage, precision=precision)
+        alldata = alldata.sort_values(by=['participant_id', columns.prep_datetime_start, columns.prep_datetime_end]).reset_index(drop=True)
+        cols_to_select = [x for x in preprocessed_columns if x in alldata.columns]
+        return dtypes.compact(alldata[cols_to_select].reset_index(drop=True))
+
+def get_usage_intervals(dataframe, state=None):
+    '''
+    function to extract the usage intervals (and interactions) from a raw dataset, before
+    they're split up by precision (see bin_usages).  Returns the intervals (None when
+    there are none) and the state at the end, with the values to fill the next events
+    with (see get_usages and get_fill_values).
+    '''
+    previous = None if state is None else state['fill']
+    rawdata = clean_data(dataframe, previous=previous)
+    alldata, state = get_usages(rawdata, state)
+    state['fill'] = get_fill_values(dataframe, previous=previous)
+    return (pd.DataFrame(alldata) if len(alldata)>0 else None), state
+
+@utils.profiled('extract_usage')
+def extract_usage(dataframe,precision=3600,state=None,return_state=False):
+    '''
+    function to extract usage from a filename.  Precision in seconds.
+    With return_state, the state at the end is returned as well (see get_usages),
+    with the values to fill the next events with (see get_fill_values).  Passing this
+    state continues the extraction with the events that come after.
+    '''
+    usage, state = get_usage_intervals(dataframe, state)
+    alldata = bin_usages(usage, precision=precision)
+    if return_state:
+        return alldata, state
+    return alldata
+
+def next_occurrence(positions, keys, querypositions, querykeys, default):
+    '''
+    For every query, find the first position (strictly after the query position)
+    with the same key.  Returns default when there is no such position.
+    '''
+    if len(positions) == 0:
+        return np.full(len(querypositions), default)
+    stride = default + 1
+    combined = keys * stride + positions
+    order = np.argsort(combined, kind='mergesort')
+    combined = combined[order]
+    found = np.searchsorted(combined, querykeys * stride + querypositions, side='right')
+    inrange = found < len(combined)
+    found = np.minimum(found, len(combined) - 1)
+    match = inrange & (combined[found] // stride == querykeys)
+    return np.where(match, positions[order][found], default)
+
+def get_state_events(state):
+    '''
+    This function returns the events that bring extract_intervals in a state (see get_usages):
+    the moments the latest unbackgrounded app was discarded and opened (as events without
+    record type) and the open apps moved to the foreground, in order of first appearance.
+    '''
+    events = []
+    latest = state['latest_unbackgrounded']
+    if latest:
+        events.append((None, latest['fg_time'], latest['unbgd_app']))
+        events.append((None, latest['unbgd_time'], latest['unbgd_app']))
+    for app, appdata in state['openapps'].items():
+        if appdata['open']:
+            events.append((interactions.foreground, appdata['time'], app))
+    return pd.DataFrame(events, columns=[columns.raw_record_type, 'dt_logged', columns.full_name])
+
+def extract_intervals(rawdata, state=None, groups=None):
+    '''
+    Vectorized version of the foreground/background state machine in extract_usage.
+    Pairs the events of a cleaned dataset (see clean_data) and returns a dataframe
+    with one row per usage interval or interaction:
+    - start_row: row in rawdata where the usage started
+    - end_row: row in rawdata that closed the usage (metadata is taken from this row)
+    - record type of the usage
+    Usage is closed by (1) moving the app to the background, (2) a power off, or
+    (3) discarded when another app is moved to the foreground, unless the discarded app
+    is moved to the background within 1 second (the latest unbackgrounded app).
+    Rows are in the order the loop in extract_usage would have emitted them.
+    Also returns the state of the loop at the end (see get_usages).  To start from a
+    state, rawdata starts with its events (see get_state_events).  With groups (a
+    number per row, eg. the person, with the rows sorted by group), the events of every
+    group are paired separately, as if they were extracted one group at a time.
+    '''
+    order = {} if state is None else {app: i for i, app in enumerate(state['openapps'])}
+    latest_state = False if state is None else state['latest_unbackgrounded']
+    nrows = len(rawdata)
+    rowids = np.arange(nrows)
+    times = pd.to_datetime(rawdata['dt_logged'], utc=True).values.view('int64')
+    apps, appnames = pd.factorize(rawdata[columns.full_name])
+    interaction = rawdata[columns.raw_record_type].values
+
+    is_fg = interaction == interactions.foreground
+    is_bg = interaction == interactions.background
+    is_po = interaction == interactions.power_off
+    fg_rows, bg_rows, po_rows = rowids[is_fg], rowids[is_bg], rowids[is_po]
+    fg_order = times[is_fg]
+    if groups is not None:
+        # every app of every group is a separate app, and the events of a group don't close
+        # the apps of the group before (the foreground events are ranked by group and time)
+        groups = np.asarray(groups, dtype='int64')
+        apps, pairs = pd.factorize(groups * (len(appnames) + 1) + apps + 1)
+        appnames = appnames.take(pairs % (len(appnames) + 1) - 1)
+        group_end = np.searchsorted(groups, groups, side='right')
+        fg_order = np.cumsum(np.append(0, (np.diff(fg_order) != 0) | (np.diff(groups[is_fg]) != 0)))
+    fg_apps = apps[is_fg]
 
-    alldata = pd.concat(alldata, axis = 0)
-    if len(alldata)>0:
-        alldata = alldata.sort_values(by=[columns.prep_datetime_start, columns.prep_datetime_end]).reset_index(drop=True)
-        cols_to_select = list(set(cols).intersection(set(alldata.columns)))
-        return alldata[cols_to_select].reset_index(drop=True)
+    # an app that is moved to the foreground stays open until the first of:
+    # - it is moved to the background
+    # - the phone is powered off
+    # - any app is moved to the foreground at a later time (or the app itself again)
+    next_bg = next_occurrence(bg_rows, apps[is_bg], fg_rows, fg_apps, nrows)
+    next_po = np.append(po_rows, nrows)[np.searchsorted(po_rows, fg_rows, side='right')]
+    next_fg = np.append(fg_rows, nrows)[np.searchsorted(fg_order, fg_order, side='right')]
+    if groups is not None:
+        next_po = np.where(next_po < group_end[fg_rows], next_po, nrows)
+        next_fg = np.where(next_fg < group_end[fg_rows], next_fg, nrows)
+    next_same = next_occurrence(fg_rows, fg_apps, fg_rows, fg_apps, nrows)
+    closed_by = np.minimum.reduce([next_bg, next_po, next_fg, next_same])
 
+    # apps discarded by another app moving to the foreground
+    # (the loop keeps the last discarded app in order of first appearance, apps of the state first)
+    discarded = (closed_by == next_fg) & (closed_by < nrows) & (closed_by != next_same)
+    firstseen = pd.Series(fg_rows).groupby(fg_apps).transform('min').values + len(order)
+    known = pd.Series(appnames[fg_apps]).map(order)
+    firstseen = np.where(known.notna(), known.fillna(0).astype('int64'), firstseen)
+    latest = pd.DataFrame({
+        'row': closed_by[discarded],
+        'app': fg_apps[discarded],
+        'firstseen': firstseen[discarded],
+        'start_row': fg_rows[discarded]
+    })
+    if latest_state:
+        # the first two events are the discard and start of the latest unbackgrounded app
+        latest = pd.concat([pd.DataFrame({
+            'row': [0],
+            'app': [apps[0]],
+            'firstseen': [order.get(latest_state['unbgd_app'], 0)],
+            'start_row': [1]
+        }), latest], ignore_index=True)
+    latest = latest.sort_values(['row', 'firstseen'], kind='mergesort').drop_duplicates('row', keep='last')
+
+    # an unbackgrounded app that's moved to the background within 1 second after the
+    # next app was moved to the foreground is closed on that moment
+    unbgd_bg = next_occurrence(bg_rows, apps[is_bg], latest['row'].values, latest['app'].values, nrows)
+    next_latest = np.append(latest['row'].values, nrows)[1:]
+    fg_time = times[latest['row'].values]
+    bg_time = times[np.minimum(unbgd_bg, nrows - 1)]
+    rescued = (unbgd_bg < next_latest) & (bg_time - fg_time < 10**9)
+    rescues = pd.DataFrame({
+        'start_row': latest['start_row'].values[rescued],
+        'end_row': unbgd_bg[rescued],
+        columns.prep_record_type: 'App Usage'
+    })
+
+    backgrounded = (closed_by == next_bg) & (closed_by < nrows) & ~np.isin(next_bg, rescues['end_row'].values)
+    usage = pd.DataFrame({
+        'start_row': fg_rows[backgrounded],
+        'end_row': closed_by[backgrounded],
+        columns.prep_record_type: 'App Usage'
+    })
+
+    poweredoff = (closed_by == next_po) & (closed_by < nrows)
+    poweroff = pd.DataFrame({
+        'start_row': fg_rows[poweredoff],
+        'end_row': closed_by[poweredoff],
+        columns.prep_record_type: 'Power Off',
+        'firstseen': firstseen[poweredoff]
+    })
+
+    other_interactions = {
+        interactions.screen_non_interactive : "Screen Non-interactive",
+        interactions.screen_interactive: "Screen Interactive",
+        interactions.notification_seen: "Notification Seen",
+        interactions.notification_interruption: "Notification Interruption"
+    }
+    is_other = np.isin(interaction, list(other_interactions.keys()))
+    other = pd.DataFrame({
+        'start_row': rowids[is_other],
+        'end_row': rowids[is_other],
+        columns.prep_record_type: [other_interactions[x] for x in interaction[is_other]]
+    })
+
+    # a power off closes all open apps in order of first appearance
+    intervals = pd.concat([rescues, usage, poweroff, other], ignore_index=True).fillna({'firstseen': 0})
+    intervals = intervals.sort_values(['end_row', 'firstseen'], kind='mergesort').reset_index(drop=True)
+
+    # state at the end: all apps in order of first appearance, open when nothing closed them
+    openapps = {app: {'open': False} for app in order}
+    for app in fg_apps[np.unique(firstseen, return_index=True)[1]]:
+        openapps[appnames[app]] = {'open': False}
+    for row in fg_rows[closed_by == nrows]:
+        openapps[appnames[apps[row]]] = {'open': True, 'time': rawdata['dt_logged'].iloc[row]}
+    latest_unbackgrounded = False
+    if len(latest) > 0 and not rescued[-1]:
+        latest_unbackgrounded = {
+            'unbgd_app': appnames[latest['app'].values[-1]],
+            'fg_time': rawdata['dt_logged'].iloc[latest['row'].values[-1]],
+            'unbgd_time': rawdata['dt_logged'].iloc[latest['start_row'].values[-1]]
+        }
+    state = {'openapps': openapps, 'latest_unbackgrounded': latest_unbackgrounded}
+    return intervals.drop('firstseen', axis=1), state
+
+def get_interval_usage(rawdata, intervals):
+    '''
+    function to register the usage intervals and interactions paired by extract_intervals,
+    with the participant, app and title of the row that ends them (see get_usage).
+    Returns None when there are none.
+    '''
+    if len(intervals) == 0:
+        return None
+    starts = rawdata['dt_logged'].iloc[intervals['start_row']].reset_index(drop=True)
+    ends = rawdata['dt_logged'].iloc[intervals['end_row']].reset_index(drop=True)
+    closing = rawdata.iloc[intervals['end_row']].reset_index(drop=True)
+    return pd.DataFrame({
+        columns.prep_datetime_start: starts,
+        columns.prep_datetime_end: ends.where(intervals['start_row'] != intervals['end_row']),
+        "participant_id": closing['person'],
+        columns.full_name: closing[columns.full_name],
+        columns.title: closing[columns.title],
+        columns.prep_record_type: intervals[columns.prep_record_type]
+    })
+
+def get_usage_intervals_vectorized(dataframe, state=None):
+    '''
+    function to extract the usage intervals from a raw dataset with grouped array
+    operations (see extract_intervals).  Gives the same output as get_usage_intervals.
+    '''
+    usage = None
+    previous = None if state is None else state['fill']
+    rawdata = clean_data(dataframe, previous=previous)
+    if state is None:
+        state = {'openapps': {}, 'latest_unbackgrounded': False}
+    else:
+        state = {k: v for k,v in state.items() if k != 'fill'}
+    if len(rawdata) > 0:
+        if len(state['openapps']) > 0:
+            rawdata = pd.concat([get_state_events(state), rawdata], ignore_index=True)
+            intervals, state = extract_intervals(rawdata, state)
+        else:
+            intervals, state = extract_intervals(rawdata)
+        usage = get_interval_usage(rawdata, intervals)
+    state['fill'] = get_fill_values(dataframe, previous=previous)
+    return usage, state
+
+@utils.profiled('extract_usage_vectorized')
+def extract_usage_vectorized(dataframe, precision=3600, state=None, return_state=False):
+    '''
+    function to extract usage from a filename, using grouped array operations
+    instead of looping over all events.  Gives the same output as extract_usage.
+    Precision in seconds.  With return_state, the state at the end is returned as
+    well (see extract_usage).
+    '''
+    usage, state = get_usage_intervals_vectorized(dataframe, state)
+    alldata = bin_usages(usage, precision=precision)
+    if return_state:
+        return alldata, state
+    return alldata
 
+engines = {
+    'loop': extract_usage,
+    'vectorized': extract_usage_vectorized
+}
+
+# the same engines, without splitting up the usage by precision (see preprocess_precisions)
+interval_engines = {
+    'loop': get_usage_intervals,
+    'vectorized': get_usage_intervals_vectorized
+}
+
+
+@utils.profiled('check_overlap_add_sessions')
 def check_overlap_add_sessions(data, session_def = [5*60]):
     '''
-    Function to loop over dataset, spot overlaps (and remove them), and add columns
-    to indicate whether a new session has been started or not.
+    Function to spot overlaps in the dataset (and remove them), and add columns
+    to indicate whether a new session has been started or not.  All rows are
+    compared with the previous row at once, for all session definitions.  With
+    several participants (sorted by participant, see preprocess_cohort), the first
+    row of every participant starts a session.
     '''
     data = data[data[columns.prep_duration_seconds] > 0].reset_index(drop=True)
+    if len(data) == 0:
+        for sess in session_def:
+            data['app_engage_%is'%int(sess)] = 0
+        data[columns.switch_app] = 0
+        return data
+
+    starttz = utils.get_timezones(data[columns.prep_datetime_start])
+    endtz = utils.get_timezones(data[columns.prep_datetime_end])
+    starts = utils.get_utc_ns(data[columns.prep_datetime_start])
+    ends = utils.get_utc_ns(data[columns.prep_datetime_end])
+    participants, names = pd.factorize(data['participant_id'])
+    first = np.append(True, participants[1:] != participants[:-1])
+
+    # check overlap: close the previous app when an app (not spanning midnight) is opened
+    # (the first row of a participant is compared with the last row before)
+    samedate = utils.get_local_ns(starts, starttz) // utils.NS_DAY == utils.get_local_ns(ends, endtz) // utils.NS_DAY
+    overlap = (starts - np.roll(ends, 1) < 0) & samedate & ~first
+    if np.any(overlap):
+        counts = np.bincount(participants[overlap], minlength=len(names))
+        for participant in np.where(counts > 0)[0]:
+            utils.logger("WARNING: Overlapping usage for participant %s: %i apps were still open when the next app was opened. \
+            Manually closing these apps..."%(names[participant], counts[participant]))
+        current = np.where(overlap)[0]
+        previous = current - 1
+        data.loc[previous, columns.prep_datetime_end] = data[columns.prep_datetime_start].iloc[current].tolist()
+        data.loc[previous, 'endtime'] = utils.format_time(utils.get_local_ns(starts[current], starttz[current]))
+        data.loc[previous, columns.prep_duration_seconds] = ((starts[current] - starts[previous]) % utils.NS_DAY) // utils.NS_SECOND
+        ends[previous] = starts[current]
+
+        # apps closed in the second they were opened are removed
+        keep = (data[columns.prep_duration_seconds] > 0).values
+        data = data[keep].reset_index(drop=True)
+        starts, ends, participants = starts[keep], ends[keep], participants[keep]
+        first = np.append(True, participants[1:] != participants[:-1])
 
-    # initiate session column(s)
+    # check sessions: time between previous and this app usage
+    nousetime = starts - np.roll(ends, 1)
     for sess in session_def:
-        data['app_engage_%is'%int(sess)] = 0
-
-    data[columns.switch_app] = 0
-    # loop over dataset:
-    # - prevent overlap (with warning)
-    # - check if a new session is started
-    for idx,row in data.iterrows():
-        if idx == 0:
-            for sess in session_def:
-                data.at[idx, 'app_engage_%is'%int(sess)] = 1
-
-        # check time between previous and this app usage
-        nousetime = row[columns.prep_datetime_start].astimezone(timezone("UTC")) - data[columns.prep_datetime_end].iloc[idx - 1].astimezone(timezone("UTC"))
-
-        # check overlap
-        if nousetime < timedelta(microseconds=0) and row[columns.prep_datetime_start].date == row[columns.prep_datetime_end].date:
-            utils.logger("WARNING: Overlapping usage for participant %s: %s was open since %s when %s was openened on %s. \
-            Manually closing %s..."%(
-                row['participant_id'],
-                data.iloc[idx-1][columns.full_name],
-                data.iloc[idx-1][columns.prep_datetime_start].strftime("%Y-%m-%d %H:%M:%S"),
-                row[columns.full_name],
-                row[columns.prep_datetime_start].strftime("%Y-%m-%d %H:%M:%S"),
-                data.iloc[idx-1][columns.full_name]
-            ))
-            data.at[idx-1,columns.prep_datetime_end] = row[columns.prep_datetime_start]
-            data.at[idx-1, columns.prep_duration_seconds] = (data.at[idx - 1, columns.prep_datetime_end] - data.at[idx - 1, columns.prep_datetime_start]).seconds
-
-        # check sessions
-        else:
-            for sess in session_def:
-                if nousetime > timedelta(seconds = sess):
-                    data.at[idx, 'app_engage_%is'%int(sess)] = 1
+        engage = (nousetime > sess * utils.NS_SECOND) | first
+        data['app_engage_%is'%int(sess)] = engage.astype(int)
 
-        # check appswitch
-        data.at[idx, columns.switch_app] = 1-(row[columns.full_name]==data[columns.full_name].iloc[idx-1])*1
+    # check appswitch (the first row of a participant is a switch)
+    apps = data[columns.full_name].values
+    switch = (apps != np.roll(apps, 1)) | first
+    data[columns.switch_app] = switch.astype(int)
     return data.reset_index(drop=True)
 
 def log_exceed_durations_minutes(row, threshold, outfile):
@@ -300,13 +697,38 @@ def log_exceed_durations_minutes(row, threshold, outfile):
             timestamp = timestamp
         ))
 
-def preprocess_dataframe(dataframe, precision=3600,sessioninterval = [5*60], logdir=None, logopts={}):
+def preprocess_dataframe(dataframe, precision=3600,sessioninterval = [5*60], logdir=None, logopts={}, engine='loop'):
+    dataframe = utils.backwards_compatibility(dataframe)
+    utils.logger("LOG: Extracting usage...",level=1)
+    tmp = engines[engine](dataframe,precision=precision)
+    return preprocess_usage(tmp, sessioninterval=sessioninterval)
+
+def preprocess_precisions(dataframe, precisions=[3600], sessioninterval = [5*60], engine='loop'):
+    '''
+    This function preprocesses a raw dataset at several precisions at once: the usage
+    intervals are extracted once, only splitting them up by precision (see bin_usages)
+    and the sessions are done per precision.  Returns the preprocessed data by precision,
+    the same as preprocess_dataframe at every precision.
+    '''
     dataframe = utils.backwards_compatibility(dataframe)
     utils.logger("LOG: Extracting usage...",level=1)
-    tmp = extract_usage(dataframe,precision=precision)
+    usage, _ = interval_engines[engine](dataframe)
+    return {precision: preprocess_usage(bin_usages(usage, precision=precision), sessioninterval=sessioninterval) for precision in precisions}
+
+def get_precision_folder(folder, precision, precisions):
+    '''
+    This function returns the folder for the data at a precision: the folder itself when
+    there's only one precision, otherwise a subfolder per precision (eg. precision_900).
+    '''
+    return folder if len(precisions) <= 1 else os.path.join(folder, "precision_%i"%precision)
+
+def preprocess_usage(tmp, sessioninterval = [5*60]):
+    '''
+    This function checks the overlap and adds the sessions and warnings to the extracted
+    usage, and adds the interactions back in order of time.
+    '''
     if not isinstance(tmp,pd.DataFrame) or np.sum(tmp[columns.prep_duration_seconds]) == 0:
         return None
-        utils.logger("WARNING: File %s does not seem to contain relevant data.  Skipping..."%filename)
     utils.logger("LOG: checking overlap session...",level=1)
     data = check_overlap_add_sessions(tmp,session_def=sessioninterval)
     data = utils.add_warnings(data)
@@ -314,47 +736,619 @@ def preprocess_dataframe(dataframe, precision=3600,sessioninterval = [5*60], log
     flagcols = [x for x in non_timed.columns if 'engage' in x or 'switch' in x]
     non_timed[flagcols] = None
     data = pd.concat([data, non_timed], ignore_index=True, sort=False)\
-        .sort_values(columns.prep_datetime_start)\
+        .sort_values(['participant_id', columns.prep_datetime_start], kind='mergesort')\
         .reset_index(drop=True)
 
-    return data
-    
-    
-def preprocess_folder(infolder,outfolder,precision=3600,sessioninterval = [5*60], logdir=None, logopts={}):
+    return dtypes.compact(data)
+
+interval_columns = [columns.prep_bins, columns.prep_interval_end, columns.prep_precision,
+    columns.prep_start_timezone, columns.prep_end_timezone]
+
+def same_values(first, second):
+    first, second = np.asarray(first, dtype=object), np.asarray(second, dtype=object)
+    return (first == second) | (pd.isna(first) & pd.isna(second))
+
+def to_intervals(data, precision=3600):
+    '''
+    This function stores preprocessed data as intervals instead of bins, so that the size
+    grows with the number of app usages rather than with the time they were used.  A bin is
+    merged in the bin before when it continues it: it starts at its end, in the same app and
+    timezone, without a new session, app switch or warning, and the bin before is a full bin
+    (or the first of the interval).  The first bin keeps its columns, with the number of bins
+    and the end of the last one.  Only bins that expand_intervals gives back exactly are
+    merged (eg. not the bins that were cut by an overlap).  The timezones are kept by name,
+    to split up the intervals on the local clock again.
+    '''
+    data = data.reset_index(drop=True)
+    step = int(round(precision * utils.NS_SECOND))
+    meta = ["participant_id", columns.full_name, columns.title, columns.prep_record_type]
+    flagcols = [x for x in data.columns if 'engage' in x or 'switch' in x]
+    timed = np.where(data[columns.prep_duration_seconds].notna().values)[0]
+    rows = data.iloc[timed]
+    starts = utils.get_utc_ns(rows[columns.prep_datetime_start])
+    ends = utils.get_utc_ns(rows[columns.prep_datetime_end])
+    starttz = utils.get_timezones(rows[columns.prep_datetime_start])
+    endtz = utils.get_timezones(rows[columns.prep_datetime_end])
+
+    # the bins that can be computed from the bin before (see expand_intervals)
+    continued = np.zeros(len(rows), dtype=bool)
+    if len(rows) > 1:
+        continued[1:] = (starts[1:] == ends[:-1]) & (starttz[1:] == starttz[:-1]) & (endtz[:-1] == starttz[:-1])
+    continued &= (ends - starts <= step) & np.array([len(x) == 0 for x in rows[columns.flags]], dtype=bool)
+    for col, values in get_bin_columns(starts, ends, utils.get_local_ns(starts, starttz), utils.get_local_ns(ends, endtz)).items():
+        continued &= rows[col].values == values
+    for col in flagcols:
+        continued &= rows[col].values == 0
+    for col in meta:
+        continued[1:] &= same_values(rows[col].values[1:], rows[col].values[:-1])
+
+    # a bin only continues a bin that's full or that starts an interval
+    afterfull = np.zeros(len(rows), dtype=bool)
+    afterfull[1:] = ends[:-1] - starts[:-1] == step
+    merged = continued & afterfull
+    for row in np.where(continued & ~afterfull)[0]:
+        merged[row] = not merged[row - 1]
+
+    first = np.where(~merged)[0]
+    last = np.append(first[1:], len(rows))[:len(first)] - 1
+    # the end of the interval and its timezone are left out when they're the ones of the first bin
+    bins = np.ones(len(data), dtype='int64')
+    bins[timed[first]] = last - first + 1
+    intervalend = np.full(len(data), np.iinfo('int64').min, dtype='int64')
+    intervalend[timed[first]] = np.where(last > first, ends[last], intervalend[0])
+    endzone = np.full(len(data), None, dtype=object)
+    endzone[timed[first]] = np.where(endtz[last] == starttz[first], None, endtz[last])
+
+    data[columns.prep_bins] = bins
+    data[columns.prep_interval_end] = pd.DatetimeIndex(intervalend.view('datetime64[ns]')).tz_localize('UTC')
+    data[columns.prep_precision] = precision
+    data[columns.prep_start_timezone] = utils.get_timezones(data[columns.prep_datetime_start])
+    data[columns.prep_end_timezone] = endzone
+    keep = np.ones(len(data), dtype=bool)
+    keep[timed[merged]] = False
+    return dtypes.compact(data[keep].reset_index(drop=True))
+
+def expand_intervals(data):
+    '''
+    This function splits up the intervals of preprocessed data (see to_intervals) in their
+    bins again, in the order they were in.  The timestamps are in UTC, with a column for their
+    utc offset (as read from a parquet file, see utils.read_intermediate).  Data with bins
+    is returned as it is.
+    '''
+    if not columns.prep_bins in data.columns:
+        return data
+    outcols = [x for x in data.columns if not x in interval_columns and not x.endswith('_utcoffset')]
+    data = data.reset_index(drop=True)
+    timed = data[columns.prep_duration_seconds].notna().values
+    bins = data[columns.prep_bins].values.astype('int64')
+    steps = np.round(data[columns.prep_precision].values.astype('float64') * utils.NS_SECOND).astype('int64')
+    starttz = data[columns.prep_start_timezone].values.astype(object)
+    endtz = data[columns.prep_end_timezone].values.astype(object)
+    endtz = np.where(pd.isna(endtz), starttz, endtz)
+    starts = utils.get_utc_ns(data[columns.prep_datetime_start])
+    ends = utils.get_utc_ns(data[columns.prep_datetime_end])
+    intervalends = np.where(bins > 1, utils.get_utc_ns(data[columns.prep_interval_end]), ends)
+
+    # the next bins follow the first (full bins, up to the end of the last)
+    counts = np.where(timed, bins - 1, 0)
+    owner = np.repeat(np.arange(len(data)), counts)
+    position = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    last = position == counts[owner]
+    binstarts = ends[owner] + (position - 1) * steps[owner]
+    binends = np.where(last, intervalends[owner], binstarts + steps[owner])
+    binendtz = np.where(last, endtz[owner], starttz[owner])
+    localstart = utils.get_local_ns(binstarts, starttz[owner])
+    localend = utils.get_local_ns(binends, binendtz)
+    following = pd.DataFrame(get_bin_columns(binstarts, binends, localstart, localend))
+    for col in ["participant_id", columns.full_name, columns.title, columns.prep_record_type]:
+        following[col] = data[col].values[owner]
+    for col in [x for x in outcols if 'engage' in x or 'switch' in x]:
+        following[col] = 0
+    following[columns.flags] = [[] for _ in range(len(following))]
+
+    # the first bins: the end is in the timezone of the start when more bins follow
+    firstendtz = np.where(bins > 1, starttz, endtz)
+    allstarts = np.append(starts, binstarts)
+    allends = np.append(np.where(timed, ends, np.iinfo('int64').min), binends)
+    startoffsets = np.append(utils.get_local_ns(starts, starttz), localstart) - allstarts
+    endoffsets = np.append(np.where(timed, utils.get_local_ns(np.where(timed, ends, 0), np.where(timed, firstendtz, 'UTC')), 0), localend) - allends
+    expanded = pd.concat([data[outcols], following.reindex(columns=outcols)], ignore_index=True)
+    expanded[columns.prep_datetime_start] = pd.DatetimeIndex(allstarts.view('datetime64[ns]')).tz_localize('UTC')
+    expanded[columns.prep_datetime_end] = pd.DatetimeIndex(allends.view('datetime64[ns]')).tz_localize('UTC')
+    for col, offsets in [(columns.prep_datetime_start, startoffsets), (columns.prep_datetime_end, endoffsets)]:
+        expanded[utils.utcoffset_column(col)] = (offsets // utils.NS_MINUTE).astype('float32')
+    expanded.loc[np.append(~timed, np.zeros(len(following), dtype=bool)), utils.utcoffset_column(columns.prep_datetime_end)] = np.nan
+
+    # every bin after its first bin, the interactions where they were
+    order = np.lexsort((np.append(np.zeros(len(data), dtype='int64'), position), np.append(np.arange(len(data)), owner)))
+    order = order[np.argsort(allstarts[order], kind='mergesort')]
+    return dtypes.compact(expanded.iloc[order].reset_index(drop=True))
+
+def get_cutoff(state, logged):
+    '''
+    This function returns the time (nanoseconds since epoch) from which events after the
+    last event (logged) can still add usage: the time of the first app that is still open,
+    or of the latest unbackgrounded app when it can still be moved to the background.
+    '''
+    times = [logged.value]
+    times += [x['time'] for x in state['openapps'].values() if x['open']]
+    latest = state['latest_unbackgrounded']
+    if latest and logged - latest['fg_time'] < timedelta(seconds=1):
+        times.append(latest['unbgd_time'])
+    return min(pd.Timestamp(x).value for x in times)
+
+def split_resumable(extracted, data, state, logged):
+    '''
+    This function finds the rows that can still change when events are added after
+    the last event (logged).  These are the rows that start after the last app usage
+    before the cutoff (see get_cutoff), as that usage can be closed by the next one.
+    Returns the number of rows in the (preprocessed) data before these rows, the start
+    of these rows and the extracted rows to recompute them (from the app usage before,
+    to compare with).
+    '''
+    if extracted is None or data is None:
+        return 0, None, extracted
+    starts = utils.get_utc_ns(extracted[columns.prep_datetime_start])
+    timed = (extracted[columns.prep_duration_seconds] > 0).values
+    before = np.where(timed & (starts < get_cutoff(state, logged)))[0]
+    if len(before) == 0:
+        return 0, None, extracted
+    since = starts[before[-1]]
+    previous = np.where(timed & (starts < since))[0]
+    pending = extracted.iloc[previous[-1]:] if len(previous) > 0 else extracted
+    final = np.sum(utils.get_utc_ns(data[columns.prep_datetime_start]) < since)
+    return int(final), int(since), pending.reset_index(drop=True)
+
+def get_output_columns(sessioninterval = [5*60]):
+    '''
+    This function returns the columns of a preprocessed file (see preprocess_usage).
+    '''
+    return preprocessed_columns + ['app_engage_%is'%int(sess) for sess in sessioninterval] + \
+        [columns.switch_app, columns.flags]
+
+def extract_resumable(dataframe, checkpoint=None, precision=3600, sessioninterval = [5*60], engine='loop'):
+    '''
+    This function preprocesses the raw events after a checkpoint, starting from the state of
+    the extraction at the checkpoint (or from the start without checkpoint).  Returns the
+    number of rows to keep from the preprocessed data before, the rows to add after them and
+    the new checkpoint.
+    '''
+    logged = pd.to_datetime(dataframe[columns.raw_date_logged], utc=True, errors='coerce')
+    state = None if checkpoint is None else checkpoint['state']
+    extracted, state = engines[engine](dataframe, precision=precision, state=state, return_state=True)
+    keep, since, rows = 0, None, int(logged.notna().sum())
+    if checkpoint is not None:
+        extracted = [x for x in [checkpoint['pending'], extracted] if x is not None]
+        extracted = pd.concat(extracted, ignore_index=True)\
+            .sort_values(by=[columns.prep_datetime_start, columns.prep_datetime_end])\
+            .reset_index(drop=True) if len(extracted) > 0 else None
+        keep, since, rows = checkpoint['final'], checkpoint['since'], checkpoint['rows'] + rows
+        logged = pd.concat([pd.Series([checkpoint['logged']]), logged], ignore_index=True)
+
+    data = preprocess_usage(extracted, sessioninterval=sessioninterval)
+    if data is not None:
+        data = data.reindex(columns=get_output_columns(sessioninterval))
+        if since is not None:
+            # rows before are in the earlier preprocessed data
+            data = data[utils.get_utc_ns(data[columns.prep_datetime_start]) >= since].reset_index(drop=True)
+
+    lastlogged = logged.max()
+    final, newsince, pending = split_resumable(extracted, data, state, lastlogged)
+    newcheckpoint = {
+        'logged': lastlogged,
+        'rows': rows,
+        'state': state,
+        'pending': pending,
+        'since': newsince,
+        'final': keep + final
+    }
+    return keep, data, newcheckpoint
+
+def check_checkpoint(chunks, checkpoint):
+    '''
+    This function checks that the raw events up to a checkpoint didn't change (as far as
+    can be seen without reading them all again): there are as many, and all timestamps
+    can be parsed.
+    '''
+    if checkpoint is None or None in checkpoint['state']['fill'].values():
+        return False
+    rows = 0
+    for chunk in chunks:
+        chunk = utils.backwards_compatibility(chunk)
+        logged = pd.to_datetime(chunk[columns.raw_date_logged], utc=True, errors='coerce')
+        if (logged.isna() & chunk[columns.raw_date_logged].notna()).any():
+            return False
+        rows += np.sum(logged <= checkpoint['logged'])
+    return rows == checkpoint['rows']
 
-    if not os.path.exists(outfolder):
-        os.mkdir(outfolder)
+def stream_dataframe(chunks, checkpoint=None, precision=3600, sessioninterval = [5*60], engine='loop'):
+    '''
+    This function preprocesses a raw dataset in chunks (see read_data), continuing the
+    extraction from the state after the chunk before, so that only one chunk is in memory.
+    Events at the last moment of a chunk are kept for the next, as events from the same
+    moment are sorted together.  With a checkpoint (see check_checkpoint), the events up to
+    it are skipped.  Yields the number of rows to keep from the preprocessed data before,
+    the rows to add after them and the new checkpoint, after every chunk (see extract_resumable).
+    The chunks should be sorted by time, events within a chunk don't need to be.
+    '''
+    start = None if checkpoint is None else checkpoint['logged']
+    carry = None
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            if carry is None:
+                break
+            chunk, carry = carry, None
+        else:
+            chunk = utils.backwards_compatibility(chunk)
+            logged = pd.to_datetime(chunk[columns.raw_date_logged], utc=True, errors='coerce')
+            if (logged.isna() & chunk[columns.raw_date_logged].notna()).any():
+                raise ValueError("Could not parse all timestamps in %s."%columns.raw_date_logged)
+            new = (logged > start).values if start is not None else logged.notna().values
+            if checkpoint is not None and np.any(new & (logged <= checkpoint['logged']).values):
+                raise ValueError("The raw data is not sorted by time: events from before %s come after it."%checkpoint['logged'])
+            chunk = chunk[new | logged.isna().values]
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            logged = pd.to_datetime(chunk[columns.raw_date_logged], utc=True, errors='coerce')
+            if logged.notna().sum() == 0:
+                continue
+            last = (logged == logged.max()).values
+            chunk, carry = chunk[~last], chunk[last]
+            if np.sum(chunk[columns.raw_date_logged].notna()) == 0:
+                continue
+        utils.logger("LOG: Extracting usage%s..."%("" if checkpoint is None else " after %s"%checkpoint['logged']),level=1)
+        keep, data, checkpoint = extract_resumable(chunk, checkpoint, precision=precision, sessioninterval=sessioninterval, engine=engine)
+        yield keep, data, checkpoint
 
-    for filename in [x for x in os.listdir(infolder) if x.startswith("Chronicle")]:
+def preprocess_file(filename,infolder,outfolder,precision=3600,sessioninterval = [5*60], logdir=None, logopts={}, engine='loop', intermediate_format='csv', resume=False, force=False, chunksize=None, intervals=False):
+    '''
+    This function preprocesses a single raw file and writes the result to the outfolder.
+    Errors are logged and not raised, so that one corrupt file doesn't stop a full folder.
+    Returns the filename when the file could not be processed, otherwise None.
+    With resume, a checkpoint is kept with the file, so that the next time only events
+    after the checkpoint are processed and appended (unless force).  With chunksize, the
+    file is read and written in chunks of that many events (see stream_dataframe).  With
+    intervals, the usage is written as intervals instead of bins (see to_intervals).
+    '''
+    utils.set_logtag(get_personid(filename))
+    try:
         utils.logger("LOG: Preprocessing file %s..."%filename,level=1)
+        infilename = os.path.join(infolder,filename)
+        outfilename = os.path.join(outfolder, filename.replace('ChronicleData','ChronicleData_preprocessed'))
+        checkpointfile = os.path.join(outfolder, "checkpoints", "%s.pkl"%filename)
+        if not resume and os.path.exists(checkpointfile):
+            # the output is rewritten, so the checkpoint doesn't match anymore
+            os.remove(checkpointfile)
+        if not resume and chunksize is None:
+            dataframe = read_data(infilename)
+            data = preprocess_dataframe(dataframe, precision=precision,sessioninterval = sessioninterval, logdir=logdir, logopts=logopts, engine=engine)
+            if data is not None:
+                utils.write_intermediate(to_intervals(data, precision) if intervals else data, outfilename, intermediate_format)
+            return
+
+        parameters = {'precision': precision, 'sessioninterval': list(sessioninterval), 'intermediate_format': intermediate_format}
+        checkpoint = None if force or not resume else manifest.read_checkpoint(checkpointfile, parameters)
+        if checkpoint is not None and checkpoint['final'] > 0 and \
+            not os.path.exists("%s.%s"%(os.path.splitext(outfilename)[0], intermediate_format)):
+            checkpoint = None
+        chunks = [read_data(infilename)] if chunksize is None else read_data(infilename, chunksize)
+        if checkpoint is not None and not check_checkpoint(chunks if chunksize is None else read_data(infilename, chunksize), checkpoint):
+            utils.logger("WARNING: The raw data changed before the checkpoint.  Preprocessing the full file...")
+            checkpoint = None
+
+        # rows that can still change are only written at the end
+        writer, offset, pending = None, None, None
+        if checkpoint is not None:
+            offset = checkpoint['offset']
+        for keep, data, checkpoint in stream_dataframe(chunks, checkpoint, precision=precision, sessioninterval=sessioninterval, engine=engine):
+            if writer is None:
+                writer = utils.start_intermediate(outfilename, intermediate_format, keep, offset)
+            pending = None
+            if data is not None:
+                offset = utils.append_intermediate(data[:checkpoint['final'] - keep], writer)
+                pending = data[checkpoint['final'] - keep:]
+        if writer is None:
+            return
+        if pending is not None:
+            utils.append_intermediate(pending, writer)
+        utils.finish_intermediate(writer)
+        if resume:
+            checkpoint['offset'] = offset
+            manifest.write_checkpoint(checkpoint, checkpointfile, parameters)
+    except Exception as e:
+        utils.logger("ERROR: Could not preprocess file %s: %s: %s"%(filename, type(e).__name__, e))
+        return filename
+    finally:
+        utils.set_logtag(None)
+
+def preprocess_file_precisions(filename, infolder, outfolders, sessioninterval = [5*60], engine='loop', intermediate_format='csv', intervals=False):
+    '''
+    This function preprocesses a single raw file at several precisions (see preprocess_precisions)
+    and writes the result at every precision to its folder (outfolders, by precision).  Errors are
+    logged and not raised, as in preprocess_file.  Returns the filename when the file could not
+    be processed, otherwise None.
+    '''
+    utils.set_logtag(get_personid(filename))
+    try:
+        utils.logger("LOG: Preprocessing file %s at %i precisions..."%(filename, len(outfolders)),level=1)
+        outfilename = filename.replace('ChronicleData','ChronicleData_preprocessed')
+        for outfolder in outfolders.values():
+            checkpointfile = os.path.join(outfolder, "checkpoints", "%s.pkl"%filename)
+            if os.path.exists(checkpointfile):
+                os.remove(checkpointfile)
         dataframe = read_data(os.path.join(infolder,filename))
-        data = preprocess_dataframe(dataframe, precision=precision,sessioninterval = sessioninterval, logdir=logdir, logopts=logopts)
-        if data is not None:
-            outfilename = filename.replace('ChronicleData','ChronicleData_preprocessed')
-            data.to_csv(os.path.join(outfolder,outfilename),index=False)
+        results = preprocess_precisions(dataframe, list(outfolders.keys()), sessioninterval=sessioninterval, engine=engine)
+        for precision, data in results.items():
+            if data is not None:
+                utils.write_intermediate(to_intervals(data, precision) if intervals else data,
+                    os.path.join(outfolders[precision], outfilename), intermediate_format)
+    except Exception as e:
+        utils.logger("ERROR: Could not preprocess file %s: %s: %s"%(filename, type(e).__name__, e))
+        return filename
+    finally:
+        utils.set_logtag(None)
+
+def get_cohort_intervals(dataframe):
+    '''
+    function to extract the usage intervals of many persons at once (see read_cohort): the
+    events of all persons are cleaned and paired together, every person separately (see
+    extract_intervals).  Gives the same intervals as get_usage_intervals_vectorized for
+    every person, sorted by person.
+    '''
+    rawdata = clean_data(dataframe)
+    if len(rawdata) == 0:
+        return None
+    intervals, _ = extract_intervals(rawdata, groups=pd.factorize(rawdata['person'])[0])
+    return get_interval_usage(rawdata, intervals)
+
+def split_persons(data):
+    '''
+    This function splits up the preprocessed data of several persons (see preprocess_cohort)
+    by person, as preprocess_usage returns it for one person: persons without usage are
+    left out, and the categories, the dtypes (see dtypes.compact) and the timezones of the
+    timestamps are those of the person.  Returns the data by person.
+    '''
+    if data is None:
+        return {}
+    # timestamps in different timezones are objects, unless they're in one timezone per person
+    zones = {col: utils.get_timezones(data[col]) for col in [columns.prep_datetime_start, columns.prep_datetime_end]
+        if data[col].dtype == object}
+    persons = {}
+    for person, rows in data.groupby('participant_id', sort=False, observed=True).indices.items():
+        personal = data.iloc[rows].reset_index(drop=True)
+        if np.sum(personal[columns.prep_duration_seconds]) == 0:
+            continue
+        for col in personal.columns[(personal.dtypes == 'category').values]:
+            personal[col] = personal[col].cat.remove_unused_categories()
+        for col, colzones in zones.items():
+            personzones = [x for x in pd.unique(colzones[rows]) if x is not None]
+            if len(personzones) == 1:
+                personal[col] = pd.to_datetime(personal[col], utc=True).dt.tz_convert(personzones[0])
+        persons[person] = dtypes.compact(personal)
+    return persons
+
+def get_timezone_groups(dataframe):
+    '''
+    This function groups the persons of a dataframe with the raw data of many persons (see
+    read_cohort) by timezone: the persons with all events in the same timezone, and the
+    persons with events in more than one timezone.  Returns the lists of persons.
+    '''
+    zones = dataframe[['person', columns.timezone]].dropna().drop_duplicates()
+    counts = zones['person'].value_counts()
+    single = zones[zones['person'].isin(counts.index[counts == 1])]
+    groups = [list(x) for _, x in single.groupby(columns.timezone, observed=True)['person']]
+    mixed = [x for x in pd.unique(dataframe['person']) if not x in single['person'].values]
+    return [x for x in groups + [mixed] if len(x) > 0]
 
+def preprocess_cohort(dataframe, precisions=[3600], sessioninterval = [5*60]):
+    '''
+    This function preprocesses the raw data of many persons at once (see read_cohort): the
+    usage of all persons is extracted together (see get_cohort_intervals), split up by
+    precision and checked for overlap and sessions in one go, and only split up by person
+    at the end (see split_persons).  The persons in the same timezone are preprocessed
+    together (see get_timezone_groups), so that their timestamps keep the timezone (rather
+    than being objects, which is slower).  Returns the preprocessed data by precision and
+    by person, the same as preprocess_precisions for every person.
+    '''
+    dataframe = utils.backwards_compatibility(dataframe)
+    results = {precision: {} for precision in precisions}
+    for persons in get_timezone_groups(dataframe):
+        utils.logger("LOG: Extracting usage of %i persons..."%len(persons),level=1)
+        usage = get_cohort_intervals(dataframe[dataframe['person'].isin(persons)])
+        for precision in precisions:
+            results[precision].update(split_persons(preprocess_usage(bin_usages(usage, precision=precision), sessioninterval=sessioninterval)))
+    return results
+
+def preprocess_batch(filenames, infolder, outfolders, sessioninterval = [5*60], intermediate_format='csv', intervals=False):
+    '''
+    This function preprocesses a batch of raw files at once (see preprocess_cohort), and writes
+    the result of every file at every precision to its folder (outfolders, by precision).
+    When the batch can't be preprocessed at once, its files are preprocessed one by one
+    (see preprocess_file_precisions), so that one corrupt file doesn't fail the others.
+    Returns the files that could not be processed.
+    '''
+    try:
+        utils.logger("LOG: Preprocessing %i files at once..."%len(filenames),level=1)
+        personids = {filename: get_personid(filename) for filename in filenames}
+        if len(set(personids.values())) < len(filenames):
+            raise ValueError("Files of the same person in one batch.")
+        for outfolder in outfolders.values():
+            for filename in filenames:
+                checkpointfile = os.path.join(outfolder, "checkpoints", "%s.pkl"%filename)
+                if os.path.exists(checkpointfile):
+                    os.remove(checkpointfile)
+        dataframe, failed = read_cohort(filenames, infolder)
+        if dataframe is None:
+            return failed
+        results = preprocess_cohort(dataframe, list(outfolders.keys()), sessioninterval=sessioninterval)
+        for precision, persons in results.items():
+            for filename in filenames:
+                data = persons.get(personids[filename])
+                if data is not None:
+                    utils.write_intermediate(to_intervals(data, precision) if intervals else data,
+                        os.path.join(outfolders[precision], filename.replace('ChronicleData','ChronicleData_preprocessed')), intermediate_format)
+        return failed
+    except Exception as e:
+        utils.logger("WARNING: Could not preprocess %i files at once: %s: %s.  Preprocessing them one by one..."%(len(filenames), type(e).__name__, e))
+        failed = [preprocess_file_precisions(filename, infolder, outfolders, sessioninterval=sessioninterval, engine='vectorized',
+            intermediate_format=intermediate_format, intervals=intervals) for filename in filenames]
+        return [x for x in failed if x is not None]
+
+def preprocess_folder(infolder,outfolder,precision=3600,sessioninterval = [5*60], logdir=None, logopts={}, engine='loop', workers=1, intermediate_format='csv', force=False, resume=False, chunksize=None, intervals=False, batch=None):
+    '''
+    This function preprocesses all raw files in a folder.  With workers > 1, the files
+    are spread over a pool of processes.  Returns the list of files that failed.
+    A manifest in the outfolder keeps track of the files that were preprocessed:
+    files that didn't change since (with the same parameters) are skipped, unless force.
+    With resume, only the events added to a file since the last run are processed.
+    With chunksize, files are read in chunks of that many events (see preprocess_file).
+    With a list of precisions, every precision is written to its own subfolder (see
+    get_precision_folder), and the usage of a file is extracted once for all precisions
+    (see preprocess_file_precisions), except with resume or chunksize.  With intervals,
+    the usage is written as intervals instead of bins (see to_intervals, not with resume
+    or chunksize).  With batch, the files are preprocessed that many at once (see
+    preprocess_batch, with the vectorized engine and not with resume or chunksize).
+    '''
+
+    if not engine in engines.keys():
+        raise ValueError("Unknown extraction engine %s: should be one of %s"%(engine, ", ".join(engines.keys())))
+    if workers < 1:
+        raise ValueError("The number of workers should be at least 1.")
+    if not intermediate_format in utils.intermediate_formats:
+        raise ValueError("Unknown intermediate format %s: should be one of %s"%(intermediate_format, ", ".join(utils.intermediate_formats)))
+    if intervals and (resume or chunksize is not None):
+        raise ValueError("The usage can only be written as intervals without resume and chunksize.")
+    if batch is not None and (resume or chunksize is not None):
+        raise ValueError("Files can only be preprocessed in batches without resume and chunksize.")
+    if batch is not None and batch < 1:
+        raise ValueError("The number of files in a batch should be at least 1.")
+
+    precisions = list(precision) if isinstance(precision, (list, tuple)) else [precision]
+    kwargs = dict(sessioninterval=sessioninterval, logdir=logdir, logopts=logopts, engine=engine, workers=workers, intermediate_format=intermediate_format, resume=resume, force=force, chunksize=chunksize, intervals=intervals)
+    if len(precisions) > 1 and (resume or chunksize is not None):
+        # the checkpoints are kept per precision
+        if not os.path.exists(outfolder):
+            os.mkdir(outfolder)
+        failed = []
+        for prec in precisions:
+            failed += [x for x in preprocess_folder(infolder, get_precision_folder(outfolder, prec, precisions), precision=prec, **kwargs) if not x in failed]
+        return failed
+
+    folders = {prec: get_precision_folder(outfolder, prec, precisions) for prec in precisions}
+    for folder in [outfolder] + list(folders.values()):
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+
+    allfilenames = sorted([x for x in os.listdir(infolder) if x.startswith("Chronicle")])
+
+    # skip files that were preprocessed before with the same parameters (a manifest per precision)
+    entries = {prec: {} for prec in precisions}
+    newentries = {prec: {} for prec in precisions}
+    todo = {}
+    for prec, folder in folders.items():
+        parameters = {'precision': prec, 'sessioninterval': list(sessioninterval), 'intermediate_format': intermediate_format, 'intervals': intervals}
+        previous = {} if force else manifest.read_manifest(os.path.join(folder, "preprocessing_manifest.json"))
+        for filename in allfilenames:
+            entry = previous.get(filename)
+            if manifest.is_unchanged(entry, os.path.join(infolder,filename), parameters) and \
+                (entry['output'] is None or os.path.exists(os.path.join(folder,entry['output']))):
+                entry['mtime'] = os.stat(os.path.join(infolder,filename)).st_mtime
+                entries[prec][filename] = entry
+            else:
+                todo.setdefault(filename, []).append(prec)
+                newentries[prec][filename] = manifest.get_entry(os.path.join(infolder,filename), parameters)
+    filenames = [x for x in allfilenames if x in todo]
+    if len(filenames) < len(allfilenames):
+        utils.logger("LOG: Skipping %i files that didn't change since they were preprocessed..."%(len(allfilenames) - len(filenames)),level=1)
+
+    def get_task(filename):
+        if len(precisions) == 1:
+            return preprocess_file, (filename, infolder, outfolder), dict(precision=precisions[0],
+                **{k: v for k,v in kwargs.items() if k != 'workers'})
+        return preprocess_file_precisions, (filename, infolder, {prec: folders[prec] for prec in todo[filename]}), \
+            dict(sessioninterval=sessioninterval, engine=engine, intermediate_format=intermediate_format, intervals=intervals)
+
+    def get_batches():
+        # files that are preprocessed at the same precisions are put in the same batches
+        groups = {}
+        for filename in filenames:
+            groups.setdefault(tuple(todo[filename]), []).append(filename)
+        for precs, group in groups.items():
+            for start in range(0, len(group), batch):
+                files = group[start:start+batch]
+                yield files, preprocess_batch, (files, infolder, {prec: folders[prec] for prec in precs}), \
+                    dict(sessioninterval=sessioninterval, intermediate_format=intermediate_format, intervals=intervals)
+
+    # every task returns the files that failed (a batch a list, a file itself)
+    tasks = [([x],) + get_task(x) for x in filenames] if batch is None else list(get_batches())
+    failed = []
+    if workers == 1 or len(tasks) <= 1:
+        for files, function, args, fkwargs in tasks:
+            result = function(*args, **fkwargs)
+            failed += result if isinstance(result, list) else [result]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+            futures = [(files, executor.submit(function, *args, **fkwargs)) for files, function, args, fkwargs in tasks]
+            for files, future in futures:
+                try:
+                    result = future.result()
+                    failed += result if isinstance(result, list) else [result]
+                except Exception as e:
+                    # the worker process itself died (eg. out of memory)
+                    for filename in files:
+                        utils.logger("ERROR: Could not preprocess file %s: %s: %s"%(filename, type(e).__name__, e))
+                    failed += files
+
+    failed = [x for x in failed if x is not None]
+    if len(failed) > 0:
+        utils.logger("WARNING: %i out of %i files could not be preprocessed: %s"%(len(failed), len(filenames), ", ".join(failed)))
+
+    for prec, folder in folders.items():
+        for filename in [x for x in newentries[prec] if not x in failed]:
+            outfilename = "%s.%s"%(os.path.splitext(filename.replace('ChronicleData','ChronicleData_preprocessed'))[0], intermediate_format)
+            newentries[prec][filename]['output'] = outfilename if os.path.exists(os.path.join(folder,outfilename)) else None
+            entries[prec][filename] = newentries[prec][filename]
+        manifest.write_manifest(entries[prec], os.path.join(folder, "preprocessing_manifest.json"))
+    return failed
+
+@utils.profiled('add_preprocessed_columns')
 def add_preprocessed_columns(data):
+    '''
+    This function adds the columns for the summary (durations, dates, weekdays, hours,
+    quarters) for all rows at once.  These are taken on the local clock, so after this
+    the start and end timestamps are local times without timezone.
+    '''
     if data.shape[0] == 0:
         return data
-    data[columns.prep_datetime_start] = data[columns.prep_datetime_start].astype(str).replace('nan', )
-    data[columns.prep_datetime_end] = data[columns.prep_datetime_end].astype(str).replace('nan',None)
-
-    data[columns.prep_datetime_start] = pd.to_datetime(data[columns.prep_datetime_start].replace('nan', ''), infer_datetime_format = True, utc = True)
-    data[columns.prep_datetime_end] = pd.to_datetime(data[columns.prep_datetime_end].replace('nan', ''), infer_datetime_format = True, utc = True)
-    data['duration_minutes'] = data.apply(lambda x: x[columns.prep_duration_seconds] / 60., axis = 1)
-    data['firstdate'] = min(data[columns.prep_datetime_start]).date()
-    data['lastdate'] = max(data[columns.prep_datetime_end][~data[columns.prep_datetime_end].isna()]).date()
-    data['date'] = data.apply(lambda x: x[columns.prep_datetime_start].date(), axis =1)
-    data[columns.prep_datetime_start] = data.apply(lambda x: x[columns.prep_datetime_start], axis = 1)
-    data[columns.prep_datetime_end] = data.apply(lambda x: x[columns.prep_datetime_end], axis = 1)
-    data["day"] = data.apply(lambda x: (x[columns.prep_datetime_start].weekday() + 1) % 7 + 1, axis = 1)
-    data["weekdayMF"] = data.apply(lambda x: 1 if x[columns.prep_datetime_start].weekday() < 5 else 0, axis = 1)
-    data["weekdayMTh"] = data.apply(lambda x: 1 if x[columns.prep_datetime_start].weekday() < 4 else 0, axis = 1)
-    data["weekdaySTh"] = data.apply(lambda x: 1 if (x[columns.prep_datetime_start].weekday() < 4 or x[columns.prep_datetime_start].weekday() == 6) else 0, axis = 1)
-    data["hour"] = data.apply(lambda x: x[columns.prep_datetime_start].hour, axis = 1)
-    data["quarter"] = data.apply(lambda x: utils.round_down_to_quarter(x[columns.prep_datetime_start]), axis = 1)
+    local = {}
+    for col in [columns.prep_datetime_start, columns.prep_datetime_end]:
+        if utils.utcoffset_column(col) in data.columns:
+            utcoffsets = data[utils.utcoffset_column(col)].values
+            local[col] = utils.get_local_timestamps(data[col], utcoffsets)
+            data = data.drop(columns = utils.utcoffset_column(col))
+        else:
+            utcoffsets = utils.get_utcoffsets(data[col])
+            local[col] = utils.get_local_timestamps(data[col])
+        # utc times (for durations over daylight saving time changes)
+        data[col] = (local[col] - pd.to_timedelta(utcoffsets, unit='m')).dt.tz_localize('UTC').values
+        local[col] = local[col].values
     data = utils.add_session_durations(data)
-    return data
+    data[columns.prep_datetime_start] = local[columns.prep_datetime_start]
+    data[columns.prep_datetime_end] = local[columns.prep_datetime_end]
+
+    start = data[columns.prep_datetime_start]
+    weekday = start.dt.weekday
+    data['duration_minutes'] = data[columns.prep_duration_seconds].astype('float64') / 60.
+    data['firstdate'] = start.min().date()
+    data['lastdate'] = data[columns.prep_datetime_end].max().date()
+    data['date'] = start.dt.date
+    data["day"] = (weekday + 1) % 7 + 1
+    data["weekdayMF"] = (weekday < 5).astype(int)
+    data["weekdayMTh"] = (weekday < 4).astype(int)
+    data["weekdaySTh"] = ((weekday < 4) | (weekday == 6)).astype(int)
+    data["hour"] = start.dt.hour
+    data["quarter"] = start.dt.minute // 15 + 1
+    return dtypes.compact(data)
 
     # if 'log_exceed_durations_minutes' in logopts.keys():
     #     if not os.path.exists(logdir):
@@ -1,4 +1,4 @@
-from . import utils, summarise_person
+from . import utils, summarise_person, dtypes
 from .constants import columns
 from datetime import datetime, timedelta
 from collections import Counter
@@ -8,33 +8,62 @@ import numpy as np
 import os
 import re
 
-def subset(infolder, outfolder, removefile=None, subsetfile = None):
+def read_filters(subsetfile=None, removefile=None):
+    '''
+    This function compiles the subset and remove files into app filters, once for all
+    participants: a filter per subset (per column of the subset file, with the apps coded 1)
+    with the set of apps to keep (None for all apps) and the set of apps to remove.  Returns
+    a dictionary with the filters by name, empty without a subset or remove file.
+    '''
+    remove = frozenset(pd.read_csv(removefile)['full_name']) if isinstance(removefile,str) else None
+    if isinstance(subsetfile,str):
+        subset = pd.read_csv(subsetfile,index_col= 'full_name').astype(str)
+        return {name: {'keep': frozenset(subset.index[subset[name]=='1']), 'remove': remove} for name in subset.columns}
+    if remove is not None:
+        return {'removed': {'keep': None, 'remove': remove}}
+    return {}
 
-    if not (isinstance(subsetfile,str) or isinstance(removefile,str)):
+def get_folder(folder, name, filters):
+    '''
+    This function returns the folder for the data of a filter: the folder itself when there's
+    only one filter, otherwise a subfolder named after the filter.
+    '''
+    return folder if len(filters) <= 1 else os.path.join(folder, name)
+
+def filter_apps(preprocessed, appfilter):
+    '''
+    This function applies an app filter (see read_filters) to the preprocessed data of a person.
+    The apps are categories, so the filter is checked once per app instead of once per row.
+    '''
+    preprocessed = dtypes.compact(utils.backwards_compatibility(preprocessed)).dropna(subset=[columns.full_name])
+    apps = preprocessed[columns.full_name]
+    allowed = np.ones(len(apps.cat.categories), dtype=bool)
+    if appfilter['keep'] is not None:
+        allowed &= apps.cat.categories.isin(appfilter['keep'])
+    if appfilter['remove'] is not None:
+        allowed &= ~apps.cat.categories.isin(appfilter['remove'])
+    return preprocessed[allowed[apps.cat.codes.values]].reset_index(drop=True)
+
+def subset(infolder, outfolder, removefile=None, subsetfile = None, intermediate_format='csv'):
+    '''
+    This function writes the subsetted files of all preprocessed files in a folder, in a
+    subfolder per subset when the subset file has more than one column.  The summary
+    doesn't need these files: it can filter the preprocessed files (see summarising.summary).
+    '''
+    filters = read_filters(subsetfile, removefile)
+    if len(filters) == 0:
         return 0
-        
-    if not os.path.exists(outfolder):
-        os.mkdir(outfolder)
+
+    for name in filters:
+        folder = get_folder(outfolder, name, filters)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
 
     files = [x for x in os.listdir(infolder) if x.startswith("Chronicle")]
     for idx,filenm in enumerate(files):
         utils.logger("LOG: Subsetting file %s..."%filenm,level=1)
-        preprocessed = pd.read_csv(os.path.join(infolder,filenm)
-            )
-        preprocessed = utils.backwards_compatibility(preprocessed).dropna(subset=[columns.full_name])
-            
-        if isinstance(subsetfile,str):
-            subset = pd.read_csv(subsetfile,index_col= 'full_name').astype(str)
-            if len(subset.columns)>1:
-                utils.logger("WARNING: only 1 subset can be defined at a time.  Only the first column of the subset file will be used.")
-            subsetname = list(subset.columns)[0]
-            apps = list(subset.index[subset[subsetname]=='1'])
-            preprocessed = preprocessed[preprocessed[columns.full_name].isin(apps)].reset_index(drop=True)
-
-        if isinstance(removefile,str):
-            remove = pd.read_csv(removefile)['full_name']
-            apps = list(remove)
-            preprocessed = preprocessed[~preprocessed[columns.full_name].isin(apps)].reset_index(drop=True)
-
+        preprocessed = utils.read_intermediate(os.path.join(infolder,filenm))
         outfilename = filenm.replace('ChronicleData_preprocessed','ChronicleData_subsetted')
-        preprocessed.to_csv(os.path.join(outfolder, outfilename),index=False)
\ No newline at end of file
+        for name, appfilter in filters.items():
+            utils.write_intermediate(filter_apps(preprocessed, appfilter),
+                os.path.join(get_folder(outfolder, name, filters), outfilename), intermediate_format)
@@ -6,13 +6,16 @@ import numpy as np
 import os
 import re
 
-def percentages(preprocessed, personID = None, recodefile=None):
+@utils.profiled('percentages')
+def percentages(preprocessed, personID = None, recodefile=None, recode=None):
     
-    recode = pd.read_csv(recodefile,index_col='full_name').astype(str)
-    addedcol = list(set(recode.columns)-set('full_name'))[0]
-    unique_apps = preprocessed \
-        .drop_duplicates(columns.full_name)[['participant_id', columns.full_name]] \
-        .merge(recode, how="left", right_on="full_name", left_on=columns.full_name) \
+    if recode is None:
+        recode = utils.read_recode(recodefile)
+    addedcol = recode.columns[0]
+    unique_apps = utils.recode_apps(
+            preprocessed.drop_duplicates(columns.full_name)[['participant_id', columns.full_name]],
+            recode[[addedcol]]
+        ) \
         .groupby(addedcol) \
         .agg({columns.full_name: 'count'}) \
         .reset_index()
@@ -1,4 +1,3 @@
-from collections import Counter
 from .constants import columns, interactions
 from . import utils
 import pandas as pd
@@ -7,28 +6,48 @@ import os
 import re
 
 def summarise_daily(dataset,engagecols, datelist):
+    return summarise_daily_splits(dataset, engagecols, datelist, {'daily': pd.Series(True, index=dataset.index)})['daily']
+
+@utils.profiled('summarise_daily_splits')
+def summarise_daily_splits(dataset, engagecols, datelist, splits):
+    '''
+    This function summarises the data per day for several subsets of the rows at once
+    (eg. weekdays and weekend days): splits is a dictionary of boolean masks.  Rows
+    outside a subset are set missing for that subset, so that all subsets are summed
+    in one groupby by date (and in the same order as for the subset alone).  Returns a
+    dictionary with the daily table of every subset.
+    '''
 
     # simple daily aggregate functions
-    dailyfunctions = {
-        "duration_minutes": ['sum'],
-        columns.switch_app: ['sum']
+    sums = {
+        "duration_minutes": 'dur',
+        columns.switch_app: 'appcnt'
     }
-    engagedurfunctions = {"%s_dur"%k: [lambda x: np.mean(np.unique(x))] for k in engagecols}
-    dailyfunctions.update(engagedurfunctions)
-    engagecntfunctions = {k: ['sum'] for k in engagecols}
-    dailyfunctions.update(engagecntfunctions)
-
-    # group by date
-    daily = dataset.groupby('date').agg(dailyfunctions)
+    means = {"%s_dur"%k: "%s_dur"%k for k in engagecols}
+    sums.update({k: '%s_cnt'%k for k in engagecols})
     cols = ['dur','appcnt'] + ['%s_dur'%k for k in engagecols] + ['%s_cnt'%k for k in engagecols]
-    daily.columns = cols
-    daily.index = pd.to_datetime(daily.index)
-
-    # fill days of no usage
-    daily = utils.fill_dates(daily, datelist)
-
-    return daily
 
+    # group by date
+    masked = pd.DataFrame({(name, col): dataset[col].where(mask) \
+        for name, mask in splits.items() for col in list(sums) + list(means)}, index=dataset.index)
+    grouped = masked.groupby(dataset['date'])
+    summed = grouped[[x for x in masked.columns if x[1] in sums]].sum(min_count=1)
+    if len(means) > 0:
+        summed = summed.join(grouped[[x for x in masked.columns if x[1] in means]].agg(lambda x: np.mean(np.unique(x.dropna()))))
+
+    tables = {}
+    for name in splits:
+        daily = summed[name].rename(columns = {**sums, **means})[cols].dropna(how='all')
+        for col in [x for x in sums if dataset[x].dtype.kind in 'biu']:
+            daily[sums[col]] = daily[sums[col]].astype('int64')
+        daily.index = pd.to_datetime(daily.index)
+
+        # fill days of no usage
+        tables[name] = utils.fill_dates(daily, datelist)
+
+    return tables
+
+@utils.profiled('summarise_hourly')
 def summarise_hourly(dataset,engagecols):
 
     # hourly daily aggregate functions
@@ -59,14 +78,15 @@ def summarise_hourly(dataset,engagecols):
 
     return hourly
 
+@utils.profiled('summarise_quarterly')
 def summarise_quarterly(dataset,engagecols):
 
     # quarterly daily aggregate functions
     quarterlyfunctions = {
-        "duration_minutes": {"dur": 'sum'},
-        columns.switch_app: {"appcnt": "sum"}
+        "duration_minutes": ['sum'],
+        columns.switch_app: ['sum']
     }
-    quarterlyengagefunctions = {k: {"%s_num"%k: 'sum'} for k in engagecols}
+    quarterlyengagefunctions = {k: ['sum'] for k in engagecols}
     quarterlyfunctions.update(quarterlyengagefunctions)
 
     # group by date / hour / quarter
@@ -86,68 +106,70 @@ def summarise_quarterly(dataset,engagecols):
     return quarterly
 
 def summarise_appcoding_daily(dataset,addedcols):
-    custom = None
-    for addedcol in addedcols:
-        dataset = dataset.fillna(value = {addedcol:"NA"})
-        customgrouped = dataset[['date',addedcol,'duration_minutes']].groupby(['date',addedcol])
-        try:
-            customgrouped = customgrouped.agg(sum)
-        except TypeError:
-            utils.logger("There's an issue with the appcoding file.  Is it possible that an app was defined twice? Exiting !!")
-        customgrouped = customgrouped.unstack(addedcol)
-        customgrouped.columns = ["%s_%s_dur"%(addedcol,x) for x in customgrouped.columns.droplevel(0)]
-        customgrouped.index = pd.to_datetime(customgrouped.index)
-        if not isinstance(custom,pd.DataFrame):
-            custom = customgrouped
-        else:
-            custom = pd.merge(custom,customgrouped, on='date')
-    return custom
+    return summarise_recodes(dataset,addedcols,quarterly=False,hourly=False)['appcoding_daily']
 
 def summarise_appcoding_hourly(dataset,addedcols):
-    custom = None
-    datelist = pd.date_range(start = np.min(dataset[columns.prep_datetime_start]).date(), end = np.max(dataset[columns.prep_datetime_end]).date(), freq='D')
-    for addedcol in addedcols:
-        catlist = list(Counter(dataset[addedcol]).keys())
-        dataset = dataset.fillna(value = {addedcol:"NA"})
-        try:
-            customgrouped = dataset[['date',addedcol,'duration_minutes','hour']].groupby(['date',addedcol,'hour']).agg(sum)
-        except TypeError:
-            utils.logger("There's an issue with the appcoding file.  Is it possible that an app was defined twice?")
-            raise SystemExit
-        customgrouped = utils.fill_appcat_hourly(customgrouped,datelist,catlist).unstack([addedcol,'hour'])
-        customgrouped.columns = ["%s_%s_dur_h%i"%(addedcol,x[1],int(x[2])) for x in customgrouped.columns]
-        customgrouped.index = pd.to_datetime(customgrouped.index)
-        if not isinstance(custom,pd.DataFrame):
-            custom = customgrouped
-        else:
-            custom = pd.merge(custom,customgrouped, on='date')
-    return custom
+    return summarise_recodes(dataset,addedcols,quarterly=False,hourly=True)['appcoding_hourly']
 
 def summarise_appcoding_quarterly(dataset,addedcols):
-    custom = None
-    datelist = pd.date_range(start = np.min(dataset[columns.prep_datetime_start]).date(), end = np.max(dataset[columns.prep_datetime_end]).date(), freq='D')
-    for addedcol in addedcols:
-        catlist = list(Counter(dataset[addedcol]).keys())
-        dataset = dataset.fillna(value = {addedcol:"NA"})
-        customgrouped = dataset[['date',addedcol,'duration_minutes','hour','quarter']].groupby(['date',addedcol,'hour','quarter']).agg(sum)
-        customgrouped = utils.fill_appcat_quarterly(customgrouped,datelist,catlist).unstack([addedcol,'hour','quarter'])
-        customgrouped.columns = ["%s_%s_dur_h%i_q%i"%(addedcol,x[1],int(x[2]),int(x[3])) for x in customgrouped.columns]
-        customgrouped.index = pd.to_datetime(customgrouped.index)
-        if not isinstance(custom,pd.DataFrame):
-            custom = customgrouped
-        else:
-            custom = pd.merge(custom,customgrouped, on='date')
-    return custom
+    return summarise_recodes(dataset,addedcols,quarterly=True,hourly=False)['appcoding_quarterly']
+
+def sum_recodes(dataset, addedcols, splits):
+    '''
+    This function sums the duration per date, hour and quarter for all recode categories
+    at once: the data is grouped by all recode columns together, and the (much smaller)
+    sums are melted into one long key (the recode column and its category) and summed
+    again.  Apps that aren't recoded are in category "NA".  The duration of every split
+    (see summarise_daily_splits) is summed in a column named after the split.
+    '''
+    keys = ['date', 'hour', 'quarter']
+    durations = pd.DataFrame({name: dataset['duration_minutes'].where(mask) for name, mask in splits.items()}, index=dataset.index)
+    categories = [dataset[addedcol].fillna("NA").rename(i) for i, addedcol in enumerate(addedcols)]
+    grouped = durations.groupby([dataset[x] for x in keys] + categories).sum(min_count=1).reset_index()
+    # the recode columns are numbered, so their names can't clash with the other columns
+    stacked = grouped.melt(id_vars=keys + list(splits), value_vars=list(range(len(addedcols))),
+        var_name='recode', value_name='category')
+    return stacked.groupby(['date', 'recode', 'category', 'hour', 'quarter']).sum(min_count=1)
+
+@utils.profiled('summarise_recodes')
+def summarise_recodes(dataset,addedcols,quarterly=False,hourly=True,splits=None):
+    '''
+    This function summarises the duration per recode category: per day for every split
+    (by default all data, see summarise_daily_splits), and per hour and quarter for all
+    data.  All tables come from one sum of the stacked recode columns (see sum_recodes).
+    Returns a dictionary with appcoding_daily, appcoding_hourly, appcoding_quarterly
+    and appcoding_<split> for the other splits.
+    '''
+    addedcols = list(addedcols)
+    if splits is None:
+        splits = {'daily': pd.Series(True, index=dataset.index)}
+    summed = sum_recodes(dataset, addedcols, splits)
+    appcoding = {}
 
+    # only the categories that are used in a split get a column
+    daily = summed.groupby(level=['date', 'recode', 'category']).sum(min_count=1)
+    for name in splits:
+        customgrouped = daily[name].unstack(['recode', 'category']).dropna(how='all').dropna(axis=1, how='all')
+        customgrouped.columns = ["%s_%s_dur"%(addedcols[x[0]],x[1]) for x in customgrouped.columns]
+        customgrouped.index = pd.to_datetime(customgrouped.index)
+        appcoding['appcoding_%s'%name] = customgrouped
 
-def summarise_recodes(dataset,addedcols,quarterly=False,hourly=True):
-    appcoding = {}
+    if not (hourly or quarterly):
+        return appcoding
 
-    for addedcol in addedcols:
-        appcoding['appcoding_daily'] = summarise_appcoding_daily(dataset,addedcols)
-        if hourly:
-            appcoding['appcoding_hourly'] = summarise_appcoding_hourly(dataset,addedcols)
-        if quarterly:
-            appcoding['appcoding_quarterly'] = summarise_appcoding_quarterly(dataset,addedcols)
+    # per hour and quarter: all categories of all recode columns, days without usage are 0
+    datelist = pd.date_range(start = np.min(dataset[columns.prep_datetime_start]).date(), end = np.max(dataset[columns.prep_datetime_end]).date(), freq='D')
+    categories = summed.index.droplevel(['date', 'hour', 'quarter']).unique().sort_values()
+    if hourly:
+        hours = summed['daily'].groupby(level=['date', 'recode', 'category', 'hour']).sum()
+        wide = utils.fill_wide(hours.unstack(['recode', 'category', 'hour']), datelist,
+            [(i, cat, hour) for i, cat in categories for hour in range(24)])
+        wide.columns = ["%s_%s_dur_h%i"%(addedcols[x[0]],x[1],x[2]) for x in wide.columns]
+        appcoding['appcoding_hourly'] = wide
+    if quarterly:
+        wide = utils.fill_wide(summed['daily'].unstack(['recode', 'category', 'hour', 'quarter']), datelist,
+            [(i, cat, hour, quarter) for i, cat in categories for hour in range(24) for quarter in range(1,5)])
+        wide.columns = ["%s_%s_dur_h%i_q%i"%(addedcols[x[0]],x[1],x[2],x[3]) for x in wide.columns]
+        appcoding['appcoding_quarterly'] = wide
 
     return appcoding
@@ -1,4 +1,4 @@
-from . import utils, summarise_modalities
+from . import utils, summarise_modalities, dtypes
 from .constants import columns, interactions
 from collections import Counter
 from datetime import datetime
@@ -7,9 +7,11 @@ import numpy as np
 import os
 import re
 
+@utils.profiled('summarise_person')
 def summarise_person(preprocessed,personID = None, quarterly=False, splitweek = True, 
     weekdefinition = 'weekdayMF', recodefile=None, includestartend = False,
-    splitday = False, daytime = "10:00", nighttime = "22:00", maxdays = None
+    splitday = False, daytime = "10:00", nighttime = "22:00", maxdays = None,
+    recode = None
     ):
 
     # for now not using non-duration timepoints
@@ -24,10 +26,10 @@ def summarise_person(preprocessed,personID = None, quarterly=False, splitweek =
         utils.logger("WARNING: No data for %s..."%personID,level=1)
         return pd.DataFrame()
     
-    if isinstance(recodefile,str):
-        recode = pd.read_csv(recodefile,index_col='full_name').astype(str)
-        newcols = preprocessed.apply(lambda x: utils.recode(x,recode),axis=1)
-        preprocessed[recode.columns] = newcols
+    if recode is None and isinstance(recodefile,str):
+        recode = utils.read_recode(recodefile)
+    if recode is not None:
+        preprocessed = utils.recode_apps(preprocessed,recode)
 
     if splitweek:
         if np.sum(preprocessed[weekdefinition]==1)==0:
@@ -49,58 +51,52 @@ def summarise_person(preprocessed,personID = None, quarterly=False, splitweek =
     for col in engagecols:
         preprocessed[col] = preprocessed[col].astype(int)
 
-    data = {}
-    data['daily'] = summarise_modalities.summarise_daily(preprocessed,engagecols, datelist)
-    data['hourly'] = summarise_modalities.summarise_hourly(preprocessed,engagecols)
-
-    if len(noncustom) > 0:
-        appcoding = summarise_modalities.summarise_recodes(preprocessed,custom,quarterly=quarterly,hourly=True)
-        data.update(appcoding)
-
-    if quarterly:
-        data['quarterly'] = summarise_modalities.summarise_quarterly(preprocessed,engagecols)
+    # the flags are counted per day and hour (see dtypes.widen)
+    countcols = [x for x in preprocessed.columns if dtypes.is_integer_column(x) and (x == columns.switch_app or 'engage' in x)]
+    preprocessed = dtypes.widen(preprocessed.copy(), countcols)
 
+    # the subsets that are summarised per day, all in one pass
+    splits = {'daily': pd.Series(True, index=preprocessed.index)}
     if splitweek:
         if np.sum(preprocessed[weekdefinition]==1) > 0:
-            data['week'] = summarise_modalities.summarise_daily(preprocessed[preprocessed[weekdefinition]==1].reset_index(drop=True),engagecols, datelist)
-            data['week'].columns = ['%s'%x for x in data['week'].columns]
-            if len(custom) > 0:
-                weekapp = summarise_modalities.summarise_recodes(preprocessed[preprocessed[weekdefinition]==1],custom,quarterly=False,hourly=False)
-                data['appcoding_week'] = weekapp['appcoding_daily']
+            splits['week'] = preprocessed[weekdefinition]==1
         if np.sum(preprocessed[weekdefinition]==0) > 0:
-            data['weekend'] = summarise_modalities.summarise_daily(preprocessed[preprocessed[weekdefinition]==0].reset_index(drop=True),engagecols, datelist)
-            data['weekend'].columns = ['%s'%x for x in data['weekend'].columns]
-            if len(custom) > 0:
-                weekndapp = summarise_modalities.summarise_recodes(preprocessed[preprocessed[weekdefinition]==0],custom,quarterly=False,hourly=False)
-                data['appcoding_weekend'] = weekndapp['appcoding_daily']
+            splits['weekend'] = preprocessed[weekdefinition]==0
 
     if splitday:
         daytime_dt = datetime.strptime(daytime, "%H:%M") 
         nighttime_dt = datetime.strptime(nighttime, "%H:%M")
-    
+        starttime = preprocessed.app_start_timestamp.dt.time
+
         # daytime
-        daytime_df = preprocessed[(preprocessed.app_start_timestamp.dt.time > daytime_dt.time()) & (preprocessed.app_start_timestamp.dt.time < nighttime_dt.time())]
-        
-        if len(daytime_df) > 0:
-            data['daytime'] = summarise_modalities.summarise_daily(daytime_df.reset_index(drop=True),engagecols, datelist)
-            data['daytime'].columns = ['%s'%x for x in data['daytime'].columns]
-            if len(custom) > 0:
-                dayapp = summarise_modalities.summarise_recodes(daytime_df,custom,quarterly=False,hourly=False)
-                data['appcoding_daytime'] = dayapp['appcoding_daily']
+        isdaytime = (starttime > daytime_dt.time()) & (starttime < nighttime_dt.time())
+        if np.sum(isdaytime) > 0:
+            splits['daytime'] = isdaytime
         else:
             utils.logger("WARNING: No daytime data for %s..."%personID,level=1)
 
-        # nighttime
-        nighttime_df = preprocessed[(preprocessed.app_start_timestamp.dt.time < daytime_dt.time()) | (preprocessed.app_start_timestamp.dt.time > nighttime_dt.time())]
+        # nighttime (also summarised without nighttime data: the days are filled with 0's)
+        splits['nighttime'] = (starttime < daytime_dt.time()) | (starttime > nighttime_dt.time())
 
-        if len(nighttime) > 0:
-            data['nighttime'] = summarise_modalities.summarise_daily(nighttime_df.reset_index(drop=True),engagecols, datelist)
-            data['nighttime'].columns = ['%s'%x for x in data['nighttime'].columns]
-            if len(custom) > 0:
-                nightapp = summarise_modalities.summarise_recodes(nighttime_df,custom,quarterly=False,hourly=False)
-                data['appcoding_nighttime'] = nightapp['appcoding_daily']
-        else:
-            utils.logger("WARNING: No nighttime data for %s..."%personID,level=1)
+    data = {}
+    daily = summarise_modalities.summarise_daily_splits(preprocessed, engagecols, datelist, splits)
+    data['daily'] = daily['daily']
+    data['hourly'] = summarise_modalities.summarise_hourly(preprocessed,engagecols)
+
+    if len(custom) > 0:
+        appcoding = summarise_modalities.summarise_recodes(preprocessed, custom, quarterly=quarterly, hourly=True, splits=splits)
+        data['appcoding_daily'] = appcoding['appcoding_daily']
+        data['appcoding_hourly'] = appcoding['appcoding_hourly']
+        if quarterly:
+            data['appcoding_quarterly'] = appcoding['appcoding_quarterly']
+
+    if quarterly:
+        data['quarterly'] = summarise_modalities.summarise_quarterly(preprocessed,engagecols)
+
+    for name in [x for x in splits if x != 'daily']:
+        data[name] = daily[name]
+        if len(custom) > 0:
+            data['appcoding_%s'%name] = appcoding['appcoding_%s'%name]
 
     for key,values in data.items():
         # get appsperminute
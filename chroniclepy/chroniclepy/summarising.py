@@ -1,6 +1,8 @@
-from . import utils, summarise_person, summarise_app_categories, preprocessing
+from . import utils, summarise_person, summarise_app_categories, preprocessing, subsetting, manifest, dtypes
 from .constants import columns, interactions
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from collections import Counter
 from pytz import timezone
 import dateutil.parser
@@ -9,63 +11,180 @@ import numpy as np
 import os
 import re
 
+def get_personid(filenm):
+    return os.path.splitext(str(filenm).replace("ChronicleData_preprocessed_",""))[0]
+
+def summarise_file(filenm, infolder, filters={}, **kwargs):
+    '''
+    This function summarises a single preprocessed file (see summarise_preprocessed), for
+    every app filter (see subsetting.read_filters) when there are filters.  Returns the
+    results by filter name (None without filters).
+    '''
+    personID = get_personid(filenm)
+    utils.set_logtag(personID)
+    try:
+        utils.logger("LOG: Summarising file %s..."%filenm,level=1)
+        # files with intervals are split up in bins again (see preprocessing.to_intervals)
+        preprocessed = preprocessing.expand_intervals(utils.read_intermediate(os.path.join(infolder,filenm)))
+        return summarise_filtered(preprocessed, filenm, filters, **kwargs)
+    finally:
+        utils.set_logtag(None)
+
+def summarise_filtered(preprocessed, filenm, filters={}, **kwargs):
+    '''
+    This function summarises the preprocessed data of a person for every app filter (or
+    all data without filters).  The person is named after the subsetted file, as when
+    the subsetted files are summarised.  Returns the results by filter name.
+    '''
+    if len(filters) == 0:
+        return {None: summarise_preprocessed(preprocessed, get_personid(filenm), **kwargs)}
+    personID = get_personid(filenm.replace('ChronicleData_preprocessed','ChronicleData_subsetted'))
+    return {name: summarise_preprocessed(subsetting.filter_apps(preprocessed, appfilter), personID, **kwargs) \
+        for name, appfilter in filters.items()}
+
+def summarise_preprocessed(preprocessed, personID, includestartend=False, recode=None,
+    quarterly = False, splitweek = True, weekdefinition = 'weekdayMF',
+    splitday = False, daytime = "10:00", nighttime = "22:00", maxdays = None
+    ):
+    '''
+    This function summarises the preprocessed (or subsetted) data of a person.  It returns
+    the set of apps, the summary tables of the person and the app category percentages (or None).
+    '''
+    if not 'participant_id' in preprocessed.columns:
+        preprocessed['participant_id'] = personID
+
+    preprocessed = dtypes.compact(utils.backwards_compatibility(preprocessed))
+    preprocessed = preprocessed.dropna(subset=[columns.full_name])
+    preprocessed = preprocessing.add_preprocessed_columns(preprocessed)
+
+    apps = set(preprocessed[columns.full_name])
+    if preprocessed.shape[0] == 0:
+        return apps, {}, None
+    person = summarise_person.summarise_person(
+        preprocessed,
+        personID = personID,
+        quarterly = quarterly,
+        splitweek = splitweek,
+        weekdefinition = weekdefinition,
+        recode = recode,
+        includestartend = includestartend,
+        splitday = splitday,
+        daytime = daytime,
+        nighttime = nighttime,
+        maxdays = maxdays
+        )
+
+    app_percentages = None
+    if recode is not None:
+        app_percentages = summarise_app_categories.percentages(
+            preprocessed,
+            personID = personID,
+            recode = recode
+        )
+    return apps, dict(person.items()), app_percentages
+
 def summary(infolder, outfolder, includestartend=False, recodefile=None, 
     fullapplistfile=None, quarterly = False, 
     splitweek = True, weekdefinition = 'weekdayMF',
     splitday = False, daytime = "10:00", nighttime = "22:00",
-    maxdays = None
+    maxdays = None, workers = 1, force = False, subsetfile = None, removefile = None
     ):
+    '''
+    This function summarises all preprocessed files in a folder.  The results per file are
+    cached in the outfolder: files that didn't change since the last summary (with the same
+    parameters and recode file) aren't summarised again, unless force.  With a subset or
+    remove file, the apps are filtered while summarising (see subsetting.read_filters), in
+    a subfolder of the outfolder per subset when there's more than one.
+    '''
         
+    if workers < 1:
+        raise ValueError("The number of workers should be at least 1.")
+
     if not os.path.exists(outfolder):
-        os.mkdir(outfolder)
+        os.makedirs(outfolder)
 
-    files = [x for x in os.listdir(infolder) if x.startswith("Chronicle")]
+    # sorted, so that the tables are concatenated in the same order for any number of workers
+    files = sorted([x for x in os.listdir(infolder) if x.startswith("Chronicle")])
+    # the recode file is read once, for all participants
+    recode = utils.read_recode(recodefile) if isinstance(recodefile,str) else None
+    filters = subsetting.read_filters(subsetfile, removefile)
+    kwargs = dict(includestartend = includestartend, recode = recode, filters = filters,
+        quarterly = quarterly, splitweek = splitweek, weekdefinition = weekdefinition,
+        splitday = splitday, daytime = daytime, nighttime = nighttime, maxdays = maxdays)
 
-    allapps = set()
+    # reuse the results of files that were summarised before with the same parameters
+    cachefolder = os.path.join(outfolder, "summary_cache")
+    if not os.path.exists(cachefolder):
+        os.mkdir(cachefolder)
+    manifestfile = os.path.join(cachefolder, "summary_manifest.json")
+    parameters = {k: v for k,v in kwargs.items() if not k in ['recode', 'filters']}
+    for name, filename in [('recodefile', recodefile), ('subsetfile', subsetfile), ('removefile', removefile)]:
+        parameters[name] = manifest.get_hash(filename) if isinstance(filename,str) else None
+    previous = {} if force else manifest.read_manifest(manifestfile)
+    entries = {}
+    cached = {}
+    for filenm in files:
+        entry = previous.get(filenm)
+        cachefile = os.path.join(cachefolder, "%s.pkl"%filenm)
+        if manifest.is_unchanged(entry, os.path.join(infolder,filenm), parameters) and os.path.exists(cachefile):
+            try:
+                cached[filenm] = pd.read_pickle(cachefile)
+            except Exception:
+                # eg. truncated, or written by another version of pandas
+                utils.logger("WARNING: Could not read the cached summary of %s.  Summarising it again..."%filenm)
+                continue
+            entry['mtime'] = os.stat(os.path.join(infolder,filenm)).st_mtime
+            entries[filenm] = entry
+    if len(cached) > 0:
+        utils.logger("LOG: Reusing the summaries of %i files that didn't change..."%len(cached),level=1)
+    todo = [x for x in files if not x in cached]
+    newentries = {filenm: manifest.get_entry(os.path.join(infolder,filenm), parameters) for filenm in todo}
 
-    full = {}
-    appcat = pd.DataFrame()
-    
-    for idx,filenm in enumerate(files):
-        utils.logger("LOG: Summarising file %s..."%filenm,level=1)
-        preprocessed = pd.read_csv(os.path.join(infolder,filenm))
-        personID = str(filenm).replace("ChronicleData_preprocessed_","").replace(".csv", "")
-        if not 'participant_id' in preprocessed.columns:
-            preprocessed['participant_id'] = personID
-
-        preprocessed = utils.backwards_compatibility(preprocessed)
-        preprocessed = preprocessed.dropna(subset=[columns.full_name])
-        preprocessed = preprocessing.add_preprocessed_columns(preprocessed)
-
-        allapps = allapps.union(set(preprocessed[columns.full_name]))
-        if preprocessed.shape[0] == 0:
-            continue
-        person = summarise_person.summarise_person(
-            preprocessed,
-            personID = personID,
-            quarterly = quarterly,
-            splitweek = splitweek,
-            weekdefinition = weekdefinition,
-            recodefile = recodefile,
-            includestartend = includestartend,
-            splitday = splitday,
-            daytime = daytime,
-            nighttime = nighttime,
-            maxdays = maxdays
-            )
+    if workers == 1 or len(todo) <= 1:
+        computed = [summarise_file(filenm, infolder, **kwargs) for filenm in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as executor:
+            computed = list(executor.map(partial(summarise_file, infolder=infolder, **kwargs), todo))
+
+    for filenm, result in zip(todo, computed):
+        pd.to_pickle(result, os.path.join(cachefolder, "%s.pkl"%filenm))
+        cached[filenm] = result
+        entries[filenm] = newentries[filenm]
+    manifest.write_manifest(entries, manifestfile)
+    write_summaries([cached[filenm] for filenm in files], outfolder, filters, recode=recode, fullapplistfile=fullapplistfile)
+
+def write_summaries(results, outfolder, filters={}, recode=None, fullapplistfile=None):
+    '''
+    This function writes the summary of every app filter (see summarise_filtered), in a
+    subfolder per filter when there's more than one (see subsetting.get_folder), with the
+    name of the filter added to the full app list.
+    '''
+    for name in list(filters) or [None]:
+        applistfile = fullapplistfile
+        if isinstance(fullapplistfile,str) and len(filters) > 1:
+            applistfile = "%s_%s%s"%(os.path.splitext(fullapplistfile)[0], name, os.path.splitext(fullapplistfile)[1])
+        write_summary([x[name] for x in results], subsetting.get_folder(outfolder, name, filters),
+            recode=recode, fullapplistfile=applistfile)
+
+def write_summary(results, outfolder, recode=None, fullapplistfile=None):
+    '''
+    This function combines the summaries of all persons (see summarise_preprocessed) and
+    writes the summary tables to the outfolder.
+    '''
+    if not os.path.exists(outfolder):
+        os.mkdir(outfolder)
+
+    allapps = set()
+    tables = {}
+    appcat = []
+    for apps, person, app_percentages in results:
+        allapps = allapps.union(apps)
         for k,v in person.items():
-            if not k in full.keys():
-                full[k] = v
-            else:
-                full[k] = pd.concat([full[k],person[k]],sort=True)
-
-        if recodefile:
-            app_percentages = summarise_app_categories.percentages(
-                preprocessed,
-                personID = personID,
-                recodefile = recodefile         
-            )
-            appcat = appcat.append(app_percentages, ignore_index=True)        
+            tables.setdefault(k, []).append(v)
+        if app_percentages is not None:
+            appcat.append(app_percentages)
+
+    full = {k: pd.concat(v,sort=True) for k,v in tables.items()}
 
     aggfuncs = {
         "daily":                ['mean','std'],
@@ -75,6 +194,7 @@ def summary(infolder, outfolder, includestartend=False, recodefile=None,
         'quarterly':            ['mean','std'],
         "hourly":               ['mean'],
         'appcoding_hourly':     ['mean'],
+        'appcoding_quarterly':  ['mean'],
         'appcoding_week':       ['mean'],
         'appcoding_weekend':    ['mean'],
         'daytime':              ['mean', 'std'],
@@ -92,13 +212,13 @@ def summary(infolder, outfolder, includestartend=False, recodefile=None,
         summary.to_csv(os.path.join(outfolder,"summary_%s.csv"%(k)))
 
     if isinstance(fullapplistfile,str):
-        fullapplist = pd.DataFrame({"full_name": list(allapps)})
-        if isinstance(recodefile,str):
-            recode = pd.read_csv(recodefile,index_col='full_name').astype(str)
+        fullapplist = pd.DataFrame({"full_name": sorted(allapps)})
+        if recode is not None:
             fullapplist = pd.merge(fullapplist,recode,left_on='full_name',right_index=True,how='outer')
         fullapplist.to_csv(fullapplistfile,index=False)
     
-    if recodefile:
+    if recode is not None and len(appcat) > 0:
+        appcat = pd.concat(appcat, ignore_index=True)
         addedcol = list(set(appcat)-set(['count', 'percentage', 'personID']))[0]
         appcat = appcat.pivot(index="personID", columns = addedcol, values = 'percentage')
         appcat.to_csv(os.path.join(outfolder, "summary_appcoding_percentages.csv"))
@@ -1,12 +1,20 @@
 from datetime import datetime, timedelta, timezone
 from .constants import columns, interactions
+from . import dtypes
 from collections import Counter
+from contextlib import contextmanager
 import dateutil.parser
 import pandas as pd
 import numpy as np
+import cProfile
+import functools
+import itertools
+import json
 import pytz
 import os
 import re
+import time
+import tracemalloc
 
 def get_dt(row):
     '''
@@ -22,96 +30,349 @@ def get_dt(row):
     # localtime = localtime.replace(microsecond = microsecond)
     return localtime
 
-def get_action(row):
+NS_SECOND = 10**9
+NS_MINUTE = 60 * NS_SECOND
+NS_HOUR = 60 * NS_MINUTE
+NS_DAY = 24 * NS_HOUR
+
+def get_timezones(timestamps):
+    '''
+    This function returns the name of the timezone of each timestamp in a series.
+    Timestamps in different timezones are stored as objects rather than datetimes.
+    '''
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        return np.full(len(timestamps), str(timestamps.dt.tz), dtype=object)
+    return np.array([None if pd.isna(x) else str(x.tzinfo) for x in timestamps], dtype=object)
+
+def get_utc_ns(timestamps):
+    '''
+    This function transforms a series of timezone aware timestamps to nanoseconds since epoch.
+    '''
+    return pd.to_datetime(timestamps, utc=True).values.view('int64')
+
+def get_local_ns(utc_ns, zones):
+    '''
+    This function transforms nanoseconds since epoch to nanoseconds since epoch on the
+    local clock (i.e. shifted by the utc offset of the timezone at that moment).
+    '''
+    local_ns = np.array(utc_ns, dtype='int64')
+    for zone in pd.unique(zones):
+        subset = zones == zone
+        local_ns[subset] = pd.DatetimeIndex(local_ns[subset].view('datetime64[ns]'))\
+            .tz_localize('UTC').tz_convert(pytz.timezone(zone)).tz_localize(None).asi8
+    return local_ns
+
+def to_timestamps(utc_ns, zones):
+    '''
+    This function transforms nanoseconds since epoch back to timestamps in their timezone.
+    When there is more than one timezone, the timestamps are returned as objects.
+    '''
+    utc = pd.DatetimeIndex(np.array(utc_ns, dtype='int64').view('datetime64[ns]')).tz_localize('UTC')
+    zoneset = pd.unique(zones)
+    if len(zoneset) == 0:
+        return utc
+    if len(zoneset) == 1:
+        return utc.tz_convert(pytz.timezone(zoneset[0]))
+    timestamps = np.empty(len(utc), dtype=object)
+    for zone in zoneset:
+        subset = zones == zone
+        timestamps[subset] = utc[subset].tz_convert(pytz.timezone(zone)).astype(object)
+    return timestamps
+
+utcoffset_pattern = r'^([+-])(\d\d):(\d\d)$'
+
+def parse_utcoffset(offset):
+    '''
+    This function returns the number of minutes of a utc offset (eg. "-07:00"),
+    or 0 when there is no offset.
+    '''
+    match = re.match(utcoffset_pattern, offset)
+    if not match:
+        return 0
+    minutes = int(match.group(2)) * 60 + int(match.group(3))
+    return -minutes if match.group(1) == '-' else minutes
+
+def get_local_timestamps(timestamps, utcoffsets=None):
+    '''
+    This function returns timestamps on the local clock (without timezone), from
+    timestamps in a timezone, timestamps in different timezones (objects) or
+    strings with a utc offset (as written in the preprocessed csv files).
+    When the utc offsets (in minutes) are given, they are added to the utc time.
+    '''
+    timestamps = pd.Series(timestamps)
+    if utcoffsets is not None:
+        utc = pd.to_datetime(timestamps, utc=True).dt.tz_localize(None)
+        return utc + pd.to_timedelta(np.asarray(utcoffsets), unit='m')
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        return timestamps.dt.tz_localize(None)
+    if pd.api.types.is_datetime64_dtype(timestamps.dtype):
+        return timestamps
+    observed = timestamps.dropna()
+    if len(observed) == 0:
+        return pd.to_datetime(timestamps)
+    if isinstance(observed.iloc[0], str):
+        suffix = timestamps.str.slice(-6)
+        if all(re.match(utcoffset_pattern, x) for x in pd.unique(suffix.dropna())):
+            return pd.to_datetime(timestamps.str.slice(0, -6))
+        return pd.to_datetime(timestamps.str.replace(r'(Z|[+-]\d\d:?\d\d)$', '', regex=True))
+    utc_ns = get_utc_ns(timestamps)
+    zones = np.array(['UTC' if x is None else x for x in get_timezones(timestamps)], dtype=object)
+    local_ns = np.where(timestamps.isna(), utc_ns, get_local_ns(utc_ns, zones))
+    return pd.Series(local_ns.view('datetime64[ns]'), index=timestamps.index)
+
+def get_utcoffsets(timestamps):
+    '''
+    This function returns the utc offset (in minutes) of timestamps in a timezone,
+    timestamps in different timezones (objects) or strings with a utc offset.
+    For strings, the offset is read from the string (which is faster than parsing).
+    '''
+    timestamps = pd.Series(timestamps)
+    observed = timestamps.dropna()
+    if timestamps.dtype == object and len(observed) > 0 and isinstance(observed.iloc[0], str):
+        # there are only a few different offsets, so they are parsed once
+        suffix = timestamps.str.slice(-6)
+        offsets = {x: parse_utcoffset(x) for x in pd.unique(suffix.dropna())}
+        return suffix.map(offsets).astype(float).values
+    utc = pd.to_datetime(timestamps, utc=True).dt.tz_localize(None)
+    return ((get_local_timestamps(timestamps) - utc) // pd.Timedelta(minutes=1)).values
+
+def format_date(local_ns):
+    '''
+    This function formats local nanoseconds since epoch as "%Y-%m-%d".
+    '''
+    return np.datetime_as_string(np.array(local_ns, dtype='int64').view('datetime64[ns]'), unit='D').astype(object)
+
+def format_time(local_ns):
+    '''
+    This function formats local nanoseconds since epoch as "%H:%M:%S.%f".
+    '''
+    strings = np.datetime_as_string(np.array(local_ns, dtype='int64').view('datetime64[ns]'), unit='us')
+    return pd.Series(strings, dtype=object).str.slice(11).values
+
+def get_dt_vectorized(datelogged, zones):
+    '''
+    This function transforms the reported (string) datetimes to timestamps all at once:
+    the (UTC) datetimes are parsed together and converted to the local time per timezone.
+    When there is more than one timezone, the timestamps are returned as objects.
+    '''
+    zulutime = pd.to_datetime(datelogged, utc=True)
+    return to_timestamps(zulutime.values.view('int64'), np.asarray(zones, dtype=object))
+
+def get_action(record_types):
     '''
     This function creates a column with a value 0 for foreground action, 1 for background
     action.  This can be used for sorting (when times are equal: foreground before background)
     '''
-    if row[columns.raw_record_type]== 'Move to Foreground':
-        return 0
-    if row[columns.raw_record_type]== 'Move to Background':
-        return 1
+    return record_types.map({interactions.foreground: 0, interactions.background: 1})
+
+def read_recode(recodefile):
+    '''
+    This function reads the recode file: a table indexed by the app name (full_name),
+    with one column per recoding.
+    '''
+    recode = pd.read_csv(recodefile,index_col='full_name').astype(str)
+    duplicated = recode.index[recode.index.duplicated()]
+    if len(duplicated) > 0:
+        raise ValueError("There's an issue with the appcoding file: apps are defined more than once (%s)."%", ".join(map(str, duplicated.unique())))
+    return recode
 
-def recode(row,recode):
-    newcols = {x:None for x in recode.columns}
-    if row[columns.full_name] in recode.index:
-        for col in recode.columns:
-            newcols[col] = recode[col][row[columns.full_name]]
+def recode_apps(data,recode):
+    '''
+    This function adds the recode columns to the data, in one lookup for all rows:
+    the app names are coded as categories of the recode table, and the codes select
+    the rows of the table.  Apps that are not in the table get None.
+    '''
+    codes = pd.Categorical(data[columns.full_name], categories=recode.index).codes
+    lookup = np.vstack([recode.values.astype(object), np.full((1, len(recode.columns)), None, dtype=object)])
+    newcols = pd.DataFrame(lookup[codes], columns=recode.columns, index=data.index)
+    data = data.drop(columns=[x for x in recode.columns if x in data.columns])
+    return pd.concat([data, newcols], axis=1)
 
-    return pd.Series(newcols)
+logtag = None
+
+def set_logtag(tag=None):
+    '''
+    This function sets a tag (eg. the participant) that is added to all log lines,
+    so that lines from files processed in parallel can be told apart.
+    '''
+    global logtag
+    logtag = tag
 
 def logger(message,level=1):
     time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
     prefix = "༼ つ ◕_◕ ༽つ" if level==0 else "-- "
-    print("%s %s: %s"%(prefix,time,message))
+    tag = "" if logtag is None else "[%s] "%logtag
+    # one write per line, so lines from parallel processes are not mixed up
+    print("%s %s: %s%s\n"%(prefix,time,tag,message), end="", flush=True)
 
-def fill_dates(dataset,datelist):
+# the profiling settings are environment variables, so that worker processes have them too
+profile_variable = 'CHRONICLEPY_PROFILE'
+profile_dir_variable = 'CHRONICLEPY_PROFILE_DIR'
+# the peak memory of the stages that are running (nested stages)
+running_stages = []
+profile_count = itertools.count()
+
+def start_profiling(filename, profiledir=None):
     '''
-    This function checks for empty days and fills them with 0's.
+    This function turns on the profiling of the stages (see profile_stage): a json line per
+    stage is written to filename (which is emptied first).  With profiledir, a cProfile dump
+    is written for every stage that isn't part of another stage.  Profiling makes the
+    processing slower (mostly to trace the memory).
     '''
-    for date in datelist:
-        if not date in dataset.index:
-            newrow = pd.Series({k:0 for k in dataset.columns}, name=date)
-            dataset = dataset.append(newrow)
-    return dataset
+    open(filename, 'w').close()
+    os.environ[profile_variable] = os.path.abspath(filename)
+    if profiledir is not None:
+        os.makedirs(profiledir, exist_ok=True)
+        os.environ[profile_dir_variable] = os.path.abspath(profiledir)
+    else:
+        os.environ.pop(profile_dir_variable, None)
 
+def stop_profiling():
+    os.environ.pop(profile_variable, None)
+    os.environ.pop(profile_dir_variable, None)
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
 
-def fill_hours(dataset,datelist):
+@contextmanager
+def profile_stage(stage, rows=None):
     '''
-    This function checks for empty days/hours and fills them with 0's.
+    This context manager records a stage when profiling is on: the wall and cpu time, the
+    peak memory above the memory at the start (of the allocations of python and numpy,
+    see tracemalloc) and the number of rows in (rows) and out (set 'rows_out' on the
+    dictionary that is yielded).  The records have the participant (see set_logtag).
     '''
-    for date in datelist:
-        datestr = date.strftime("%Y-%m-%d")
-        for hour in range(24):
-            multind = (datestr,hour)
-            if not multind in dataset.index:
-                newrow = pd.Series({k:0 for k in dataset.columns}, name=multind)
-                dataset = dataset.append(newrow)
-    return dataset
+    record = {'stage': stage, 'participant': logtag, 'rows_in': rows, 'rows_out': None}
+    filename = os.environ.get(profile_variable)
+    if filename is None:
+        yield record
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if len(running_stages) > 0:
+        running_stages[-1] = max(running_stages[-1], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    memory = tracemalloc.get_traced_memory()[0]
+    running_stages.append(memory)
+    profiledir = os.environ.get(profile_dir_variable)
+    # profilers can't be nested, so the outer stage has the profile of the inner stages
+    profiler = cProfile.Profile() if profiledir is not None and len(running_stages) == 1 else None
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.process_time() - cpu
+        peak = max(running_stages.pop(), tracemalloc.get_traced_memory()[1])
+        if len(running_stages) > 0:
+            running_stages[-1] = max(running_stages[-1], peak)
+        record['peak_mb'] = (peak - memory) / 2.**20
+        record['pid'] = os.getpid()
+        # one write per line (see logger)
+        with open(filename, 'a') as fl:
+            fl.write(json.dumps(record) + "\n")
+        if profiler is not None:
+            profiler.dump_stats(os.path.join(profiledir, "%s_%s_%i_%i.prof"%(
+                stage, logtag or "all", os.getpid(), next(profile_count))))
 
-def fill_quarters(dataset,datelist):
+def count_rows(result):
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, tuple) and len(result) > 0:
+        return count_rows(result[0])
+    if isinstance(result, dict):
+        return sum(len(x) for x in result.values() if isinstance(x, pd.DataFrame))
+    return None
+
+def profiled(stage):
     '''
-    This function checks for empty days/hours/quarters and fills them with 0's.
+    This decorator profiles a function as a stage (see profile_stage): the rows in are the
+    rows of the first argument, the rows out the rows of the result (of the tables in a
+    dictionary, or of the first element of a tuple).
     '''
-    for date in datelist:
-        datestr = date.strftime("%Y-%m-%d")
-        for hour in range(24):
-            for quarter in range(1,5):
-                multind = (datestr,hour,quarter)
-                if not multind in dataset.index:
-                    newrow = pd.Series({k:0 for k in dataset.columns}, name=multind)
-                    dataset = dataset.append(newrow)
-    return dataset
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profile_variable in os.environ:
+                return function(*args, **kwargs)
+            with profile_stage(stage, count_rows(args[0]) if len(args) > 0 else None) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = count_rows(result)
+            return result
+        return wrapper
+    return decorator
 
-def fill_appcat_hourly(dataset,datelist,catlist):
+def profile_summary(filename):
     '''
-    This function checks for empty days/hours and fills them with 0's for all categories.
+    This function sums the profile of all stages (a json line per stage, see start_profiling)
+    per stage: the number of calls, the times, the rows and the largest peak memory.
     '''
-    for date in datelist:
-        datestr = date.strftime("%Y-%m-%d")
-        for hour in range(24):
-            for cat in catlist:
-                multind = (datestr,str(cat),hour)
-                if not multind in dataset.index:
-                    newrow = pd.Series({k:0 for k in dataset.columns}, name=multind)
-                    dataset = dataset.append(newrow)
-    return dataset
+    with open(filename, 'r') as fl:
+        records = pd.DataFrame([json.loads(line) for line in fl])
+    if len(records) == 0:
+        return records
+    summary = records.groupby('stage').agg(
+        calls = ('stage', 'size'),
+        participants = ('participant', 'nunique'),
+        wall_s = ('wall_s', 'sum'),
+        cpu_s = ('cpu_s', 'sum'),
+        rows_in = ('rows_in', 'sum'),
+        rows_out = ('rows_out', 'sum'),
+        peak_mb = ('peak_mb', 'max'))
+    return summary.sort_values('wall_s', ascending=False)
 
-def fill_appcat_quarterly(dataset,datelist,catlist):
+def fill_index(dataset,datelist,*levels):
     '''
-    This function checks for empty days/hours/quarters and fills them with 0's for all categories.
+    This function fills all missing combinations of dates and the other index levels
+    (eg. categories, hours, quarters) with 0's, in one reindex on the product.
+    The date level is compared as (timezone-naive) timestamps.
+    '''
+    dates = pd.DatetimeIndex(pd.to_datetime(list(datelist)))
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+    if dataset.index.nlevels == 1:
+        dataset.index = pd.DatetimeIndex(pd.to_datetime(list(dataset.index)), name=dataset.index.name)
+        full = dates.rename(dataset.index.name)
+    else:
+        dataset.index = dataset.index.set_levels(pd.to_datetime(list(dataset.index.levels[0])), level=0)
+        full = pd.MultiIndex.from_product([dates] + [list(x) for x in levels], names=dataset.index.names)
+    return dataset.reindex(dataset.index.union(full), fill_value=0)
+
+def fill_wide(dataset,datelist,columns):
     '''
-    for date in datelist:
-        datestr = date.strftime("%Y-%m-%d")
-        for hour in range(24):
-            for quarter in range(1,5):
-                for cat in catlist:
-                    multind = (datestr,str(cat),hour,quarter)
-                    if not multind in dataset.index:
-                        newrow = pd.Series({k:0 for k in dataset.columns}, name=multind)
-                        dataset = dataset.append(newrow)
+    This function is fill_index for a table that is already unstacked (one row per date):
+    the table gets all columns, and all days of the datelist, filled with 0's.
+    '''
+    dates = pd.DatetimeIndex(pd.to_datetime(list(datelist)))
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+    dataset.index = pd.DatetimeIndex(pd.to_datetime(list(dataset.index)), name=dataset.index.name)
+    dataset = dataset.reindex(index=dataset.index.union(dates), columns=pd.MultiIndex.from_tuples(columns, names=dataset.columns.names))
+    filled = dataset.index.isin(dates)
+    dataset.loc[filled] = dataset.loc[filled].fillna(0)
     return dataset
 
+def fill_dates(dataset,datelist):
+    '''
+    This function checks for empty days and fills them with 0's.
+    '''
+    return fill_index(dataset,datelist)
+
+def fill_hours(dataset,datelist):
+    '''
+    This function checks for empty days/hours and fills them with 0's.
+    '''
+    return fill_index(dataset,datelist,range(24))
+
+def fill_quarters(dataset,datelist):
+    '''
+    This function checks for empty days/hours/quarters and fills them with 0's.
+    '''
+    return fill_index(dataset,datelist,range(24),range(1,5))
+
 
 def cut_first_last(dataset, includestartend, maxdays, first, last):
     first_parsed = dateutil.parser.parse(str(first))
@@ -136,7 +397,7 @@ def cut_first_last(dataset, includestartend, maxdays, first, last):
         
     if maxdays is not None:
         last_cutoff = first_cutoff + timedelta(days = maxdays)
-        last_day = (first_cutoff + timedelta(days = maxdays)).replace(tzinfo = first_obs.tzinfo)
+        last_day = (first_cutoff + timedelta(days = maxdays - 1)).replace(tzinfo = first_obs.tzinfo)
     
     if (len(dataset[columns.prep_datetime_end]) == 0):
         datelist = []
@@ -147,27 +408,32 @@ def cut_first_last(dataset, includestartend, maxdays, first, last):
         )
         datelist = pd.date_range(start = first_cutoff, end = enddate_fix, freq='D')
     
+    # keep all usage up to the end of the last day
     dataset = dataset[
         (dataset[columns.prep_datetime_start] >= first_cutoff) & \
-        (dataset[columns.prep_datetime_end] <= last_day)].reset_index(drop=True)
+        (dataset[columns.prep_datetime_end] < last_day + timedelta(days=1))].reset_index(drop=True)
             
     return dataset, datelist
 
 def add_session_durations(dataset):
+    '''
+    This function adds the duration (in minutes) of the session to each row: the time
+    between the start of the first and the end of the last row of the session.
+    Sessions are numbered by counting the session starts, rows before the first start
+    are a session on their own.
+    '''
     engagecols = [x for x in dataset.columns if x.startswith('engage')]
+    if len(engagecols) == 0 or len(dataset) == 0:
+        return dataset
+    starttimes = np.array(dataset[columns.prep_datetime_start], dtype='datetime64[ns]')
+    endtimes = np.array(dataset[columns.prep_datetime_end], dtype='datetime64[ns]')
+    position = pd.Series(np.arange(len(dataset)))
     for sescol in engagecols:
         newcol = '%s_dur'%sescol
-        sesids = np.where(dataset[sescol]==1)[0][1:]
-        starttimes = np.array(dataset[columns.prep_datetime_start].loc[np.append([0], sesids)][:-1], dtype='datetime64[ns]')
-        endtimes = np.array(dataset[columns.prep_datetime_end].loc[sesids-1], dtype='datetime64[ns]')
-        durs = (endtimes-starttimes)/ np.timedelta64(1, 'm')
-        dataset[newcol] = 0
-        for idx,sesid in enumerate(np.append([0],sesids)):
-            if idx == len(sesids):
-                continue
-            lower = sesid
-            upper = len(dataset) if idx == len(sesids)-1 else sesids[idx+1]
-            dataset.loc[np.arange(lower,upper),newcol] = durs[idx]
+        sessions = (dataset[sescol].fillna(0).values == 1).cumsum()
+        first = position.groupby(sessions).transform('min').values
+        last = position.groupby(sessions).transform('max').values
+        dataset[newcol] = (endtimes[last] - starttimes[first]) / np.timedelta64(1, 'm')
     return dataset
 
 def backwards_compatibility(dataframe):
@@ -191,6 +457,157 @@ def backwards_compatibility(dataframe):
     )
     return dataframe
 
+intermediate_formats = ['csv', 'parquet']
+
+@profiled('read_intermediate')
+def read_intermediate(filename):
+    '''
+    This function reads a preprocessed or subsetted file, as csv or parquet
+    depending on the extension.  The categories of a parquet file are sorted, whatever
+    order they were written in (see append_intermediate).
+    '''
+    if filename.endswith('.parquet'):
+        data = pd.read_parquet(filename)
+        for col in data.columns[(data.dtypes == 'category').values]:
+            data[col] = data[col].cat.reorder_categories(sorted(data[col].cat.categories))
+        return data
+    return pd.read_csv(filename)
+
+def write_intermediate(data, filename, format='csv'):
+    '''
+    This function writes a preprocessed or subsetted file, replacing the extension
+    of the filename by the format.  In parquet, the timestamps are stored as
+    timestamps and the app names as categories, so they don't need to be parsed
+    again when read.  Timestamps are stored in UTC, with their utc offset in a
+    separate column (so timestamps in different timezones fit in one column).
+    '''
+    if not format in intermediate_formats:
+        raise ValueError("Unknown intermediate format %s: should be one of %s"%(format, ", ".join(intermediate_formats)))
+    filename = "%s.%s"%(os.path.splitext(filename)[0], format)
+    if format == 'csv':
+        dtypes.output(data).to_csv(filename, index=False)
+        return filename
+    writer = start_intermediate(filename, format)
+    append_intermediate(data, writer)
+    return finish_intermediate(writer)
+
+def to_parquet_columns(data):
+    '''
+    This function transforms the timestamps to UTC with a column for their utc offset,
+    and the app names to categories (see write_intermediate).
+    '''
+    data = data.copy()
+    for col in [columns.prep_datetime_start, columns.prep_datetime_end]:
+        if col in data.columns and not utcoffset_column(col) in data.columns:
+            data[utcoffset_column(col)] = np.asarray(get_utcoffsets(data[col]), dtype='float32')
+            data[col] = pd.to_datetime(data[col], utc=True)
+    for col in [columns.full_name, columns.title]:
+        if col in data.columns:
+            data[col] = data[col].astype('category')
+    return data
+
+def get_parquet_schema(data):
+    '''
+    This function returns the parquet schema of a preprocessed file (see to_parquet_columns),
+    with fixed types for the known columns, so that parts of a file written one after the
+    other (see append_intermediate) have the same types.
+    '''
+    import pyarrow as pa
+    fields = []
+    for field in pa.Schema.from_pandas(data, preserve_index=False):
+        if field.name in [columns.prep_datetime_start, columns.prep_datetime_end]:
+            field = field.with_type(pa.timestamp('ns', tz='UTC'))
+        elif field.name.endswith('_utcoffset'):
+            field = field.with_type(pa.float32())
+        elif field.name in [columns.full_name, columns.title]:
+            field = field.with_type(pa.dictionary(pa.int32(), pa.string()))
+        elif field.name == columns.flags:
+            field = field.with_type(pa.list_(pa.string()))
+        elif dtypes.is_integer_column(field.name):
+            field = field.with_type(pa.int64())
+        elif field.name == columns.prep_duration_seconds:
+            field = field.with_type(pa.float64())
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+def start_intermediate(filename, format='csv', keep=0, offset=None):
+    '''
+    This function starts writing a preprocessed file in parts (see append_intermediate),
+    after the first rows (keep) of the existing file.  In csv, the file is cut after these
+    rows (at offset, in bytes) and appended to, in parquet a new file is written (next to
+    the existing one until finish_intermediate) and these rows are copied.  Returns the writer.
+    '''
+    if not format in intermediate_formats:
+        raise ValueError("Unknown intermediate format %s: should be one of %s"%(format, ", ".join(intermediate_formats)))
+    filename = "%s.%s"%(os.path.splitext(filename)[0], format)
+    writer = {'filename': filename, 'format': format, 'header': None, 'parquet': None}
+    if keep > 0 and format == 'csv':
+        writer['header'] = list(pd.read_csv(filename, nrows=0).columns)
+        with open(filename, 'r+') as fl:
+            fl.truncate(offset)
+    elif keep > 0:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        previous = pq.ParquetFile(filename)
+        writer['parquet'] = pq.ParquetWriter(filename + '.tmp', previous.schema_arrow)
+        for batch in previous.iter_batches():
+            batch = batch.slice(0, keep)
+            writer['parquet'].write_table(pa.Table.from_batches([batch]))
+            keep -= batch.num_rows
+            if keep == 0:
+                break
+    elif os.path.exists(filename):
+        os.remove(filename)
+    return writer
+
+def append_intermediate(data, writer):
+    '''
+    This function appends rows to a preprocessed file that is written in parts (see
+    start_intermediate).  The file (and in csv the header) is created with the first rows.
+    Returns the size of the file after the rows (in bytes) in csv, to cut it there later.
+    All parts are written with the same dtypes (see dtypes.output).
+    '''
+    data = dtypes.output(data)
+    if writer['format'] == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        data = to_parquet_columns(data)
+        if writer['parquet'] is None:
+            writer['parquet'] = pq.ParquetWriter(writer['filename'] + '.tmp', get_parquet_schema(data))
+        elif len(data) == 0:
+            return None
+        schema = writer['parquet'].schema
+        data = data.reindex(columns=schema.names)
+        writer['parquet'].write_table(pa.Table.from_pandas(data, schema=schema, preserve_index=False))
+        return None
+    if writer['header'] is None:
+        writer['header'] = list(data.columns)
+        data.to_csv(writer['filename'], index=False)
+    else:
+        extra = [x for x in data.columns if not x in writer['header']]
+        if len(extra) > 0:
+            raise ValueError("Can't append columns %s to %s"%(", ".join(extra), writer['filename']))
+        data.reindex(columns=writer['header']).to_csv(writer['filename'], index=False, header=False, mode='a')
+    return os.path.getsize(writer['filename'])
+
+def finish_intermediate(writer):
+    '''
+    This function finishes a preprocessed file that is written in parts (see start_intermediate).
+    Returns the filename, or None when no rows were written.
+    '''
+    if writer['parquet'] is not None:
+        writer['parquet'].close()
+        os.replace(writer['filename'] + '.tmp', writer['filename'])
+        return writer['filename']
+    if writer['format'] == 'parquet' or writer['header'] is None:
+        return None
+    return writer['filename']
+
+def utcoffset_column(col):
+    return "%s_utcoffset"%col
+
 def round_down_to_quarter(x):
     if pd.isna(x):
         return None
@@ -206,12 +623,14 @@ def combine_flags(row):
     return flags
 
 
+@profiled('add_warnings')
 def add_warnings(df):
-    df['no_usage'] = pd.to_datetime(df[columns.prep_datetime_start], utc=True) - \
+    # the first row of a participant has no usage before (see preprocessing.preprocess_cohort)
+    df['no_usage'] = (pd.to_datetime(df[columns.prep_datetime_start], utc=True) - \
                      pd.to_datetime(df[columns.prep_datetime_end].shift(), utc= True) > \
-                     timedelta(days=1)
+                     timedelta(days=1)) & (df['participant_id'] == df['participant_id'].shift())
     df['long_usage'] = df[columns.prep_duration_seconds] > 3 * 60 * 60
-    df[columns.flags] = df.apply(combine_flags, axis=1)
+    df[columns.flags] = [combine_flags(row) for row in df[['no_usage', 'long_usage']].itertuples(index=False)]
     df = df.drop(['no_usage', 'long_usage'], axis=1)
     return df
 
@@ -1,7 +1,7 @@
 from setuptools import setup, find_packages
 
 setup(name='chroniclepy',
-      version='1.7',
+      version='1.9',
       description='Package for preprocessing Chronicle data.',
       author='OpenLattice',
       author_email='info@openlattice.com',
@@ -9,5 +9,11 @@ setup(name='chroniclepy',
       install_requires=[
           'pandas>0.15.0',
           ],
-      packages = find_packages(),
+      extras_require={
+          'parquet': ['pyarrow'],
+          },
+      packages = find_packages(exclude=['benchmarks', 'benchmarks.*']),
+      entry_points={
+          'console_scripts': ['chroniclepy=chroniclepy.cli:main'],
+          },
       zip_safe=False)
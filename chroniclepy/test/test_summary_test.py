@@ -1,5 +1,37 @@
-from chroniclepy.chroniclepy import summarising, preprocessing, subsetting
+from chroniclepy.chroniclepy import summarising, summarise_modalities, preprocessing, subsetting, pipeline, utils, dtypes
+from chroniclepy.benchmarks import bench, generate
+import pandas as pd
 import unittest
+import importlib.util
+import subprocess
+import sys
+import tempfile
+import yaml
+import os
+
+def raw_events():
+    events = [
+        ('Move to Foreground', '2020-03-07T20:00:00.000Z', 'com.Slack'),
+        ('Move to Background', '2020-03-07T20:20:00.000Z', 'com.Slack'),
+        ('Unknown importance: 10', '2020-03-07T20:21:00.000Z', 'com.Slack'),
+        ('Move to Foreground', '2020-03-07T20:25:00.000Z', 'com.facebook.orca'),
+        ('Move to Foreground', '2020-03-07T21:10:00.000Z', 'com.android.chrome'),
+        ('Move to Background', '2020-03-07T21:10:00.500Z', 'com.facebook.orca'),
+        ('Move to Foreground', '2020-03-07T22:00:00.000Z', 'com.Slack'),
+        ('Unknown importance: 26', '2020-03-07T23:15:00.000Z', 'android'),
+        ('Move to Foreground', '2020-03-08T09:00:00.000Z', 'com.android.chrome'),
+        ('Move to Background', '2020-03-08T09:00:00.000Z', 'com.android.chrome'),
+        ('Unknown importance: 15', '2020-03-08T10:00:00.000Z', 'com.android.chrome'),
+        ('Move to Foreground', '2020-03-08T10:02:00.000Z', 'com.facebook.orca'),
+        ('Move to Foreground', '2020-03-08T10:30:00.000Z', 'com.Slack'),
+        ('Move to Background', '2020-03-08T10:35:00.000Z', 'com.facebook.orca'),
+        ('Move to Background', '2020-03-08T12:45:00.000Z', 'com.Slack')
+    ]
+    dataframe = pd.DataFrame(events, columns = ['app_record_type', 'app_date_logged', 'app_full_name'])
+    dataframe['app_timezone'] = 'America/Los_Angeles'
+    dataframe['app_title'] = ''
+    dataframe['person'] = 'TestParticipant'
+    return dataframe
 
 class PreprocessingTest(unittest.TestCase):
     def test_no_args(self):
@@ -19,6 +51,438 @@ class PreprocessingTest(unittest.TestCase):
             sessioninterval = [30]
         )
 
+class EngineTest(unittest.TestCase):
+    def test_engines(self):
+        print("Comparing extraction engines")
+        for precision in [60, 900, 3600]:
+            expected = preprocessing.preprocess_dataframe(raw_events(), precision = precision, engine = 'loop')
+            encountered = preprocessing.preprocess_dataframe(raw_events(), precision = precision, engine = 'vectorized')
+            self.assertEqual(expected.to_csv(index=False), encountered.to_csv(index=False))
+
+class OverlapTest(unittest.TestCase):
+    def test_overlap(self):
+        print("Closing apps that are still open")
+        events = [
+            ('Move to Foreground', '2020-03-07T20:00:00.000Z', 'a'),
+            ('Move to Foreground', '2020-03-07T20:05:00.000Z', 'b'),
+            ('Move to Background', '2020-03-07T20:05:00.500Z', 'a'),
+            ('Move to Background', '2020-03-07T20:08:00.000Z', 'b'),
+            # b is closed when c is opened, in the same second
+            ('Move to Foreground', '2020-03-07T20:20:00.000Z', 'b'),
+            ('Move to Foreground', '2020-03-07T20:20:00.000Z', 'c'),
+            ('Move to Background', '2020-03-07T20:20:00.600Z', 'b'),
+            ('Move to Background', '2020-03-07T20:30:00.000Z', 'c')
+        ]
+        raw = pd.DataFrame(events, columns = ['app_record_type', 'app_date_logged', 'app_full_name'])
+        raw = raw.assign(app_timezone = 'UTC', app_title = '', person = 'TestParticipant')
+        for engine in ['loop', 'vectorized']:
+            data = preprocessing.preprocess_dataframe(raw.copy(), precision = 3600, engine = engine)
+            self.assertEqual(data['app_full_name'].tolist(), ['a', 'b', 'c'])
+            self.assertEqual(data['endtime'].tolist(), ['20:05:00.000000', '20:08:00.000000', '20:30:00.000000'])
+            self.assertEqual(data['app_duration_seconds'].tolist(), [300., 180., 600.])
+            self.assertEqual(data['app_engage_300s'].tolist(), [1, 0, 1])
+
+def write_raw(tmp, participants, corrupt=False, **assign):
+    '''
+    Writes the raw events (with the columns in assign changed) as the raw file of every
+    participant to the folder raw in tmp, and with corrupt a file that can't be read.
+    Returns the folder.
+    '''
+    infolder = os.path.join(tmp, 'raw')
+    os.makedirs(infolder, exist_ok=True)
+    for participant in participants:
+        raw_events().drop(columns = 'person').assign(**assign).to_csv(os.path.join(infolder, 'ChronicleData-%s.csv'%participant), index=False)
+    if corrupt:
+        with open(os.path.join(infolder, 'ChronicleData-corrupt.csv'), 'w') as fl:
+            fl.write("not,a,chronicle,file\n")
+    return infolder
+
+class FolderTestCase(unittest.TestCase):
+    def assertSameFiles(self, encountered, expected, extension='.csv'):
+        '''
+        Asserts that two folders have the same files with the extension, with the same content.
+        '''
+        files = sorted(x for x in os.listdir(expected) if x.endswith(extension))
+        self.assertEqual(sorted(x for x in os.listdir(encountered) if x.endswith(extension)), files)
+        for x in files:
+            with open(os.path.join(encountered, x)) as first, open(os.path.join(expected, x)) as second:
+                self.assertEqual(first.read(), second.read(), x)
+
+class WorkersTest(FolderTestCase):
+    def test_workers(self):
+        print("Preprocessing files in parallel")
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A', 'B'], corrupt = True)
+            for workers in [1, 2]:
+                outfolder = os.path.join(tmp, 'preprocessed_%i'%workers)
+                failed = preprocessing.preprocess_folder(infolder, outfolder, workers = workers)
+                self.assertEqual(failed, ['ChronicleData-corrupt.csv'])
+                outfiles = sorted([x for x in os.listdir(outfolder) if x.startswith('Chronicle')])
+                self.assertEqual(outfiles, ['ChronicleData_preprocessed-A.csv', 'ChronicleData_preprocessed-B.csv'])
+            self.assertSameFiles(os.path.join(tmp, 'preprocessed_2'), os.path.join(tmp, 'preprocessed_1'))
+
+class PipelineTest(FolderTestCase):
+    def test_fused(self):
+        print("Running all stages in memory")
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A', 'B'], corrupt = True)
+            kwargs = dict(recodefile = 'resources/categorisation.csv', quarterly = True, splitday = True)
+            preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'preprocessed'), precision = 900)
+            subsetting.subset(os.path.join(tmp, 'preprocessed'), os.path.join(tmp, 'subsetted'), removefile = 'resources/remove.csv')
+            summarising.summary(os.path.join(tmp, 'subsetted'), os.path.join(tmp, 'output'), **kwargs)
+            for workers in [1, 2]:
+                outfolder = os.path.join(tmp, 'fused_%i'%workers)
+                failed = pipeline.run(infolder, outfolder, precision = 900, removefile = 'resources/remove.csv', workers = workers, **kwargs)
+                self.assertEqual(failed, ['ChronicleData-corrupt.csv'])
+                self.assertSameFiles(outfolder, os.path.join(tmp, 'output'))
+
+class FilterTest(FolderTestCase):
+    def test_subsets(self):
+        print("Summarising several subsets while reading the preprocessed files")
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A'])
+            subsetfile = os.path.join(tmp, 'subset.csv')
+            pd.DataFrame({'full_name': ['com.Slack', 'com.facebook.orca', 'com.android.chrome'],
+                'work': [1, 0, 1], 'social': [0, 1, 0]}).to_csv(subsetfile, index=False)
+            filters = subsetting.read_filters(subsetfile)
+            self.assertEqual(filters['social'], {'keep': frozenset(['com.facebook.orca']), 'remove': None})
+            preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'preprocessed'), precision = 900)
+            subsetting.subset(os.path.join(tmp, 'preprocessed'), os.path.join(tmp, 'subsetted'), subsetfile = subsetfile)
+            summarising.summary(os.path.join(tmp, 'preprocessed'), os.path.join(tmp, 'output'), includestartend = True, subsetfile = subsetfile)
+            for name in ['work', 'social']:
+                expected = os.path.join(tmp, 'expected_%s'%name)
+                summarising.summary(os.path.join(tmp, 'subsetted', name), expected, includestartend = True)
+                self.assertSameFiles(os.path.join(tmp, 'output', name), expected)
+            daily = pd.read_csv(os.path.join(tmp, 'output', 'social', 'summary_daily.csv'))
+            self.assertTrue((daily['dur_mean'] > 0).all())
+
+class PrecisionTest(FolderTestCase):
+    def test_precisions(self):
+        print("Preprocessing at several precisions in one pass")
+        precisions = [60, 900, 3600]
+        for engine in ['loop', 'vectorized']:
+            results = preprocessing.preprocess_precisions(raw_events(), precisions, engine = engine)
+            for precision in precisions:
+                expected = preprocessing.preprocess_dataframe(raw_events(), precision = precision, engine = engine)
+                self.assertEqual(results[precision].to_csv(index=False), expected.to_csv(index=False))
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A'])
+            failed = preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'preprocessed'), precision = precisions)
+            self.assertEqual(failed, [])
+            pipeline.run(infolder, os.path.join(tmp, 'fused'), precision = precisions)
+            for precision in precisions:
+                expected = os.path.join(tmp, 'expected_%i'%precision)
+                preprocessing.preprocess_folder(infolder, expected, precision = precision)
+                self.assertSameFiles(os.path.join(tmp, 'preprocessed', 'precision_%i'%precision), expected)
+                summarising.summary(expected, os.path.join(expected, 'output'))
+                self.assertSameFiles(os.path.join(tmp, 'fused', 'precision_%i'%precision), os.path.join(expected, 'output'))
+            # unchanged files are skipped at every precision
+            self.assertEqual(preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'preprocessed'), precision = precisions), [])
+
+class IntervalTest(FolderTestCase):
+    def test_intervals(self):
+        print("Writing the usage as intervals")
+        for precision in [60, 630, 3600]:
+            data = preprocessing.preprocess_dataframe(raw_events(), precision = precision)
+            intervals = preprocessing.to_intervals(data, precision)
+            self.assertLess(len(intervals), len(data))
+            expected = preprocessing.add_preprocessed_columns(data.copy())
+            encountered = preprocessing.add_preprocessed_columns(preprocessing.expand_intervals(intervals))
+            self.assertEqual(encountered.to_csv(index=False), expected.to_csv(index=False))
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A'])
+            kwargs = dict(recodefile = 'resources/categorisation.csv', quarterly = True, splitday = True, includestartend = True)
+            for intervals in [False, True]:
+                preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'preprocessed_%s'%intervals), precision = 60, intervals = intervals)
+                summarising.summary(os.path.join(tmp, 'preprocessed_%s'%intervals), os.path.join(tmp, 'output_%s'%intervals), **kwargs)
+            self.assertSameFiles(os.path.join(tmp, 'output_True'), os.path.join(tmp, 'output_False'))
+            with self.assertRaises(ValueError):
+                preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'resumed'), intervals = True, resume = True)
+
+class CohortTest(FolderTestCase):
+    def test_batch(self):
+        print("Preprocessing a batch of files at once")
+        with tempfile.TemporaryDirectory() as tmp:
+            # A leaves an app open, B is in another timezone, D has no interactions
+            infolder = write_raw(tmp, ['C'], corrupt = True)
+            write_raw(tmp, ['B'], app_timezone = 'Asia/Kolkata')
+            raw = raw_events().drop(columns = 'person')
+            raw[:8].to_csv(os.path.join(infolder, 'ChronicleData-A.csv'), index=False)
+            usage = raw[raw['app_record_type'].str.startswith('Move')]
+            usage.to_csv(os.path.join(infolder, 'ChronicleData-D.csv'), index=False)
+            cohort, _ = preprocessing.read_cohort(['ChronicleData-C.csv', 'ChronicleData-D.csv'], infolder)
+            results = preprocessing.preprocess_cohort(cohort, [900])[900]
+            for person, events in [('C', raw), ('D', usage)]:
+                expected = preprocessing.preprocess_dataframe(events.assign(person = person), precision = 900, engine = 'vectorized')
+                self.assertEqual(results[person].dtypes.astype(str).tolist(), expected.dtypes.astype(str).tolist())
+                self.assertEqual(results[person].to_csv(index=False), expected.to_csv(index=False))
+            for precisions in [[60], [900, 3600]]:
+                preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'expected'), precision = precisions, engine = 'vectorized', force = True)
+                failed = preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'batch'), precision = precisions, batch = 2, force = True)
+                self.assertEqual(failed, ['ChronicleData-corrupt.csv'])
+                for precision in precisions:
+                    folder = preprocessing.get_precision_folder('', precision, precisions)
+                    self.assertSameFiles(os.path.join(tmp, 'batch', folder), os.path.join(tmp, 'expected', folder))
+            with self.assertRaises(ValueError):
+                preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'resumed'), batch = 2, resume = True)
+
+class ManifestTest(unittest.TestCase):
+    def test_incremental(self):
+        print("Skipping files that didn't change")
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A'])
+            outfolder = os.path.join(tmp, 'preprocessed')
+            preprocessing.preprocess_folder(infolder, outfolder)
+            outfile = os.path.join(outfolder, 'ChronicleData_preprocessed-A.csv')
+            open(outfile, 'w').close()
+            # unchanged: the (emptied) output is kept
+            preprocessing.preprocess_folder(infolder, outfolder)
+            self.assertEqual(os.path.getsize(outfile), 0)
+            # other parameters or force: preprocessed again
+            preprocessing.preprocess_folder(infolder, outfolder, precision = 900)
+            self.assertTrue(os.path.getsize(outfile) > 0)
+            open(outfile, 'w').close()
+            preprocessing.preprocess_folder(infolder, outfolder, precision = 900, force = True)
+            self.assertTrue(os.path.getsize(outfile) > 0)
+
+    def test_summary_cache(self):
+        print("Summarising again when the cache can't be read")
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A'])
+            preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'preprocessed'), precision = 900)
+            summarising.summary(os.path.join(tmp, 'preprocessed'), os.path.join(tmp, 'output'), includestartend = True)
+            expected = open(os.path.join(tmp, 'output', 'summary_daily.csv')).read()
+            with open(os.path.join(tmp, 'output', 'summary_cache', 'ChronicleData_preprocessed-A.csv.pkl'), 'wb') as fl:
+                fl.write(b'truncated')
+            summarising.summary(os.path.join(tmp, 'preprocessed'), os.path.join(tmp, 'output'), includestartend = True)
+            self.assertEqual(open(os.path.join(tmp, 'output', 'summary_daily.csv')).read(), expected)
+
+class ResumeTest(FolderTestCase):
+    def test_split(self):
+        print("Resuming preprocessing after new events")
+        raw = raw_events().drop(columns = 'person')
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A'])
+            filename = os.path.join(infolder, 'ChronicleData-A.csv')
+            preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'full'), precision = 900, sessioninterval = [60, 300])
+            for splits in [[x] for x in range(1, len(raw))] + [[4, 9, 12]]:
+                outfolder = os.path.join(tmp, 'resumed_%s'%'_'.join(map(str, splits)))
+                for rows in splits + [len(raw)]:
+                    raw[:rows].to_csv(filename, index=False)
+                    preprocessing.preprocess_folder(infolder, outfolder, precision = 900, sessioninterval = [60, 300], resume = True)
+                self.assertSameFiles(outfolder, os.path.join(tmp, 'full'))
+
+class ChunkTest(FolderTestCase):
+    def test_chunks(self):
+        print("Preprocessing raw files in chunks")
+        raw = raw_events().drop(columns = 'person')
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A'])
+            preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'full'), precision = 900)
+            for engine in ['loop', 'vectorized']:
+                for chunksize in [1, 4]:
+                    outfolder = os.path.join(tmp, 'chunks_%s_%i'%(engine, chunksize))
+                    preprocessing.preprocess_folder(infolder, outfolder, precision = 900, engine = engine, chunksize = chunksize)
+                    self.assertSameFiles(outfolder, os.path.join(tmp, 'full'))
+            if importlib.util.find_spec('pyarrow'):
+                # parts of a parquet file are row groups, with their own categories
+                kwargs = dict(precision = 900, intermediate_format = 'parquet')
+                preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'full'), force = True, **kwargs)
+                preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'chunks'), chunksize = 4, **kwargs)
+                expected = utils.read_intermediate(os.path.join(tmp, 'full', 'ChronicleData_preprocessed-A.parquet'))
+                encountered = utils.read_intermediate(os.path.join(tmp, 'chunks', 'ChronicleData_preprocessed-A.parquet'))
+                pd.testing.assert_frame_equal(encountered, expected)
+            # events out of order can't be read in chunks
+            raw[::-1].to_csv(os.path.join(infolder, 'ChronicleData-A.csv'), index=False)
+            failed = preprocessing.preprocess_folder(infolder, os.path.join(tmp, 'unsorted'), chunksize = 4)
+            self.assertEqual(failed, ['ChronicleData-A.csv'])
+
+def preprocessed_events():
+    with open('resources/constants/constants_preprocessed.yaml', 'r') as infile:
+        expected = pd.DataFrame(yaml.safe_load(infile))
+    basecols = ['participant_id', 'app_full_name', 'app_start_timestamp', 'app_end_timestamp',
+        'app_duration_seconds', 'app_switch_app', 'engage_60s']
+    return expected[basecols], expected
+
+class PreprocessedColumnsTest(unittest.TestCase):
+    def test_columns(self):
+        print("Adding preprocessed columns")
+        preprocessed, expected = preprocessed_events()
+        encountered = preprocessing.add_preprocessed_columns(preprocessed.copy())
+        for col in ['date', 'firstdate', 'lastdate']:
+            self.assertEqual(encountered[col].astype(str).tolist(), expected[col].tolist())
+        for col in ['day', 'weekdayMF', 'weekdayMTh', 'weekdaySTh', 'hour', 'quarter', 'duration_minutes', 'engage_60s_dur']:
+            self.assertEqual(encountered[col].tolist(), expected[col].tolist())
+
+    def test_sessions(self):
+        print("Adding session durations")
+        preprocessed, _ = preprocessed_events()
+        # first row is not a session start
+        encountered = preprocessing.add_preprocessed_columns(preprocessed[2:5].reset_index(drop=True))
+        self.assertEqual(encountered['engage_60s_dur'].tolist(), [30., 70., 70.])
+        # only one session
+        encountered = preprocessing.add_preprocessed_columns(preprocessed[1:3].reset_index(drop=True))
+        self.assertEqual(encountered['engage_60s_dur'].tolist(), [40., 40.])
+
+    def test_summary(self):
+        print("Summarising preprocessed columns")
+        preprocessed, _ = preprocessed_events()
+        with open('resources/constants/constants_summary.yaml', 'r') as infile:
+            expected = yaml.safe_load(infile)
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, 'preprocessed'))
+            preprocessed.to_csv(os.path.join(tmp, 'preprocessed', 'ChronicleData_preprocessed-TestParticipant.csv'), index=False)
+            summarising.summary(os.path.join(tmp, 'preprocessed'), os.path.join(tmp, 'output'))
+            encountered = pd.read_csv(os.path.join(tmp, 'output', 'summary_daily.csv')).to_dict()
+        # session summaries are currently not exported
+        for key in [x for x in expected.keys() if not x.startswith('engage')]:
+            if isinstance(expected[key][0], str):
+                self.assertEqual(encountered[key][0], expected[key][0])
+            else:
+                self.assertAlmostEqual(encountered[key][0], expected[key][0])
+
+class SplitTest(unittest.TestCase):
+    def test_splits(self):
+        print("Summarising subsets per day in one pass")
+        preprocessed, _ = preprocessed_events()
+        data = preprocessing.add_preprocessed_columns(preprocessed.copy())
+        data['category'] = ['a', 'b'] * (len(data) // 2) + ['a'] * (len(data) % 2)
+        datelist = pd.date_range(start = data['date'].min(), end = data['date'].max(), freq = 'D')
+        splits = {'week': data['weekdayMF'] == 1, 'morning': data['hour'] < 12}
+        daily = summarise_modalities.summarise_daily_splits(data, [], datelist, splits)
+        appcoding = summarise_modalities.summarise_recodes(data, ['category'], hourly=False, splits=splits)
+        for name, mask in splits.items():
+            subset = data[mask].reset_index(drop=True)
+            pd.testing.assert_frame_equal(daily[name], summarise_modalities.summarise_daily(subset, [], datelist))
+            pd.testing.assert_frame_equal(appcoding['appcoding_%s'%name], summarise_modalities.summarise_appcoding_daily(subset, ['category']))
+
+class RecodeTest(unittest.TestCase):
+    def test_recode(self):
+        print("Recoding apps")
+        recode = utils.read_recode('resources/categorisation.csv')
+        data = pd.DataFrame({'app_full_name': ['com.android.settings', 'not.an.app', 'com.android.settings']})
+        encountered = utils.recode_apps(data, recode)
+        self.assertEqual(encountered['categories'].tolist(), ['instrumental', None, 'instrumental'])
+
+class IntermediateFormatTest(unittest.TestCase):
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_parquet(self):
+        print("Writing preprocessed data as parquet")
+        data = preprocessing.preprocess_dataframe(raw_events(), precision = 900)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = utils.write_intermediate(data, os.path.join(tmp, 'ChronicleData_preprocessed-A.csv'), 'parquet')
+            self.assertTrue(filename.endswith('.parquet'))
+            encountered = utils.read_intermediate(filename)
+        self.assertEqual(list(encountered.columns), list(data.columns) + ['app_start_timestamp_utcoffset', 'app_end_timestamp_utcoffset'])
+        self.assertTrue((encountered['app_start_timestamp'] == data['app_start_timestamp']).all())
+        self.assertEqual(str(encountered['app_full_name'].dtype), 'category')
+
+class DtypesTest(unittest.TestCase):
+    def test_compact(self):
+        print("Compacting dtypes")
+        data = preprocessing.preprocess_dataframe(raw_events(), precision = 900)
+        self.assertEqual(str(data['app_full_name'].dtype), 'category')
+        self.assertEqual(str(data['app_duration_seconds'].dtype), 'float32')
+        # interactions have no hour
+        self.assertEqual(str(data['hour'].dtype), 'float32')
+        timed = dtypes.compact(data.dropna(subset = ['hour']).reset_index(drop=True))
+        self.assertEqual(str(timed['hour'].dtype), 'int8')
+        # counts of flags don't overflow
+        flags = dtypes.widen(pd.DataFrame({'app_switch_app': [1]*200}).astype('int8'), ['app_switch_app'])
+        self.assertEqual(flags['app_switch_app'].sum(), 200)
+
+class FillTest(unittest.TestCase):
+    def test_fill_hours(self):
+        print("Filling hours without usage")
+        dates = [pd.Timestamp('2020-03-07').date(), pd.Timestamp('2020-03-07').date(), pd.Timestamp('2020-03-09').date()]
+        hourly = pd.DataFrame({'date': dates, 'hour': [1, 5, 23], 'dur': [1., 2., 3.]}).groupby(['date', 'hour']).agg(sum)
+        datelist = pd.date_range(start = '2020-03-07', end = '2020-03-09', freq = 'D', tz = 'UTC')
+        filled = utils.fill_hours(hourly, datelist)
+        self.assertEqual(len(filled), 3*24)
+        self.assertEqual(filled['dur'].sum(), 6.)
+        self.assertEqual(filled.unstack('hour').shape, (3, 24))
+
+class CommandLineTest(unittest.TestCase):
+    def test_help(self):
+        print("Printing the help without importing pandas")
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=root)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'chroniclepy.chroniclepy', '--help'],
+            capture_output=True, text=True, env=env, cwd=root)
+        self.assertEqual(result.returncode, 0)
+        self.assertIn('usage:', result.stdout)
+        # lines "import time: self [us] | cumulative [us] | package", nested imports are indented
+        imports = [x.split('|') for x in result.stderr.splitlines() if x.startswith('import time:') and not 'self [us]' in x]
+        packages = [x[2].strip() for x in imports]
+        self.assertNotIn('pandas', packages)
+        self.assertNotIn('numpy', packages)
+
+    def test_submodules(self):
+        print("Listing all modules to import lazily")
+        package = importlib.import_module('chroniclepy.chroniclepy')
+        folder = os.path.dirname(package.__file__)
+        modules = [os.path.splitext(x)[0] for x in os.listdir(folder) if x.endswith('.py') and not x.startswith('__')]
+        self.assertEqual(sorted(set(modules) - set(package.submodules)), [])
+
+    def test_failed(self):
+        print("Exiting with an error when files failed")
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=root)
+        with tempfile.TemporaryDirectory() as tmp:
+            infolder = write_raw(tmp, ['A'])
+            folders = [infolder] + [os.path.join(tmp, x) for x in ['preprocessed', 'subsetted', 'output']]
+            command = [sys.executable, '-m', 'chroniclepy.chroniclepy', 'all'] + folders
+            result = subprocess.run(command, capture_output=True, text=True, env=env, cwd=root)
+            self.assertEqual(result.returncode, 0)
+            write_raw(tmp, [], corrupt = True)
+            result = subprocess.run(command, capture_output=True, text=True, env=env, cwd=root)
+            self.assertEqual(result.returncode, 1)
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'preprocessed', 'ChronicleData_preprocessed-A.csv')))
+            result = subprocess.run(command + ['--fused'], capture_output=True, text=True, env=env, cwd=root)
+            self.assertEqual(result.returncode, 1)
+
+class ProfileTest(unittest.TestCase):
+    def test_profile(self):
+        print("Profiling the stages")
+        with tempfile.TemporaryDirectory() as tmp:
+            profile = os.path.join(tmp, 'profile.jsonl')
+            utils.start_profiling(profile, os.path.join(tmp, 'profiles'))
+            try:
+                data = preprocessing.preprocess_dataframe(raw_events(), precision = 900)
+            finally:
+                utils.stop_profiling()
+            summary = utils.profile_summary(profile)
+            self.assertEqual(sorted(summary.index), ['add_warnings', 'bin_usages', 'check_overlap_add_sessions', 'clean_data', 'extract_usage'])
+            self.assertEqual(summary.loc['extract_usage', 'rows_in'], len(raw_events()))
+            self.assertEqual(summary.loc['extract_usage', 'calls'], 1)
+            self.assertTrue((summary['peak_mb'] >= 0).all())
+            # one dump per outer stage (clean_data and bin_usages are part of extract_usage)
+            self.assertEqual(len(os.listdir(os.path.join(tmp, 'profiles'))), 3)
+            # without profiling, nothing is written
+            preprocessing.preprocess_dataframe(raw_events(), precision = 900)
+            self.assertEqual(len(utils.profile_summary(profile)), 5)
+
+class BenchmarkTest(unittest.TestCase):
+    def test_generate(self):
+        print("Generating synthetic raw files")
+        with tempfile.TemporaryDirectory() as tmp:
+            first = generate.generate(os.path.join(tmp, 'first'), participants = 2, days = 3, seed = 1)
+            second = generate.generate(os.path.join(tmp, 'second'), participants = 2, days = 3, seed = 1)
+            for x, y in zip(first, second):
+                pd.testing.assert_frame_equal(pd.read_csv(x), pd.read_csv(y))
+            raw = preprocessing.read_data(first[0])
+            self.assertTrue(raw['app_date_logged'].is_monotonic_increasing)
+            expected = preprocessing.preprocess_dataframe(raw.copy(), precision = 900, engine = 'loop')
+            encountered = preprocessing.preprocess_dataframe(raw.copy(), precision = 900, engine = 'vectorized')
+            self.assertEqual(expected.to_csv(index=False), encountered.to_csv(index=False))
+
+    def test_benchmark(self):
+        print("Running the benchmarks")
+        with tempfile.TemporaryDirectory() as tmp:
+            results = bench.benchmark(tmp, participants = 1, days = 2, precisions = [3600], repeat = 1)
+        self.assertEqual([x['stage'] for x in results['results']], ['cli_imports', 'read_data', 'extract_usage', 'extract_usage',
+            'check_overlap_add_sessions', 'add_preprocessed_columns', 'summary'])
+
 class SubsettingTest(unittest.TestCase):
     def test_no_args(self):
         print("Running subsetting")
@@ -32,25 +496,27 @@ class SubsettingTest(unittest.TestCase):
 class SummaryTest(unittest.TestCase):
     def test_no_args(self):
         print("Running summary test without arguments")
-        summarising.summary(
-                infolder = 'resources/preprocessed',
-                outfolder = 'resources/output',
-                includestartend = True
-            )
+        with tempfile.TemporaryDirectory() as tmp:
+            summarising.summary(
+                    infolder = 'resources/preprocessed',
+                    outfolder = tmp,
+                    includestartend = True
+                )
 
     def test_args(self):
         print("Running summary with arguments")
-        summarising.summary(
-            infolder='resources/preprocessed',
-            outfolder='resources/output',
-            includestartend=True,
-            recodefile='resources/categorisation.csv',
-            quarterly=False,
-            splitweek=True,
-            weekdefinition="weekdayMF",
-            splitday=False,
-            maxdays=2
-        )
+        with tempfile.TemporaryDirectory() as tmp:
+            summarising.summary(
+                infolder='resources/preprocessed',
+                outfolder=tmp,
+                includestartend=True,
+                recodefile='resources/categorisation.csv',
+                quarterly=False,
+                splitweek=True,
+                weekdefinition="weekdayMF",
+                splitday=False,
+                maxdays=2
+            )
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file